@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Iterable
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path("/var/cache/nobara-updater")
+
+
+def load_json(name: str, cache_dir: Path = CACHE_DIR) -> Any:
+    try:
+        with (cache_dir / name).open(encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_json(name: str, data: Any, cache_dir: Path = CACHE_DIR) -> bool:
+    # Write to a temp file and rename so a reader (the tray polls while we
+    # write) never sees a half-written file.
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{name}.")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, cache_dir / name)
+        return True
+    except OSError as e:
+        logger.debug("Could not write cache file %s: %s", cache_dir / name, e)
+        return False
+
+
+def paths_digest(paths: Iterable[str | Path]) -> str:
+    """sha256 over the names and contents of the given files and, for
+    directories, of every regular file directly inside them."""
+    digest = hashlib.sha256()
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files = sorted(child for child in path.iterdir() if child.is_file())
+        else:
+            files = [path]
+        for file in files:
+            try:
+                content = file.read_bytes()
+            except OSError:
+                continue
+            digest.update(str(file).encode())
+            digest.update(hashlib.sha256(content).digest())
+    return digest.hexdigest()
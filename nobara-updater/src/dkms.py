@@ -0,0 +1,193 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import NamedTuple
+
+from nobara_updater.cache import CACHE_DIR
+from nobara_updater.kernels import KernelInventory
+from nobara_updater.progress import DETAIL, format_duration
+
+DKMS_TREE = Path("/var/lib/dkms")
+CCACHE_DIR = CACHE_DIR / "ccache"
+CCACHE_SIZE = "5G"
+# Where Fedora's ccache package puts its gcc/cc wrappers.
+CCACHE_WRAPPERS = Path("/usr/lib64/ccache")
+
+# "nvidia/570.144, 6.14.5-300.fc42.x86_64, x86_64: installed", the older
+# "nvidia, 570.144, ..." form, or "nvidia/570.144: added" without a kernel.
+_STATUS_LINE = re.compile(
+    r"^(?P<name>[^,/:\s]+)[/,]\s*(?P<version>[^,:\s]+)"
+    r"(?:,\s*(?P<kver>[^,:\s]+),\s*(?P<arch>[^,:\s]+))?:\s*(?P<state>\w+)"
+)
+
+
+class ModuleBuild(NamedTuple):
+    name: str
+    version: str
+    kver: str
+
+
+def dkms_status() -> tuple[set[tuple[str, str]], set[ModuleBuild]]:
+    """The modules added to dkms, and the (module, kernel) pairs that are
+    already installed."""
+    result = subprocess.run(
+        ["dkms", "status"],
+        capture_output=True,
+        text=True, encoding="utf-8", errors="replace",
+    )
+    modules: set[tuple[str, str]] = set()
+    installed: set[ModuleBuild] = set()
+    for line in result.stdout.splitlines():
+        match = _STATUS_LINE.match(line.strip())
+        if not match:
+            continue
+        modules.add((match["name"], match["version"]))
+        if match["kver"] and match["state"] == "installed":
+            installed.add(ModuleBuild(match["name"], match["version"], match["kver"]))
+    return modules, installed
+
+
+def _build_env(basedir: str) -> dict[str, str]:
+    env = dict(os.environ)
+    env["CCACHE_DIR"] = str(CCACHE_DIR)
+    env["CCACHE_MAXSIZE"] = CCACHE_SIZE
+    # Every build runs in its own temporary tree, hash paths relative to it
+    # so the next build (other kernel, other driver version) hits the cache.
+    env["CCACHE_BASEDIR"] = basedir
+    env["CCACHE_NOHASHDIR"] = "1"
+    if CCACHE_WRAPPERS.is_dir():
+        env["PATH"] = f"{CCACHE_WRAPPERS}:{env.get('PATH', '')}"
+    return env
+
+
+class DkmsBuilder:
+    """Builds missing dkms modules for all installed kernels at once.
+
+    `dkms autoinstall` builds one kernel after the other, in a build
+    directory every kernel of a module shares, so two builds of the same
+    module can't run side by side in /var/lib/dkms. Here each kernel is
+    built in a private dkms tree, in parallel with the others and with a
+    share of the cores as make -j. The built module is then copied to
+    /var/lib/dkms and `dkms install` only installs it, one kernel at a
+    time. Kernels that already have the module installed are skipped, and
+    compiler output is kept in a ccache between runs.
+    """
+
+    def __init__(self, logger: logging.Logger | None = None, jobs: int | None = None) -> None:
+        self.logger = logger if logger else logging.getLogger("nobara-updater.dkms")
+        self.jobs = jobs or os.cpu_count() or 1
+
+    def pending(self, kernels: list[str], modules: list[str] | None = None) -> list[ModuleBuild]:
+        added, installed = dkms_status()
+        return [
+            ModuleBuild(name, version, kver)
+            for name, version in sorted(added)
+            if modules is None or name in modules
+            for kver in kernels
+            if ModuleBuild(name, version, kver) not in installed
+        ]
+
+    def _run(self, command: list[str], env: dict[str, str] | None = None) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            command,
+            capture_output=True,
+            text=True, encoding="utf-8", errors="replace",
+            env=env,
+        )
+
+    def _build(self, build: ModuleBuild, make_jobs: int) -> tuple[bool, float, str]:
+        started = time.monotonic()
+        tree = tempfile.mkdtemp(prefix=f"dkms-{build.kver}-", dir="/var/tmp")
+        env = _build_env(tree)
+        output = []
+        try:
+            for command in (
+                ["dkms", "add", "-m", build.name, "-v", build.version, "--dkmstree", tree],
+                [
+                    "dkms", "build", "-m", build.name, "-v", build.version,
+                    "-k", build.kver, "--dkmstree", tree, "-j", str(make_jobs),
+                ],
+            ):
+                result = self._run(command, env)
+                output.append(result.stdout + result.stderr)
+                if result.returncode != 0:
+                    return False, time.monotonic() - started, "".join(output)
+            built = Path(tree) / build.name / build.version / build.kver
+            shutil.copytree(
+                built, DKMS_TREE / build.name / build.version / build.kver, dirs_exist_ok=True
+            )
+            return True, time.monotonic() - started, "".join(output)
+        except OSError as e:
+            output.append(str(e))
+            return False, time.monotonic() - started, "".join(output)
+        finally:
+            shutil.rmtree(tree, ignore_errors=True)
+
+    def build(self, kernels: list[str] | None = None, modules: list[str] | None = None) -> bool:
+        """Build and install what's missing for the given kernels (the
+        bootable ones by default), for all dkms modules or only the named
+        ones. Returns False if any module failed."""
+        if shutil.which("dkms") is None:
+            return True
+        if kernels is None:
+            kernels = KernelInventory(self.logger).versions()
+        builds = self.pending(kernels, modules)
+        if not builds:
+            self.logger.info("All dkms modules are built for the installed kernels.\n")
+            return True
+
+        started = time.monotonic()
+        workers = max(1, min(len(builds), self.jobs))
+        make_jobs = max(1, self.jobs // workers)
+        CCACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.logger.info(
+            "Building %s dkms modules, %s at a time with -j%s...",
+            len(builds), workers, make_jobs,
+        )
+
+        built: list[ModuleBuild] = []
+        success = True
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = {executor.submit(self._build, build, make_jobs): build for build in builds}
+            for job in as_completed(jobs):
+                build = jobs[job]
+                ok, seconds, output = job.result()
+                if ok:
+                    built.append(build)
+                    self.logger.info(
+                        "%s/%s built for %s in %s.",
+                        build.name, build.version, build.kver, format_duration(seconds),
+                    )
+                    self.logger.info("dkms output:\n%s", output, extra=DETAIL)
+                else:
+                    # e.g. a dkms without --dkmstree, build it the usual way below.
+                    self.logger.warning(
+                        "Parallel build of %s/%s for %s failed, retrying with dkms install:\n%s",
+                        build.name, build.version, build.kver, output,
+                    )
+
+        for build in builds:
+            install_started = time.monotonic()
+            result = self._run(["dkms", "install", "-m", build.name, "-v", build.version, "-k", build.kver])
+            if result.returncode != 0:
+                success = False
+                self.logger.error(
+                    "dkms install of %s/%s for %s failed:\n%s",
+                    build.name, build.version, build.kver, result.stdout + result.stderr,
+                )
+            elif build not in built:
+                self.logger.info(
+                    "%s/%s built for %s in %s.",
+                    build.name, build.version, build.kver,
+                    format_duration(time.monotonic() - install_started),
+                )
+        self.logger.info(
+            "dkms builds done in %s.\n", format_duration(time.monotonic() - started)
+        )
+        return success
@@ -4,22 +4,35 @@ import libdnf5.repo as dnf5_repo
 import libdnf5.rpm as dnf5_rpm
 import libdnf5.transaction as dnf5_trans
 from libdnf5.exception import OptionValueNotSetError
+import hashlib
 import queue
 import threading
 import time
 import sys
-from logging.handlers import QueueHandler
-from typing import Any, List
-import inspect
-import dnf  # type: ignore[import]
-import gi  # type: ignore[import]
+import re
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
 import subprocess
 import os
 import contextlib
 
-gi.require_version("Gtk", "3.0")
-
-from gi.repository import Gtk  # type: ignore[import]
+from nobara_updater.cache import load_json, paths_digest, save_json
+from nobara_updater.downloads import DownloadProfile, apply_download_profile, record_download_sample
+from nobara_updater.freshness import expire_changed_repos, refresh_args
+from nobara_updater.kernels import (
+    KERNEL_INSTALLONLY_PACKAGE,
+    KERNEL_PACKAGE,
+    boot_usage,
+    initramfs_seconds,
+    kernels_to_remove,
+    known_good_kernel,
+    record_booted_kernel,
+)
+from nobara_updater.mirrors import apply_mirror_ranking
+from nobara_updater.progress import DETAIL, TransactionProgress
+
+if TYPE_CHECKING:
+    from gi.repository import Gtk  # type: ignore[import]
 
 logger = logging.getLogger()
 
@@ -71,40 +84,96 @@ def mute_loggers(names: list[str], level: int = logging.WARNING):
             lg.propagate = old_propagate
             lg.handlers = old_handlers
 
-def repoindex(retries: int = 3, delay: int = 5) -> list[AttributeDict]:
+REPO_CONFIG_PATHS = (
+    "/etc/yum.repos.d",
+    "/etc/distro.repos.d",
+    "/etc/dnf/repos.override.d",
+    "/etc/dnf/dnf.conf",
+    "/etc/dnf/vars",
+    "/etc/os-release",
+)
+REPO_CONFIG_CACHE_FILE = "repos.json"
+_repo_config_cache: tuple[str, list[AttributeDict]] | None = None
+
+
+def repo_config_stamp() -> str:
+    """mtimes of the repo configuration, the directories (files added,
+    removed or renamed) and every file directly inside them (edited in
+    place)."""
+    state = []
+    for path in REPO_CONFIG_PATHS:
+        try:
+            state.append((path, os.stat(path).st_mtime_ns))
+            if os.path.isdir(path):
+                for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                    state.append((entry.path, entry.stat().st_mtime_ns))
+        except OSError:
+            continue
+    return hashlib.sha256(repr(state).encode()).hexdigest()
+
+
+def _load_repo_config() -> list[AttributeDict]:
     def get_safe_value(option):
         try:
             return option.get_value()
         except (OptionValueNotSetError, RuntimeError, AttributeError):
             return None
 
+    base = dnf5_base.Base()
+    base.load_config()
+    base.setup()
+
+    # Only the .repo files are read here, load_repos() would download and
+    # parse the metadata of every repo just to get at the same options.
+    sack = base.get_repo_sack()
+    sack.create_repos_from_system_configuration()
+
+    enabled_repos = []
+    query = dnf5_repo.RepoQuery(base)
+
+    for repo in query:
+        config = repo.get_config()
+        enabled = get_safe_value(config.get_enabled_option())
+        if enabled:
+            repo_id = repo.get_id()
+            metalink = get_safe_value(config.get_metalink_option())
+            mirrorlist = get_safe_value(config.get_mirrorlist_option())
+            raw_baseurl = get_safe_value(config.get_baseurl_option())
+            baseurl = list(raw_baseurl) if raw_baseurl is not None else None
+            enabled_repos.append(AttributeDict(repo_id, metalink, mirrorlist, baseurl))
+
+    return enabled_repos
+
+
+def repoindex(retries: int = 3, delay: int = 5) -> list[AttributeDict]:
+    """Enabled repos as configured, without loading any metadata.
+
+    The result is kept in memory and in /var/cache/nobara-updater until
+    repo_config_stamp() changes, so checking the repos works offline and
+    doesn't even need libdnf5 after the first run.
+    """
+    global _repo_config_cache
+    stamp = repo_config_stamp()
+    if _repo_config_cache is not None and _repo_config_cache[0] == stamp:
+        return list(_repo_config_cache[1])
+
+    cached = load_json(REPO_CONFIG_CACHE_FILE)
+    if isinstance(cached, dict) and cached.get("stamp") == stamp:
+        try:
+            enabled_repos = [
+                AttributeDict(repo["id"], repo["metalink"], repo["mirrorlist"], repo["baseurl"])
+                for repo in cached["repos"]
+            ]
+            _repo_config_cache = (stamp, enabled_repos)
+            return list(enabled_repos)
+        except (KeyError, TypeError):
+            pass
+
     attempt = 0
     while attempt < retries:
-        base = dnf5_base.Base()
         try:
-            base.load_config()
-            base.setup()
-
-            sack = base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos()
-            
-            enabled_repos = []
-            query = dnf5_repo.RepoQuery(base)
-
-            for repo in query:
-                config = repo.get_config()
-                enabled = get_safe_value(config.get_enabled_option())
-                if enabled:
-                    repo_id = repo.get_id()
-                    metalink = get_safe_value(config.get_metalink_option())
-                    mirrorlist = get_safe_value(config.get_mirrorlist_option())
-                    raw_baseurl = get_safe_value(config.get_baseurl_option())
-                    baseurl = list(raw_baseurl) if raw_baseurl is not None else None
-                    enabled_repos.append(AttributeDict(repo_id, metalink, mirrorlist, baseurl))
-
-            return enabled_repos
-
+            enabled_repos = _load_repo_config()
+            break
         except Exception as e:
             attempt += 1
             logger.error("Attempt %d failed with error: %s. Retrying...", attempt, e)
@@ -112,8 +181,28 @@ def repoindex(retries: int = 3, delay: int = 5) -> list[AttributeDict]:
                 time.sleep(delay)
             else:
                 raise Exception(f"Failed to complete operation after {retries} attempts")
-        finally:
-            del base
+
+    _repo_config_cache = (stamp, enabled_repos)
+    save_json(
+        REPO_CONFIG_CACHE_FILE,
+        {
+            "stamp": stamp,
+            "repos": [
+                {
+                    "id": repo.id,
+                    "metalink": repo.metalink,
+                    "mirrorlist": repo.mirrorlist,
+                    "baseurl": repo.baseurl,
+                }
+                for repo in enabled_repos
+            ],
+        },
+    )
+    return list(enabled_repos)
+
+
+def repo_enabled(repo_id: str) -> bool:
+    return any(repo.id == repo_id for repo in repoindex())
 
 def _add_resolvable_installonly_upgrades(
     base: dnf5_base.Base,
@@ -138,121 +227,464 @@ def _add_resolvable_installonly_upgrades(
         if any(True for _ in query):
             goal.add_upgrade(name)
 
-def updatechecker(retries: int = 3, delay: int = 5) -> list[str]:
-    attempt = 0
-    while attempt < retries:
-        base = dnf5_base.Base()
+def _kernel_version(pkg) -> str:
+    return f"{pkg.get_version()}-{pkg.get_release()}.{pkg.get_arch()}"
+
+
+def _add_kernel_retention(
+    base: dnf5_base.Base,
+    goal: dnf5_base.Goal,
+    transaction,
+    keep: int,
+) -> str | None:
+    """Remove the kernels the retention policy drops in the same goal as
+    the upgrade. Returns what was decided, for the log of the run that
+    commits it, or None if there is nothing to remove.
+
+    Installed kernels are ordered by install time, the ones the upgrade
+    brings in count as the newest.
+    """
+    installed_query = dnf5_rpm.PackageQuery(base)
+    installed_query.filter_installed()
+    installed_packages = list(installed_query)
+    kernel_packages = sorted(
+        (pkg for pkg in installed_packages if KERNEL_PACKAGE.match(pkg.get_name())),
+        key=lambda pkg: pkg.get_install_time(),
+    )
+    installed = list(dict.fromkeys(_kernel_version(pkg) for pkg in kernel_packages))
+    incoming = [
+        _kernel_version(pkg) for pkg in _inbound_packages(transaction)
+        if KERNEL_PACKAGE.match(pkg.get_name())
+    ]
+    running = os.uname().release
+    known_good = known_good_kernel(installed)
+
+    remove = kernels_to_remove(installed, incoming, keep, running, known_good)
+    if not remove:
+        return None
+    for pkg in installed_packages:
+        # kmods built for a kernel require its kernel-core and go with it.
+        if KERNEL_INSTALLONLY_PACKAGE.match(pkg.get_name()) and _kernel_version(pkg) in remove:
+            goal.add_remove(pkg.get_nevra())
+
+    freed = sum(boot_usage(version) for version in remove)
+    per_build = initramfs_seconds()
+    saved = f", about {per_build * len(remove):.0f} s less initramfs rebuilding per kernel update" if per_build else ""
+    return (
+        f"Kernel retention (keep {keep}, running {running}, known good {known_good or 'none'}): "
+        f"removing {', '.join(remove)}, frees {freed / 1_000_000:.1f} MB in /boot{saved}."
+    )
+
+
+RPMDB_PATHS = ("/usr/lib/sysimage/rpm", "/var/lib/rpm")
+
+
+def rpmdb_cookie() -> str:
+    """Cheap fingerprint of the rpmdb.
+
+    Any committed rpm transaction rewrites the database files, so comparing
+    their stat() results tells us whether the installed set changed without
+    having to load it. The -shm file is skipped because plain readers touch
+    it too.
+    """
+    for directory in RPMDB_PATHS:
         try:
-            config = base.get_config()
-            config.get_metadata_expire_option().from_string("0")
-            config.get_obsoletes_option().from_string("true")
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        state = []
+        for entry in entries:
+            if entry.name.endswith(("-shm", ".lock")) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            state.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        if state:
+            return hashlib.sha256(repr(state).encode()).hexdigest()
+    return ""
+
+
+LIBDNF5_CACHE_DIR = Path("/var/cache/libdnf5")
+DNF_CONFIG_PATHS = (
+    "/etc/dnf/dnf.conf",
+    "/etc/dnf/libdnf5.conf.d",
+    "/etc/dnf/vars",
+    "/etc/yum.repos.d",
+    "/etc/os-release",
+)
+UPDATE_CACHE_FILE = "updates.json"
+# Upper bound on how long a cached result is trusted even if the key still
+# matches, the key only sees metadata that has already been downloaded.
+UPDATE_CACHE_MAX_AGE = 60 * 60
+
+
+def update_check_key() -> str:
+    """Everything the result of ``upgrade *`` depends on, hashed.
+
+    That is the metadata of every cached repo (its repomd.xml carries the
+    revision and the checksums of all other metadata files), the rpmdb and
+    the dnf/repo configuration. If none of those moved, resolving again
+    gives the same answer.
+    """
+    digest = hashlib.sha256()
+    for repomd in sorted(LIBDNF5_CACHE_DIR.glob("*/repodata/repomd.xml")):
+        try:
+            content = repomd.read_bytes()
+        except OSError:
+            continue
+        digest.update(repomd.parent.parent.name.encode())
+        digest.update(hashlib.sha256(content).digest())
+    digest.update(rpmdb_cookie().encode())
+    digest.update(paths_digest(DNF_CONFIG_PATHS).encode())
+    return digest.hexdigest()
 
-            base.load_config()
-            base.setup()
 
-            sack = base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos()
+def load_cached_upgrades() -> list[str] | None:
+    cached = load_json(UPDATE_CACHE_FILE)
+    if not isinstance(cached, dict):
+        return None
+    try:
+        if time.time() - float(cached["time"]) > UPDATE_CACHE_MAX_AGE:
+            return None
+        if cached["key"] != update_check_key():
+            return None
+        return list(cached["upgrades"])
+    except (KeyError, TypeError, ValueError):
+        return None
 
-            goal = dnf5_base.Goal(base)
-            goal.add_upgrade("*")
 
-            try:
-                install_only_names = config.installonlypkgs
-            except AttributeError:
-                install_only_names = []
+def store_cached_upgrades(upgrades: list[str]) -> None:
+    save_json(
+        UPDATE_CACHE_FILE,
+        {"key": update_check_key(), "time": time.time(), "upgrades": sorted(upgrades)},
+    )
+
+
+class UpdateSession:
+    """A single loaded libdnf5 Base shared by a whole nobara-sync run.
 
-            _add_resolvable_installonly_upgrades(base, goal, install_only_names)
+    Loading the sack costs seconds of CPU and hundreds of MB of RSS, and a
+    run used to do it once for the repo check, once per update check (before
+    the fixups, inside them, before the install and after it), once for the
+    upgrade transaction and once more for every PackageUpdater call. The
+    session loads it once, resolves the upgrade set once, and only throws
+    both away when the rpmdb has really changed underneath it.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger | None = None,
+        retries: int = 3,
+        delay: int = 5,
+        download_profile: DownloadProfile | None = None,
+        keep_kernels: int | None = None,
+    ) -> None:
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.retries = retries
+        self.delay = delay
+        self.download_profile = download_profile
+        # Kernel retention policy, see _add_kernel_retention(). None leaves
+        # it to dnf's installonly_limit.
+        self.keep_kernels = keep_kernels
+        # What the policy decided for the resolved transaction, logged
+        # when it's committed.
+        self.kernel_retention: str | None = None
+        # The download callbacks set on the base, see _monitor_downloads().
+        self.download_monitor: DownloadMonitor | None = None
+        self._lock = threading.RLock()
+        # Bumped by abandon(), results of calls from before are not kept.
+        self._generation = 0
+        self._base: dnf5_base.Base | None = None
+        self._transaction = None
+        self._upgrades: list[str] | None = None
+        self._installed: set[str] | None = None
+        self._cookie: str | None = None
+        self._config_stamp: str | None = None
+        # Only the first load of a run needs to check the metadata against
+        # the servers, reloads after an rpm transaction can use what was
+        # just fetched.
+        self._metadata_refreshed = False
+
+    def _load_base(self) -> dnf5_base.Base:
+        base = dnf5_base.Base()
+        config = base.get_config()
+        config.get_obsoletes_option().from_string("true")
 
-            transaction = goal.resolve()
-            upgrades = []
-            t_pkgs = transaction.get_transaction_packages()
-            for t_pkg in t_pkgs:
-                action = t_pkg.get_action()
+        base.load_config()
+        # After dnf.conf, so the command line wins.
+        apply_download_profile(base, self.download_profile)
+        if self.keep_kernels is not None:
+            # The retention policy decides which kernels go.
+            config.get_installonly_limit_option().from_string("0")
+        base.setup()
+
+        sack = base.get_repo_sack()
+        sack.create_repos_from_system_configuration()
+        try:
+            apply_mirror_ranking(base, self.logger)
+        except Exception as e:
+            self.logger.warning("Could not apply mirror ranking: %s", e)
+        if not self._metadata_refreshed:
+            try:
+                expire_changed_repos(base, self.logger)
+            except Exception as e:
+                # Fall back to what metadata_expire=0 used to do.
+                self.logger.warning("Could not check repository metadata freshness: %s", e)
+                for repo in dnf5_repo.RepoQuery(base):
+                    repo.expire()
+        sack.load_repos()
+
+        self._metadata_refreshed = True
+        return base
+
+    def _check_rpmdb(self) -> None:
+        if self._cookie is not None and rpmdb_cookie() != self._cookie:
+            self.logger.debug("rpmdb changed, reloading package sack.")
+            self.invalidate()
+        elif self._base is not None and repo_config_stamp() != self._config_stamp:
+            # e.g. the media fixup enabling a repo, the loaded sack can't
+            # see it.
+            self.logger.debug("Repository configuration changed, reloading package sack.")
+            self.invalidate()
+
+    @property
+    def base(self) -> dnf5_base.Base:
+        with self._lock:
+            self._check_rpmdb()
+            if self._base is None:
+                generation = self._generation
+                base = self._load_base()
+                if generation != self._generation:
+                    # Abandoned while loading, the caller still gets it.
+                    return base
+                self._base = base
+                self._cookie = rpmdb_cookie()
+                self._config_stamp = repo_config_stamp()
+            return self._base
+
+    def invalidate(self) -> None:
+        """Forget the loaded sack and everything resolved from it."""
+        with self._lock:
+            self._transaction = None
+            self.kernel_retention = None
+            self._upgrades = None
+            self._installed = None
+            self._cookie = None
+            self._config_stamp = None
+            self._base = None
+
+    def abandon(self) -> None:
+        """Give up on a call still running in another thread, e.g. an update
+        check that timed out.
+
+        That thread keeps the old lock until libdnf5 returns, later calls
+        get a new lock and load a new sack. What the abandoned call still
+        loads or resolves is returned to it but not kept here.
+        """
+        self._generation += 1
+        self._lock = threading.RLock()
+        self.invalidate()
+
+    def upgrade_transaction(self):
+        """Resolved ``upgrade *`` transaction for the current rpmdb state."""
+        with self._lock:
+            generation = self._generation
+            self._check_rpmdb()
+            if self._transaction is not None:
+                return self._transaction
+
+            attempt = 0
+            while True:
+                try:
+                    base = self.base
+
+                    def upgrade_goal() -> dnf5_base.Goal:
+                        goal = dnf5_base.Goal(base)
+                        goal.add_upgrade("*")
+
+                        try:
+                            install_only_names = base.get_config().installonlypkgs
+                        except AttributeError:
+                            install_only_names = []
+
+                        _add_resolvable_installonly_upgrades(base, goal, install_only_names)
+                        return goal
+
+                    transaction = upgrade_goal().resolve()
+                    retention = None
+                    if self.keep_kernels is not None:
+                        # Which kernels stay depends on the ones the upgrade
+                        # installs, so resolve once more with the removals.
+                        goal = upgrade_goal()
+                        retention = _add_kernel_retention(base, goal, transaction, self.keep_kernels)
+                        if retention:
+                            transaction = goal.resolve()
+                    if generation == self._generation:
+                        self._transaction = transaction
+                        self.kernel_retention = retention
+                    return transaction
+                except Exception as e:
+                    attempt += 1
+                    self.logger.error(f"Update check attempt {attempt} failed: {e}")
+                    if generation != self._generation:
+                        raise
+                    self.invalidate()
+                    if attempt >= self.retries:
+                        raise
+                    time.sleep(self.delay)
+
+    def upgrades(self) -> list[str]:
+        with self._lock:
+            generation = self._generation
+            self._check_rpmdb()
+            if self._upgrades is None and self._base is None:
+                # Nothing loaded yet, a previous run may already have
+                # resolved against exactly this metadata and rpmdb.
+                cached = load_cached_upgrades()
+                if cached is not None:
+                    self.logger.debug("Update check key unchanged, using cached results.")
+                    self._upgrades = cached
+                    self._cookie = rpmdb_cookie()
+            if self._upgrades is None:
                 valid_actions = [
                     dnf5_trans.TransactionItemAction_UPGRADE,
                     dnf5_trans.TransactionItemAction_INSTALL
                 ]
+                upgrades = []
+                for t_pkg in self.upgrade_transaction().get_transaction_packages():
+                    if t_pkg.get_action() in valid_actions:
+                        upgrades.append(t_pkg.get_package().get_name())
+                upgrades = list(set(upgrades))
+                store_cached_upgrades(upgrades)
+                if generation != self._generation:
+                    return upgrades
+                self._upgrades = upgrades
+            return list(self._upgrades)
+
+    def installed_names(self) -> set[str]:
+        with self._lock:
+            self._check_rpmdb()
+            if self._installed is None:
+                installed_query = dnf5_rpm.PackageQuery(self.base)
+                installed_query.filter_installed()
+                self._installed = {pkg.get_name() for pkg in installed_query}
+            return set(self._installed)
+
+
+class InstalledPackage(NamedTuple):
+    name: str
+    epoch: str
+    version: str
+    release: str
+    arch: str
+    from_repo: str
+
+    @property
+    def nevra(self) -> str:
+        # Same format `rpm -q` prints: no epoch.
+        return f"{self.name}-{self.version}-{self.release}.{self.arch}"
+
+
+class InstalledIndex:
+    """Answers `rpm -q`-style questions from one read of the rpmdb.
+
+    The fixup pass used to fork `rpm -q` once per package name, plus the
+    odd `rpm -qa | grep` and `dnf list --installed | grep`, which added up
+    to well over a hundred processes. The index maps name, name.arch and
+    the NEVRA forms rpm accepts to the installed records (including the
+    repo each package was installed from) and is only rebuilt when the
+    rpmdb cookie changes.
+    """
 
-                if action in valid_actions:
-                    upgrades.append(t_pkg.get_package().get_name())
-
-            return list(set(upgrades))
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cookie: str | None = None
+        self._packages: list[InstalledPackage] = []
+        self._by_spec: dict[str, list[InstalledPackage]] = {}
 
-        except Exception as e:
-            attempt += 1
-            logger.error(f"Update check attempt {attempt} failed: {e}")
-            if attempt >= retries:
-                raise
-            time.sleep(delay)
+    def _load(self) -> list[InstalledPackage]:
+        base = dnf5_base.Base()
+        try:
+            base.load_config()
+            base.setup()
+            base.get_repo_sack().load_repos(dnf5_repo.Repo.Type_SYSTEM)
+
+            query = dnf5_rpm.PackageQuery(base)
+            query.filter_installed()
+            return [
+                InstalledPackage(
+                    pkg.get_name(),
+                    pkg.get_epoch(),
+                    pkg.get_version(),
+                    pkg.get_release(),
+                    pkg.get_arch(),
+                    pkg.get_from_repo_id(),
+                )
+                for pkg in query
+            ]
         finally:
             del base
 
-class CustomTransactionDisplay(dnf.yum.rpmtrans.LoggingTransactionDisplay):
-    def __init__(self, total_packages):
-        super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.scriptlet_progress = {}
-        self.performing_cleanup = 0
-        self.performing_upgrade = 0
-        self.starting_line = 0
-        self.total_packages = total_packages
-        self.package = ""
-
-    def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
-        super().progress(package, action, ti_done, ti_total, ts_done, ts_total)
-        action_str = self._get_action_str(action)
-        package_name = str(package)
-
-        match action_str:
-            case "Upgraded:" | "Preparing:" | "Reinstalled:" | "Downgraded:" | "Obsoleted:" | "Cleanup:":
-                return  # Skip logging for these actions
-
-        if action_str == "Running scriptlet:":
-            if self.performing_cleanup == 0:
-                self.logger.info("Cleanup...")
-                self.performing_cleanup = 1
-            else:
-                return
-        else:
-            if self.performing_upgrade == 0:
-                if action_str == "Upgrading:":
-                    self.logger.info("Upgrading...")
-                if action_str == "Removing:":
-                    self.logger.info("Removing...")
-                if action_str == "Downgrading:":
-                    self.logger.info("Downgrading...")
-                if action_str == "Installing:":
-                    self.logger.info("Installing...")
-
-                self.performing_upgrade = 1
-
-            if self.package != package_name:
-                self.starting_line += 1
-                if self.starting_line <= self.total_packages:
-                    self.package = package_name
-                    self.logger.info(f"    ({self.starting_line}/{self.total_packages}) {action_str} {package_name}")
-                else:
-                    return
-
-    def _get_action_str(self, action):
-        action_map = {
-            dnf.transaction.PKG_DOWNGRADE: 'Downgrading:',
-            dnf.transaction.PKG_DOWNGRADED: 'Downgraded:',
-            dnf.transaction.PKG_INSTALL: 'Installing:',
-            dnf.transaction.PKG_OBSOLETE: 'Obsoleting:',
-            dnf.transaction.PKG_OBSOLETED: 'Obsoleted:',
-            dnf.transaction.PKG_REINSTALL: 'Reinstalling:',
-            dnf.transaction.PKG_REINSTALLED: 'Reinstalled:',
-            dnf.transaction.PKG_REMOVE: 'Removing:',
-            dnf.transaction.PKG_UPGRADE: 'Upgrading:',
-            dnf.transaction.PKG_UPGRADED: 'Upgraded:',
-            dnf.transaction.PKG_CLEANUP: 'Cleanup:',
-            dnf.transaction.PKG_VERIFY: 'Verified:',
-            dnf.transaction.PKG_SCRIPTLET: 'Running scriptlet:',
-            dnf.transaction.TRANS_PREPARATION: 'Preparing:',
-        }
-        return action_map.get(action, action)
+    def _ensure_current(self) -> None:
+        cookie = rpmdb_cookie()
+        if cookie == self._cookie:
+            return
+        packages = self._load()
+        by_spec: dict[str, list[InstalledPackage]] = {}
+        for pkg in packages:
+            evr = f"{pkg.version}-{pkg.release}"
+            specs = {
+                pkg.name,
+                f"{pkg.name}.{pkg.arch}",
+                f"{pkg.name}-{pkg.version}",
+                f"{pkg.name}-{evr}",
+                f"{pkg.name}-{evr}.{pkg.arch}",
+            }
+            if pkg.epoch and pkg.epoch != "0":
+                specs.add(f"{pkg.name}-{pkg.epoch}:{evr}")
+                specs.add(f"{pkg.name}-{pkg.epoch}:{evr}.{pkg.arch}")
+            for spec in specs:
+                by_spec.setdefault(spec, []).append(pkg)
+        self._packages = packages
+        self._by_spec = by_spec
+        self._cookie = cookie
+
+    def packages(self) -> list[InstalledPackage]:
+        with self._lock:
+            self._ensure_current()
+            return list(self._packages)
+
+    def find(self, spec: str) -> list[InstalledPackage]:
+        with self._lock:
+            self._ensure_current()
+            return list(self._by_spec.get(spec, []))
+
+    def is_installed(self, spec: str) -> bool:
+        return bool(self.find(spec))
+
+    def nevra(self, spec: str) -> str | None:
+        """What `rpm -q <spec>` would print, or None if it isn't installed."""
+        matches = self.find(spec)
+        if not matches:
+            return None
+        return "\n".join(sorted(pkg.nevra for pkg in matches))
+
+    def from_repo(self, repo_id: str) -> list[InstalledPackage]:
+        return [pkg for pkg in self.packages() if pkg.from_repo == repo_id]
+
+
+_installed_index = InstalledIndex()
+
+
+def get_installed_index() -> InstalledIndex:
+    return _installed_index
+
+
+def updatechecker(
+    retries: int = 3, delay: int = 5, session: UpdateSession | None = None
+) -> list[str]:
+    if session is None:
+        session = UpdateSession(retries=retries, delay=delay)
+    return session.upgrades()
 
 def _log_transaction_resolve_problems(transaction, logger: logging.Logger) -> None:
     for problem in transaction.get_resolve_logs_as_strings():
@@ -279,23 +711,26 @@ def _transaction_has_errors(transaction, logger: logging.Logger) -> bool:
     return has_errors
 
 
+def _action_name(item) -> str:
+    return {
+        dnf5_trans.TransactionItemAction_INSTALL: "Installing",
+        dnf5_trans.TransactionItemAction_UPGRADE: "Upgrading",
+        dnf5_trans.TransactionItemAction_DOWNGRADE: "Downgrading",
+        dnf5_trans.TransactionItemAction_REINSTALL: "Reinstalling",
+        dnf5_trans.TransactionItemAction_REMOVE: "Removing",
+        dnf5_trans.TransactionItemAction_REPLACED: "Replacing",
+    }.get(item.get_action(), "Processing")
+
+
 def _log_transaction_packages(transaction, logger: logging.Logger) -> None:
     packages = transaction.get_transaction_packages()
     total = transaction.get_transaction_packages_count()
     logger.info("Transaction contains %s packages.", total)
 
     for index, item in enumerate(packages, start=1):
-        package = item.get_package()
-        action = {
-            dnf5_trans.TransactionItemAction_INSTALL: "Installing",
-            dnf5_trans.TransactionItemAction_UPGRADE: "Upgrading",
-            dnf5_trans.TransactionItemAction_DOWNGRADE: "Downgrading",
-            dnf5_trans.TransactionItemAction_REINSTALL: "Reinstalling",
-            dnf5_trans.TransactionItemAction_REMOVE: "Removing",
-            dnf5_trans.TransactionItemAction_REPLACED: "Replacing",
-        }.get(item.get_action(), "Processing")
-
-        logger.info("    (%s/%s) %s %s", index, total, action, package.get_nevra())
+        logger.info(
+            "    (%s/%s) %s %s", index, total, _action_name(item), item.get_package().get_nevra()
+        )
 
 
 def _format_nevra(nevra) -> str:
@@ -314,6 +749,17 @@ def _format_nevra(nevra) -> str:
     return f"{name}-{version}-{release}.{arch}"
 
 
+def _set_history_info(transaction, description: str) -> None:
+    """What `dnf history` shows for a transaction we run ourselves: a
+    command line, and the user who started the updater instead of root."""
+    transaction.set_description(description)
+    for variable in ("ORIG_USER", "PKEXEC_UID", "SUDO_UID"):
+        value = os.environ.get(variable, "")
+        if value.isdigit():
+            transaction.set_user_id(int(value))
+            break
+
+
 class _UpgradeTransactionCallbacks(dnf5_rpm.TransactionCallbacks):
     """Heartbeat logging for transaction.run().
 
@@ -324,34 +770,43 @@ class _UpgradeTransactionCallbacks(dnf5_rpm.TransactionCallbacks):
     exactly what has led users to kill an apparently-frozen upgrade
     mid-transaction, which can leave the system with thousands of
     duplicate/orphaned packages that a re-run cannot repair.
+
+    rpm calls back many times per element, so the calls go through a
+    TransactionProgress that logs a few summary lines per second; the
+    per-package lines only reach the log file.
     """
 
-    def __init__(self, logger: logging.Logger, total_packages: int) -> None:
+    def __init__(self, logger: logging.Logger, transaction) -> None:
         super().__init__()
         self.logger = logger
-        self.total_packages = total_packages
+        self.total_packages = transaction.get_transaction_packages_count()
+        total_bytes = 0
+        for package in _inbound_packages(transaction):
+            try:
+                total_bytes += package.get_install_size()
+            except (AttributeError, RuntimeError):
+                pass
+        self.progress = TransactionProgress(logger, self.total_packages, total_bytes)
 
     def transaction_start(self, total: int) -> None:
         self.logger.info("Preparing transaction (%s items)...", total)
 
+    def install_progress(self, item, amount: int, total: int) -> None:
+        self.progress.item_bytes(amount)
+
+    def transaction_stop(self, total: int) -> None:
+        self.progress.finish()
+
     def elem_progress(self, item, amount: int, total: int) -> None:
-        action = {
-            dnf5_trans.TransactionItemAction_INSTALL: "Installing",
-            dnf5_trans.TransactionItemAction_UPGRADE: "Upgrading",
-            dnf5_trans.TransactionItemAction_DOWNGRADE: "Downgrading",
-            dnf5_trans.TransactionItemAction_REINSTALL: "Reinstalling",
-            dnf5_trans.TransactionItemAction_REMOVE: "Removing",
-            dnf5_trans.TransactionItemAction_REPLACED: "Replacing",
-        }.get(item.get_action(), "Processing")
-        self.logger.info(
-            "    (%s/%s) %s %s", amount + 1, total, action, item.get_package().get_nevra()
-        )
+        self.progress.total_items = max(total, 1)
+        self.progress.start_item(amount, f"{_action_name(item)} {item.get_package().get_nevra()}")
 
     def script_start(self, item, nevra, type) -> None:
         self.logger.info(
             "    Running %s scriptlet for %s...",
             self.script_type_to_string(type),
             _format_nevra(nevra),
+            extra=DETAIL,
         )
 
     def script_error(self, item, nevra, type, return_code: int) -> None:
@@ -360,33 +815,203 @@ class _UpgradeTransactionCallbacks(dnf5_rpm.TransactionCallbacks):
         )
 
 
-def run_system_upgrade_transaction(logger: logging.Logger | None = None) -> bool:
-    tx_logger = logger if logger is not None else logging.getLogger()
-    base = dnf5_base.Base()
+_INBOUND_ACTIONS = (
+    dnf5_trans.TransactionItemAction_INSTALL,
+    dnf5_trans.TransactionItemAction_UPGRADE,
+    dnf5_trans.TransactionItemAction_DOWNGRADE,
+    dnf5_trans.TransactionItemAction_REINSTALL,
+)
+
 
+def _inbound_packages(transaction) -> list:
+    return [
+        item.get_package()
+        for item in transaction.get_transaction_packages()
+        if item.get_action() in _INBOUND_ACTIONS
+    ]
+
+
+def _package_cached(package) -> bool:
+    """Whether the package file is already in the cache, complete and with
+    the checksum the metadata promises."""
+    path = package.get_package_path()
     try:
-        config = base.get_config()
-        config.get_metadata_expire_option().from_string("0")
-        config.get_obsoletes_option().from_string("true")
+        if os.path.getsize(path) != package.get_download_size():
+            return False
+        checksum = package.get_checksum()
+        digest = hashlib.new(checksum.get_type_str())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest() == checksum.get_checksum()
+    except (OSError, ValueError, RuntimeError):
+        return False
 
-        base.load_config()
-        base.setup()
 
-        sack = base.get_repo_sack()
-        sack.create_repos_from_system_configuration()
-        sack.load_repos()
+class DownloadMonitor(dnf5_repo.DownloadCallbacks):
+    """Bytes and rates of a package download, per repo and in total.
 
-        goal = dnf5_base.Goal(base)
-        goal.add_upgrade("*")
+    add_new_download() hands every download a number, which libdnf5
+    passes back as user_cb_data with each progress report. Mirrors are
+    only reported by libdnf5 when they fail, so that is what is counted
+    per mirror.
+    """
 
+    def __init__(self, logger: logging.Logger, repo_of: dict[str, str]) -> None:
+        super().__init__()
+        self.logger = logger
+        self.repo_of = repo_of
+        self.started = time.monotonic()
+        self._downloads: dict[int, dict[str, Any]] = {}
+        self.repo_bytes: dict[str, float] = {}
+        self.repo_started: dict[str, float] = {}
+        self.repo_finished: dict[str, float] = {}
+        self.mirror_failures: dict[str, int] = {}
+        self.errors = 0
+
+    def _download(self, user_cb_data) -> dict[str, Any] | None:
+        # Comes back as the number or as a pointer wrapper holding it.
         try:
-            install_only_names = config.installonlypkgs
-        except AttributeError:
-            install_only_names = []
+            return self._downloads.get(int(user_cb_data))
+        except (TypeError, ValueError):
+            return None
 
-        _add_resolvable_installonly_upgrades(base, goal, install_only_names)
+    def add_new_download(self, user_data, description, total_to_download):
+        repo_id = self.repo_of.get(description, "unknown")
+        now = time.monotonic()
+        self.repo_started.setdefault(repo_id, now)
+        # Starts at 1, 0 would come back as a null pointer.
+        download_id = len(self._downloads) + 1
+        self._downloads[download_id] = {"repo": repo_id, "downloaded": 0.0}
+        return download_id
+
+    def progress(self, user_cb_data, total_to_download, downloaded):
+        download = self._download(user_cb_data)
+        if download is not None and downloaded > download["downloaded"]:
+            repo_id = download["repo"]
+            self.repo_bytes[repo_id] = self.repo_bytes.get(repo_id, 0.0) + downloaded - download["downloaded"]
+            self.repo_finished[repo_id] = time.monotonic()
+            download["downloaded"] = downloaded
+        return 0
+
+    def end(self, user_cb_data, status, msg):
+        if status == dnf5_repo.DownloadCallbacks.TransferStatus_ERROR:
+            self.errors += 1
+            if msg:
+                self.logger.warning("Download failed: %s", msg)
+        return 0
+
+    def mirror_failure(self, user_cb_data, msg, url, metadata):
+        self.mirror_failures[url] = self.mirror_failures.get(url, 0) + 1
+        self.logger.warning("Mirror failure: %s: %s", url, msg)
+        return 0
+
+    @property
+    def total_bytes(self) -> float:
+        return sum(self.repo_bytes.values())
+
+    def report(self, parallel: int | None) -> None:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        total = self.total_bytes
+        if total <= 0:
+            return
+        self.logger.info(
+            "Downloaded %.1f MB in %.1f s (%.2f MB/s, %s parallel downloads).",
+            total / 1_000_000, elapsed, total / elapsed / 1_000_000, parallel or "default",
+        )
+        for repo_id, repo_bytes in sorted(self.repo_bytes.items()):
+            repo_elapsed = max(
+                self.repo_finished.get(repo_id, self.started) - self.repo_started.get(repo_id, self.started),
+                1e-6,
+            )
+            self.logger.info(
+                "    %s: %.1f MB, %.2f MB/s", repo_id, repo_bytes / 1_000_000,
+                repo_bytes / repo_elapsed / 1_000_000,
+            )
+        for url, failures in sorted(self.mirror_failures.items()):
+            self.logger.info("    mirror %s failed %s time(s)", url, failures)
 
-        transaction = goal.resolve()
+        if parallel:
+            record_download_sample(parallel, total, elapsed)
+
+
+def _monitor_downloads(session: UpdateSession, packages: list, logger: logging.Logger) -> DownloadMonitor:
+    monitor = DownloadMonitor(
+        logger,
+        {package.get_full_nevra(): package.get_repo_id() for package in packages},
+    )
+    session.base.set_download_callbacks(dnf5_repo.DownloadCallbacksUniquePtr(monitor))
+    # The base keeps calling the Python director after the download, same
+    # as the transaction callbacks below it has to outlive the call.
+    session.download_monitor = monitor
+    return monitor
+
+
+def _max_parallel_downloads(base) -> int | None:
+    try:
+        return int(base.get_config().get_max_parallel_downloads_option().get_value())
+    except (OptionValueNotSetError, RuntimeError, ValueError):
+        return None
+
+
+def _download_packages(session: UpdateSession, transaction, logger: logging.Logger) -> None:
+    base = session.base
+    packages = _inbound_packages(transaction)
+    if packages and all(_package_cached(package) for package in packages):
+        logger.info("All %s packages were already downloaded and verified.", len(packages))
+        return
+    logger.info("Downloading packages...")
+    monitor = _monitor_downloads(session, packages, logger)
+    transaction.download()
+    monitor.report(_max_parallel_downloads(base))
+
+
+def prefetch_system_upgrade(
+    logger: logging.Logger | None = None,
+    session: UpdateSession | None = None,
+) -> int:
+    """Download the packages of the pending upgrade into the dnf cache.
+
+    Nothing is installed. When the upgrade is run later, the packages are
+    found in the cache, verified and not downloaded again. Bandwidth and
+    parallelism come from the session's download profile. Returns the
+    number of packages that had to be downloaded.
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    if session is None:
+        session = UpdateSession(logger)
+
+    transaction = session.upgrade_transaction()
+    missing = [
+        package for package in _inbound_packages(transaction)
+        if not _package_cached(package)
+    ]
+    if not missing:
+        logger.info("Nothing to prefetch.")
+        return 0
+
+    base = session.base
+    logger.info("Prefetching %s packages...", len(missing))
+    monitor = _monitor_downloads(session, missing, logger)
+    downloader = dnf5_repo.PackageDownloader(base)
+    for package in missing:
+        downloader.add(package)
+    downloader.download()
+    monitor.report(_max_parallel_downloads(base))
+    logger.info("Prefetch complete.")
+    return len(missing)
+
+
+def run_system_upgrade_transaction(
+    logger: logging.Logger | None = None, session: UpdateSession | None = None
+) -> bool:
+    tx_logger = logger if logger is not None else logging.getLogger()
+    if session is None:
+        session = UpdateSession(tx_logger)
+    ran_transaction = False
+
+    try:
+        transaction = session.upgrade_transaction()
         _log_transaction_resolve_problems(transaction, tx_logger)
 
         if transaction.get_conflicting_packages():
@@ -400,20 +1025,21 @@ def run_system_upgrade_transaction(logger: logging.Logger | None = None) -> bool
             return True
 
         _log_transaction_packages(transaction, tx_logger)
+        if session.kernel_retention:
+            tx_logger.info(session.kernel_retention)
 
-        tx_logger.info("Downloading packages...")
-        transaction.download()
+        _download_packages(session, transaction, tx_logger)
 
         tx_logger.info("Running transaction...")
+        _set_history_info(transaction, "nobara-sync upgrade")
         # Keep the Python SWIG director alive until transaction.run() returns.
         # Passing it to TransactionCallbacksUniquePtr inline leaves only the
         # C++ object alive, so the first callback dispatch aborts with a
         # Swig::DirectorMethodException.
-        callbacks = _UpgradeTransactionCallbacks(
-            tx_logger, transaction.get_transaction_packages_count()
-        )
+        callbacks = _UpgradeTransactionCallbacks(tx_logger, transaction)
         callbacks_ptr = dnf5_rpm.TransactionCallbacksUniquePtr(callbacks)
         transaction.set_callbacks(callbacks_ptr)
+        ran_transaction = True
         result = transaction.run()
         if (
             result != dnf5_base.Transaction.TransactionRunResult_SUCCESS
@@ -427,6 +1053,9 @@ def run_system_upgrade_transaction(logger: logging.Logger | None = None) -> bool
                 tx_logger.error(problem)
             return False
 
+        # The kernel this ran on booted fine, the retention policy keeps
+        # it around as the known-good fallback.
+        record_booted_kernel()
         tx_logger.info("DNF System Updates complete!")
         return True
 
@@ -434,66 +1063,226 @@ def run_system_upgrade_transaction(logger: logging.Logger | None = None) -> bool
         tx_logger.error("DNF transaction failed: %s", e)
         return False
     finally:
-        del base
+        # A transaction object can only be run once, and whatever it did
+        # to the rpmdb makes the resolved upgrade set stale.
+        if ran_transaction:
+            session.invalidate()
+
+
+def _run_goal(
+    session: "UpdateSession",
+    logger: logging.Logger,
+    steps: list[tuple[str, list[str]]],
+    description: str,
+    on_package: Callable[[str, str], Any] | None = None,
+) -> bool | None:
+    """Resolve and run one transaction for (action, targets) steps.
+
+    on_package is called with (action, nevra) for every package of the
+    resolved transaction. Returns None when nothing was handed to rpm yet,
+    so the caller can still fall back to the dnf5 command.
+    """
+    # dnf5 remove shrugs at packages that aren't installed, a Goal reports
+    # them as a problem.
+    installed = get_installed_index()
+    steps = [
+        (
+            action,
+            [
+                target for target in targets
+                if action != "remove"
+                or any(char in target for char in "*?[")
+                or installed.is_installed(target)
+            ],
+        )
+        for action, targets in steps
+    ]
+    if not any(targets for _, targets in steps):
+        logger.info("Nothing to do.")
+        return True
+
+    ran_transaction = False
+    try:
+        goal = dnf5_base.Goal(session.base)
+        for action, targets in steps:
+            for target in targets:
+                if action == "install":
+                    goal.add_install(target)
+                elif action == "remove":
+                    goal.add_remove(target)
+                else:
+                    goal.add_upgrade(target)
+
+        transaction = goal.resolve()
+        _log_transaction_resolve_problems(transaction, logger)
+        if transaction.get_problems() != dnf5_base.GoalProblem_NO_PROBLEM:
+            return None
+
+        if transaction.empty():
+            logger.info("Nothing to do.")
+            return True
+
+        _log_transaction_packages(transaction, logger)
+        if on_package is not None:
+            for item in transaction.get_transaction_packages():
+                on_package(_action_name(item), item.get_package().get_nevra())
+
+        _download_packages(session, transaction, logger)
+
+        if not transaction.check_gpg_signatures():
+            for problem in transaction.get_gpg_signature_problems():
+                logger.warning(problem)
+            return None
+
+        logger.info("Running transaction...")
+        _set_history_info(transaction, description)
+        # Keep the SWIG director alive until run() returns, see
+        # run_system_upgrade_transaction().
+        callbacks = _UpgradeTransactionCallbacks(logger, transaction)
+        callbacks_ptr = dnf5_rpm.TransactionCallbacksUniquePtr(callbacks)
+        transaction.set_callbacks(callbacks_ptr)
+        ran_transaction = True
+        result = transaction.run()
+    except Exception as e:
+        logger.error("DNF transaction failed: %s", e)
+        return False if ran_transaction else None
+    finally:
+        if ran_transaction:
+            session.invalidate()
+
+    if (
+        result != dnf5_base.Transaction.TransactionRunResult_SUCCESS
+        or _transaction_has_errors(transaction, logger)
+    ):
+        logger.error("==================================================")
+        logger.error(
+            "ERROR: DNF transaction failed: %s",
+            dnf5_base.Transaction.transaction_result_to_string(result),
+        )
+        for problem in transaction.get_transaction_problems():
+            logger.error(problem)
+        logger.error("ERROR: Please see ~/.local/share/nobara-updater/nobara-sync.log for more details")
+        logger.error("ERROR: You can press the 'Open Log File' button on the Update System app to view it.")
+        logger.error("==================================================")
+        return False
+
+    logger.info("DNF System Updates complete!")
+    return True
+
+
+# Events an updater keeps around for late readers, older ones are dropped.
+EVENT_QUEUE_SIZE = 1000
+
+_CONFLICT_NEEDLES = (
+    "Problem ",
+    "Skipping packages with conflicts",
+    "Skipping packages with broken dependencies",
+    "conflicts",
+    "broken dependencies",
+    "cannot install",
+    "Transaction check error",
+    "Error:",
+)
+# dnf5 transaction progress, e.g. "[ 3/10] Upgrading foo-1.0-1.fc42.x86_64".
+_DNF_PACKAGE_LINE = re.compile(
+    r"^\[\s*\d+/\d+\]\s+(Installing|Upgrading|Downgrading|Reinstalling|Removing)\s+(\S+)"
+)
+
+
+def _is_dependency_conflict(line: str) -> bool:
+    return any(needle in line for needle in _CONFLICT_NEEDLES)
+
+
+class UpdaterEvent(NamedTuple):
+    # "started", "line", "package", "conflict" or "finished"
+    kind: str
+    data: Any = None
+
+
+class _EventHandler(logging.Handler):
+    """Turns the log records of a PackageUpdater run into "line" events."""
+
+    def __init__(self, emit_event: Callable[[str, Any], None]) -> None:
+        super().__init__(logging.INFO)
+        self.emit_event = emit_event
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.emit_event("line", record.getMessage())
 
 
 class PackageUpdater:
+    """Install, remove or upgrade packages, reporting as it goes.
+
+    What happens is published as UpdaterEvents: on the bounded `events`
+    queue, which nobody has to drain, and to `on_event` if given. The log
+    handler feeding the "line" events is only attached for the run.
+    """
+
     def __init__(
         self,
         package_names: list[str],
         action: str,
-        liststore: Gtk.ListStore,
+        liststore: "Gtk.ListStore",
         logger: logging.Logger | None = None,
+        session: UpdateSession | None = None,
+        on_event: Callable[[UpdaterEvent], Any] | None = None,
     ):
         self.package_names = package_names
         self.liststore = liststore
-        self.log_queue: queue.Queue[str] = queue.Queue()
-        self.queue_handler = QueueHandler(self.log_queue)
+        self.session = session
+        self.on_event = on_event
+        self.events: queue.Queue[UpdaterEvent] = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
         self.logger = logger if logger is not None else logging.getLogger()
-        self.logger.addHandler(self.queue_handler)
         self.logger.setLevel(logging.INFO)
-        # Right now update_packages doesn't provide sufficient logging.
-        # It also doesn't correctly log in the dnf history
-        # Use DNF command for now
-        #self.update_packages(action)
-        self.success = self.update_packages_dnf_command(action)
-
-
-    def update_packages_dnf_command(self, action: str, retries: int = 3, delay: int = 5) -> bool:
-        def _looks_like_dependency_conflict(lines: List[str]) -> bool:
-            needles = (
-                "Problem ",
-                "Skipping packages with conflicts",
-                "Skipping packages with broken dependencies",
-                "conflicts",
-                "broken dependencies",
-                "cannot install",
-                "Transaction check error",
-                "Error:",
-            )
-            return any(any(n in line for n in needles) for line in lines)
-
-        if not self.package_names:
-            raise ValueError("No package names provided")
+        handler = _EventHandler(self._emit)
+        self.logger.addHandler(handler)
+        try:
+            self._emit("started", {"action": action, "packages": list(package_names)})
+            # Run in-process on the session's sack. The dnf5 command is only
+            # the fallback for what libdnf5 can't finish here on its own,
+            # like importing a new GPG key or explaining an unresolvable
+            # request.
+            success = self.update_packages(action)
+            if success is None:
+                self.logger.info("Falling back to the dnf5 command...")
+                success = self.update_packages_dnf_command(action)
+        finally:
+            self.logger.removeHandler(handler)
+        self.success = success
+        self._emit("finished", success)
 
-        action_map = {"upgrade": "update", "install": "install", "remove": "remove"}
-        if action not in action_map:
-            raise ValueError(f"Invalid action: {action!r}")
-            
+    def _emit(self, kind: str, data: Any = None) -> None:
+        event = UpdaterEvent(kind, data)
+        while True:
+            try:
+                self.events.put_nowait(event)
+                break
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _targets(self, action: str) -> list[str]:
         installed_set = set()
         try:
-            temp_base = dnf5_base.Base()
-            temp_base.load_config()
-            temp_base.setup()
-            sack = temp_base.get_repo_sack()
-            sack.create_repos_from_system_configuration()
-            sack.load_repos() 
-            installed_query = dnf5_rpm.PackageQuery(temp_base)
-            installed_query.filter_installed()
-            installed_set = {pkg.get_name() for pkg in installed_query}
-            del installed_query
-            del sack
-            del temp_base
+            if self.session is not None:
+                installed_set = self.session.installed_names()
+            else:
+                temp_base = dnf5_base.Base()
+                temp_base.load_config()
+                temp_base.setup()
+                sack = temp_base.get_repo_sack()
+                sack.create_repos_from_system_configuration()
+                sack.load_repos()
+                installed_query = dnf5_rpm.PackageQuery(temp_base)
+                installed_query.filter_installed()
+                installed_set = {pkg.get_name() for pkg in installed_query}
+                del installed_query
+                del sack
+                del temp_base
         except Exception as e:
             self.logger.warning("Could not pre-filter installed packages: %s", e)
         if action == "upgrade":
@@ -502,14 +1291,59 @@ class PackageUpdater:
                 targets = self.package_names
         else:
             targets = self.package_names
+        return targets
+
+    def update_packages(self, action: str) -> bool | None:
+        """Install, remove or upgrade the packages with libdnf5 directly.
+
+        Spawning `dnf5` for every quirk meant a new process, a metadata
+        refresh and a fresh sack load each time. This resolves a Goal on
+        the session's already loaded Base, reports progress through the
+        same callbacks as the system upgrade and records the transaction
+        in the dnf history. Returns None when nothing was handed to rpm
+        yet and the dnf5 command should have a go instead.
+        """
+        if not self.package_names:
+            raise ValueError("No package names provided")
+        if action not in ("upgrade", "install", "remove"):
+            raise ValueError(f"Invalid action: {action!r}")
 
+        if self.session is None:
+            self.session = UpdateSession(self.logger)
+        session = self.session
+        targets = self._targets(action)
         action_log_string = {
             "upgrade": "Upgrading packages:",
             "install": "Installing packages:",
             "remove": "Removing packages:",
         }[action]
+        self.logger.info("%s\n%s", action_log_string, "\n".join(self.package_names))
 
-        cmd = ["dnf5", action_map[action], "--refresh", "-y", *targets]
+        return _run_goal(
+            session,
+            self.logger,
+            [(action, targets)],
+            f"nobara-sync {action} {' '.join(targets)}",
+            on_package=lambda package_action, nevra: self._emit("package", (package_action, nevra)),
+        )
+
+    def update_packages_dnf_command(self, action: str, retries: int = 3, delay: int = 5) -> bool:
+        if not self.package_names:
+            raise ValueError("No package names provided")
+
+        action_map = {"upgrade": "update", "install": "install", "remove": "remove"}
+        if action not in action_map:
+            raise ValueError(f"Invalid action: {action!r}")
+
+        targets = self._targets(action)
+
+        action_log_string = {
+            "upgrade": "Upgrading packages:",
+            "install": "Installing packages:",
+            "remove": "Removing packages:",
+        }[action]
+
+        cmd = ["dnf5", action_map[action], *refresh_args(), "-y", *targets]
 
         self.logger.info("%s\n%s", action_log_string, "\n".join(self.package_names))
 
@@ -525,17 +1359,23 @@ class PackageUpdater:
                     bufsize=1,
                 )
 
-                output_lines: List[str] = []
+                # Classified while it streams, the output isn't kept around.
+                conflict = False
                 assert process.stdout is not None
                 for raw in process.stdout:
                     line = raw.rstrip("\n")
-                    output_lines.append(line)
                     self.logger.info(line)
+                    if _is_dependency_conflict(line):
+                        conflict = True
+                        self._emit("conflict", line)
+                    match = _DNF_PACKAGE_LINE.match(line)
+                    if match:
+                        self._emit("package", match.groups())
 
                 rc = process.wait()
 
                 # Treat "conflict-style" output as failure even if rc == 0 (your example case)
-                if _looks_like_dependency_conflict(output_lines):
+                if conflict:
                     self.logger.error("==================================================")
                     self.logger.error("ERROR: DNF Package update are incomplete or failed due to conflicts/broken dependencies.")
                     self.logger.error("ERROR: Please see ~/.local/share/nobara-updater/nobara-sync.log for more details")
@@ -562,3 +1402,137 @@ class PackageUpdater:
                     return False
 
         return False
+
+
+class TransactionPlan:
+    """Package changes of several fixups, applied as one transaction.
+
+    Every fixup used to run its own transaction, each one taking the rpm
+    lock and resolving again, so a full fixup pass ran more than ten of
+    them. Fixups now only say what they want and commit() does it all at
+    once: every `rpm -e --nodeps` erasure in a single rpm call, then all
+    removals and installs in a single resolved Goal. A step that only makes
+    sense after an earlier one (installing something that is about to be
+    removed, erasing something that is about to be installed) commits what
+    is pending first, and so should any caller that needs the result right
+    away, e.g. to run a command the package provides.
+    """
+
+    def __init__(
+        self, logger: logging.Logger | None = None, session: UpdateSession | None = None
+    ) -> None:
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.session = session
+        self._erasures: list[str] = []
+        self._removals: list[str] = []
+        self._installs: list[str] = []
+        self._after: list[Callable[[], Any]] = []
+
+    @staticmethod
+    def _names(specs: list[str]) -> set[str]:
+        return {
+            spec.rsplit(".", 1)[0] if spec.endswith((".x86_64", ".i686", ".noarch")) else spec
+            for spec in specs
+        }
+
+    def _overlaps(self, specs: list[str], pending: list[str]) -> bool:
+        return bool(self._names(specs) & self._names(pending))
+
+    def removes(self, spec: str) -> bool:
+        """Whether spec is going away with the pending changes."""
+        return self._overlaps([spec], self._removals + self._erasures)
+
+    def empty(self) -> bool:
+        return not (self._erasures or self._removals or self._installs or self._after)
+
+    def touches(self, *needles: str) -> bool:
+        """Whether a pending change names a package containing one of
+        needles, or any pending change at all without needles."""
+        pending = self._erasures + self._removals + self._installs
+        if not needles:
+            return bool(pending)
+        return any(needle in spec for spec in pending for needle in needles)
+
+    def install(self, specs: list[str]) -> None:
+        if self._overlaps(specs, self._removals):
+            self.commit()
+        self._installs.extend(spec for spec in specs if spec not in self._installs)
+
+    def remove(self, specs: list[str]) -> None:
+        if self._overlaps(specs, self._installs):
+            self.commit()
+        self._removals.extend(spec for spec in specs if spec not in self._removals)
+
+    def swap(self, old: list[str], new: list[str]) -> None:
+        self.remove(old)
+        self.install(new)
+
+    def erase_nodeps(self, specs: list[str]) -> None:
+        """`rpm -e --nodeps`, done before the Goal of the same commit."""
+        if self._overlaps(specs, self._installs):
+            self.commit()
+        self._erasures.extend(spec for spec in specs if spec not in self._erasures)
+
+    def after(self, callback: Callable[[], Any]) -> None:
+        """Run callback once the pending changes are committed, skipped if
+        committing them fails."""
+        self._after.append(callback)
+
+    def commit(self) -> bool:
+        erasures, removals, installs, after = (
+            self._erasures, self._removals, self._installs, self._after
+        )
+        self._erasures, self._removals, self._installs, self._after = [], [], [], []
+        success = True
+
+        if erasures:
+            installed = get_installed_index()
+            present = [spec for spec in erasures if installed.is_installed(spec)]
+            if present:
+                self.logger.info("Removing without dependency checks:\n%s", "\n".join(present))
+                result = subprocess.run(
+                    ["rpm", "-e", "--nodeps", *present],
+                    capture_output=True,
+                    text=True,
+                    encoding="utf-8",
+                    errors="replace",
+                )
+                if result.returncode != 0:
+                    self.logger.error(result.stderr.strip())
+                    success = False
+
+        steps = []
+        if removals:
+            steps.append(("remove", removals))
+        if installs:
+            steps.append(("install", installs))
+        if steps:
+            if self.session is None:
+                self.session = UpdateSession(self.logger)
+            for action, targets in steps:
+                self.logger.info(
+                    "%s\n%s",
+                    "Removing packages:" if action == "remove" else "Installing packages:",
+                    "\n".join(targets),
+                )
+            result = _run_goal(self.session, self.logger, steps, "nobara-sync fixups")
+            if result is None:
+                # Something in the batch doesn't resolve. Go step by step like
+                # before, so one bad package can't hold back all the others.
+                result = True
+                for action, targets in steps:
+                    updater = PackageUpdater(targets, action, None, session=self.session)
+                    result = updater.success and result
+            success = success and bool(result)
+
+        if not success:
+            # e.g. enabling a service or switching the display manager to
+            # packages that never got installed.
+            if after:
+                self.logger.warning(
+                    "Skipping %s follow-up step(s), the package changes failed.", len(after)
+                )
+            return False
+        for callback in after:
+            callback()
+        return True
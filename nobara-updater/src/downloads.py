@@ -0,0 +1,178 @@
+import logging
+import time
+from typing import Any, NamedTuple
+
+from nobara_updater.cache import load_json, save_json
+from nobara_updater.progress import DETAIL, TransactionProgress
+
+# Nothing here imports libdnf5, nobara-sync needs the profiles before it
+# knows whether it will load it. DownloadMonitor lives in dnf.py.
+STATS_FILE = "download-stats.json"
+# Runs that moved less than this say nothing about the link.
+MIN_SAMPLE_BYTES = 8 * 1024 * 1024
+HISTORY_LENGTH = 10
+
+DEFAULT_PARALLEL_DOWNLOADS = 3
+MAX_PARALLEL_DOWNLOADS = 20  # libdnf5 refuses anything above this
+AUTOTUNE_STEP = 2
+BACKGROUND_PARALLEL_DOWNLOADS = 2
+BACKGROUND_THROTTLE = "1M"
+
+DOWNLOAD_PROFILES = ("auto", "max", "background")
+
+
+class DownloadProfile(NamedTuple):
+    name: str
+    max_parallel_downloads: int | None = None
+    # Same format as the dnf throttle option, e.g. "2M" or "50%".
+    throttle: str | None = None
+    # Background runs also drop to idle CPU/IO priority.
+    idle: bool = False
+
+
+def _history() -> list[dict[str, Any]]:
+    stats = load_json(STATS_FILE)
+    if not isinstance(stats, dict) or not isinstance(stats.get("history"), list):
+        return []
+    return [
+        sample for sample in stats["history"]
+        if isinstance(sample, dict) and "parallel" in sample and "bytes_per_second" in sample
+    ]
+
+
+def record_download_sample(parallel: int, total_bytes: float, elapsed: float) -> None:
+    if total_bytes < MIN_SAMPLE_BYTES or not parallel:
+        return
+    history = _history()
+    history.append({
+        "time": time.time(),
+        "parallel": parallel,
+        "bytes_per_second": total_bytes / elapsed,
+    })
+    save_json(STATS_FILE, {"history": history[-HISTORY_LENGTH:]})
+
+
+def autotuned_parallel_downloads() -> int:
+    """Pick max_parallel_downloads from the throughput of earlier runs.
+
+    A simple hill climb: as long as the latest run was the fastest one
+    seen, try a bit more parallelism next time, otherwise go back to
+    whatever was fastest.
+    """
+    history = _history()
+    if not history:
+        return DEFAULT_PARALLEL_DOWNLOADS
+    best = max(history, key=lambda sample: sample["bytes_per_second"])
+    parallel = int(best["parallel"])
+    if best is history[-1]:
+        parallel += AUTOTUNE_STEP
+    return max(1, min(parallel, MAX_PARALLEL_DOWNLOADS))
+
+
+def resolve_download_profile(name: str | None, throttle: str | None = None) -> DownloadProfile | None:
+    if name is None and throttle is None:
+        return None
+    if name == "max":
+        return DownloadProfile("max", MAX_PARALLEL_DOWNLOADS, throttle)
+    if name == "background":
+        return DownloadProfile(
+            "background", BACKGROUND_PARALLEL_DOWNLOADS, throttle or BACKGROUND_THROTTLE, idle=True
+        )
+    if name == "auto":
+        return DownloadProfile("auto", autotuned_parallel_downloads(), throttle)
+    return DownloadProfile("custom", None, throttle)
+
+
+def apply_download_profile(base, profile: DownloadProfile | None) -> None:
+    """Set the profile on the main config, before the repos are created so
+    they inherit it."""
+    if profile is None:
+        return
+    config = base.get_config()
+    if profile.max_parallel_downloads is not None:
+        config.get_max_parallel_downloads_option().from_string(str(profile.max_parallel_downloads))
+    if profile.throttle:
+        config.get_throttle_option().from_string(profile.throttle)
+
+
+class FlatpakTransferMonitor:
+    """Bytes, rates and timings of a Flatpak transaction, per ref and per
+    remote, with coalesced progress lines and an ETA while it runs.
+
+    libflatpak has no bandwidth or parallelism settings, so a download
+    profile only reaches Flatpak through the process priority.
+    """
+
+    # Slowest refs listed in the summary, the rest go to the log file.
+    SLOWEST_REFS = 5
+
+    def __init__(self, logger: logging.Logger, transaction, label: str = "system") -> None:
+        self.logger = logger
+        self.label = label
+        self.started = time.monotonic()
+        self.remote_bytes: dict[str, int] = {}
+        # ref -> (bytes, seconds)
+        self.ref_timings: dict[str, tuple[int, float]] = {}
+        self.progress: TransactionProgress | None = None
+        # (remote, ref) -> (progress, start time). PyGObject may hand out a
+        # different wrapper for the same operation, so not by id().
+        self._operations: dict[tuple[str, str], tuple[Any, float]] = {}
+        self._index = 0
+        transaction.connect("ready", self._ready)
+        transaction.connect("new-operation", self._new_operation)
+        transaction.connect("operation-done", self._operation_done)
+
+    def _ready(self, transaction) -> bool:
+        operations = transaction.get_operations()
+        total_bytes = 0
+        for operation in operations:
+            try:
+                total_bytes += operation.get_download_size()
+            except AttributeError:
+                pass
+        self.progress = TransactionProgress(self.logger, len(operations), total_bytes)
+        return True
+
+    def _new_operation(self, transaction, operation, progress) -> None:
+        ref = operation.get_ref()
+        self._operations[(operation.get_remote(), ref)] = (progress, time.monotonic())
+        if self.progress is not None:
+            self.progress.start_item(self._index, f"Flatpak ({self.label}) {ref}")
+            progress.set_update_frequency(500)
+            progress.connect("changed", lambda p: self.progress.item_bytes(p.get_bytes_transferred()))
+        self._index += 1
+
+    def _operation_done(self, transaction, operation, commit, result) -> None:
+        remote, ref = operation.get_remote(), operation.get_ref()
+        entry = self._operations.pop((remote, ref), None)
+        if entry is None:
+            return
+        progress, started = entry
+        transferred = progress.get_bytes_transferred()
+        elapsed = time.monotonic() - started
+        self.remote_bytes[remote] = self.remote_bytes.get(remote, 0) + transferred
+        self.ref_timings[ref] = (transferred, elapsed)
+        self.logger.info(
+            "    %s: %.1f MB in %.1f s (%.2f MB/s)", ref, transferred / 1_000_000, elapsed,
+            transferred / max(elapsed, 1e-6) / 1_000_000, extra=DETAIL,
+        )
+
+    def report(self) -> None:
+        if self.progress is not None:
+            self.progress.finish()
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        total = sum(self.remote_bytes.values())
+        if total <= 0 and not self.ref_timings:
+            return
+        self.logger.info(
+            "Flatpak (%s) downloaded %.1f MB in %.1f s (%.2f MB/s).",
+            self.label, total / 1_000_000, elapsed, total / elapsed / 1_000_000,
+        )
+        for remote, remote_bytes in sorted(self.remote_bytes.items()):
+            self.logger.info("    %s: %.1f MB", remote, remote_bytes / 1_000_000)
+        slowest = sorted(self.ref_timings.items(), key=lambda item: item[1][1], reverse=True)
+        for ref, (ref_bytes, ref_elapsed) in slowest[:self.SLOWEST_REFS]:
+            self.logger.info(
+                "    %s took %.1f s (%.1f MB, %.2f MB/s)", ref, ref_elapsed, ref_bytes / 1_000_000,
+                ref_bytes / max(ref_elapsed, 1e-6) / 1_000_000,
+            )
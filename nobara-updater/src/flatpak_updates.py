@@ -0,0 +1,201 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import gi  # type: ignore[import]
+
+gi.require_version("Flatpak", "1.0")
+gi.require_version("GLib", "2.0")
+
+from gi.repository import Flatpak, GLib  # type: ignore[import]
+
+from nobara_updater.cache import CACHE_DIR, load_json, save_json
+
+RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 8.0
+
+
+def with_backoff(operation: Callable[[], Any], what: str, log: Callable[[str], Any]) -> Any:
+    """Run a libflatpak call, retrying GErrors a few times with growing
+    pauses instead of spinning on a remote that is down."""
+    delay = BACKOFF_BASE
+    for attempt in range(1, RETRIES + 1):
+        try:
+            return operation()
+        except GLib.GError as e:
+            # Expected, see #43
+            log(f"{what} failed (attempt {attempt}/{RETRIES}): {e}")
+            if attempt == RETRIES:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX)
+
+
+def _summary_digest(installation: Flatpak.Installation, remote_name: str) -> str | None:
+    # Where libflatpak keeps the summary it last fetched for a remote: the
+    # summary index on current flatpak, the plain summary on older ones.
+    summaries = Path(installation.get_path().get_path()) / "repo" / "tmp" / "cache" / "summaries"
+    for name in (f"{remote_name}.idx", remote_name):
+        try:
+            return hashlib.sha256((summaries / name).read_bytes()).hexdigest()
+        except OSError:
+            continue
+    return None
+
+
+def list_updates(
+    installation: Flatpak.Installation,
+    log: Callable[[str], Any],
+    cache_name: str,
+    cache_dir: Path = CACHE_DIR,
+) -> list[Flatpak.InstalledRef]:
+    """The installed refs that have an update, remote by remote.
+
+    Each remote's summary is fetched on its own, so a remote that is down
+    only loses its own updates. When a remote's summary and the installed
+    commits from it are the same as last time, its updates are taken from
+    the cache instead of listing them again; the full listing only runs
+    for remotes that changed.
+    """
+    installed = {ref.format_ref(): ref for ref in installation.list_installed_refs(None)}
+    origins: dict[str, list[str]] = {}
+    for name, ref in installed.items():
+        origins.setdefault(ref.get_origin(), []).append(name)
+    enabled = {remote.get_name() for remote in installation.list_remotes(None) if not remote.get_disabled()}
+
+    state = load_json(cache_name, cache_dir)
+    cached: dict[str, Any] = state.get("remotes", {}) if isinstance(state, dict) else {}
+    keys: dict[str, str] = {}
+    answered: dict[str, list[str]] = {}
+    stale: list[str] = []
+
+    for remote_name in sorted(origins):
+        if remote_name not in enabled:
+            continue
+        try:
+            with_backoff(
+                lambda: installation.update_remote_sync(remote_name, None),
+                f"Refreshing Flatpak remote {remote_name}",
+                log,
+            )
+        except GLib.GError:
+            log(f"Skipping updates from unreachable Flatpak remote {remote_name}.")
+            continue
+
+        digest = _summary_digest(installation, remote_name)
+        if digest is not None:
+            key = hashlib.sha256(digest.encode())
+            for name in sorted(origins[remote_name]):
+                key.update(f"{name}={installed[name].get_commit()}".encode())
+            keys[remote_name] = key.hexdigest()
+            entry = cached.get(remote_name)
+            if isinstance(entry, dict) and entry.get("key") == keys[remote_name]:
+                answered[remote_name] = entry.get("refs", [])
+                continue
+        stale.append(remote_name)
+
+    if stale:
+        listed: dict[str, list[str]] = {remote_name: [] for remote_name in stale}
+        complete = True
+        try:
+            updates = with_backoff(
+                lambda: installation.list_installed_refs_for_update(None),
+                "Listing Flatpak updates",
+                log,
+            )
+            for ref in updates:
+                if ref.get_origin() in listed:
+                    listed[ref.get_origin()].append(ref.format_ref())
+        except GLib.GError:
+            # A remote failing halfway can still sink the whole listing.
+            # Fall back to the latest commits the fetched summaries name,
+            # good enough for now but not worth caching.
+            complete = False
+            for remote_name in stale:
+                listed[remote_name] = [
+                    name for name in origins[remote_name]
+                    if installed[name].get_latest_commit()
+                    and installed[name].get_latest_commit() != installed[name].get_commit()
+                ]
+        for remote_name, names in listed.items():
+            answered[remote_name] = names
+            if complete and remote_name in keys:
+                cached[remote_name] = {"key": keys[remote_name], "refs": names}
+        save_json(cache_name, {"remotes": cached}, cache_dir)
+
+    return [
+        installed[name]
+        for remote_name in sorted(answered)
+        for name in answered[remote_name]
+        if name in installed
+    ]
+
+
+def _free_space(path: Path) -> int:
+    # Walking the installation to size it takes longer than the prune on
+    # big installs, the free space on its filesystem is one syscall.
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def maintain_installation(
+    installation: Flatpak.Installation,
+    log: Callable[[str], Any],
+    drop_pulled: bool = False,
+) -> dict[str, Any]:
+    """Uninstall refs nothing needs any more and prune the OSTree repo.
+
+    Unused refs are runtimes and extensions no installed app uses, like
+    the GL and Platform versions left behind by updates. drop_pulled also
+    removes refs that were pulled without being deployed (prefetches and
+    shared downloads); only do that once the updates are installed, or
+    the next install downloads them again. Returns what was removed, the
+    bytes reclaimed and the seconds it took.
+    """
+    started = time.monotonic()
+    root = Path(installation.get_path().get_path())
+    free_before = _free_space(root)
+    removed: list[str] = []
+
+    try:
+        unused = installation.list_unused_refs(None, None)
+    except (GLib.GError, AttributeError) as e:
+        log(f"Could not list unused Flatpak refs: {e}")
+        unused = []
+    if unused:
+        transaction = Flatpak.Transaction.new_for_installation(installation)
+        for ref in unused:
+            try:
+                transaction.add_uninstall(ref.format_ref())
+                removed.append(ref.format_ref())
+            except GLib.GError as e:
+                log(f"Not removing {ref.format_ref()}: {e}")
+        if removed:
+            log(f"Removing {len(removed)} unused Flatpak refs:\n" + "\n".join(removed))
+            try:
+                transaction.run()
+            except GLib.GError as e:
+                log(f"Removing unused Flatpak refs failed: {e}")
+                removed = []
+
+    if drop_pulled:
+        try:
+            installation.cleanup_local_refs_sync(None)
+        except GLib.GError as e:
+            log(f"Could not clean up undeployed Flatpak refs: {e}")
+    try:
+        installation.prune_local_repo(None)
+    except GLib.GError as e:
+        log(f"Pruning the Flatpak repo failed: {e}")
+
+    # Other writers on the filesystem make this approximate.
+    reclaimed = max(_free_space(root) - free_before, 0)
+    seconds = time.monotonic() - started
+    log(f"Flatpak maintenance of {root}: reclaimed {reclaimed / 1_000_000:.1f} MB in {seconds:.1f} s.")
+    return {"removed": removed, "reclaimed": reclaimed, "seconds": seconds}
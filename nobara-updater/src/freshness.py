@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import libdnf5.repo as dnf5_repo
+import requests
+from libdnf5.exception import OptionValueNotSetError
+
+from nobara_updater.cache import load_json, save_json
+
+VALIDATORS_FILE = "repomd-validators.json"
+REQUEST_TIMEOUT = 10
+MAX_WORKERS = 8
+METALINK_NS = {"ml": "http://www.metalinker.org/"}
+
+# Set once this process has checked every enabled repo against its server,
+# dnf subprocesses started afterwards don't need to refresh on their own.
+_validated = False
+
+
+class RepoProbe(NamedTuple):
+    repo_id: str
+    kind: str  # "metalink", "mirrorlist" or "baseurl"
+    url: str
+    local: bytes | None
+
+
+def refresh_args() -> list[str]:
+    """``--refresh`` for a dnf command line, unless the metadata of every
+    repo was already checked against its server in this process."""
+    return [] if _validated else ["--refresh"]
+
+
+def _option_value(option) -> Any:
+    try:
+        return option.get_value()
+    except (OptionValueNotSetError, RuntimeError, AttributeError):
+        return None
+
+
+def _substitute(base, url: str) -> str:
+    try:
+        return base.get_vars().substitute(url)
+    except (RuntimeError, AttributeError):
+        return url
+
+
+def _read_local_repomd(repo) -> bytes | None:
+    try:
+        return (Path(repo.get_cachedir()) / "repodata" / "repomd.xml").read_bytes()
+    except (OSError, RuntimeError, AttributeError):
+        return None
+
+
+def _collect_probes(base) -> list[tuple[Any, RepoProbe | None]]:
+    # Everything libdnf5 is read on the calling thread, the worker threads
+    # only get plain data.
+    probes = []
+    query = dnf5_repo.RepoQuery(base)
+    query.filter_enabled(True)
+    for repo in query:
+        config = repo.get_config()
+        metalink = _option_value(config.get_metalink_option())
+        mirrorlist = _option_value(config.get_mirrorlist_option())
+        baseurls = [url for url in (_option_value(config.get_baseurl_option()) or []) if url]
+        if metalink:
+            kind, url = "metalink", metalink
+        elif mirrorlist:
+            kind, url = "mirrorlist", mirrorlist
+        elif baseurls:
+            kind, url = "baseurl", baseurls[0]
+        else:
+            probes.append((repo, None))
+            continue
+        local = _read_local_repomd(repo)
+        probe = RepoProbe(repo.get_id(), kind, _substitute(base, url), local)
+        probes.append((repo, probe if local is not None else None))
+    return probes
+
+
+def _metalink_status(probe: RepoProbe) -> str:
+    response = requests.get(probe.url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    root = ElementTree.fromstring(response.content)
+    # Only the current repomd.xml counts, not the older <mm0:alternates>.
+    verification = root.find("ml:files/ml:file/ml:verification", METALINK_NS)
+    if verification is None:
+        return "error"
+    matched = None
+    for hash_element in verification.findall("ml:hash", METALINK_NS):
+        try:
+            local_digest = hashlib.new(hash_element.get("type", ""), probe.local).hexdigest()
+        except ValueError:
+            continue
+        if local_digest == (hash_element.text or "").strip():
+            return "unchanged"
+        matched = False
+    return "changed" if matched is False else "error"
+
+
+def _repomd_url(probe: RepoProbe) -> str | None:
+    if probe.kind == "baseurl":
+        return probe.url.rstrip("/") + "/repodata/repomd.xml"
+    response = requests.get(probe.url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    for line in response.text.splitlines():
+        line = line.strip()
+        if line.startswith(("http://", "https://")):
+            return line.rstrip("/") + "/repodata/repomd.xml"
+    return None
+
+
+def _conditional_status(
+    probe: RepoProbe, stored: dict[str, Any] | None
+) -> tuple[str, dict[str, Any] | None]:
+    url = _repomd_url(probe)
+    if url is None:
+        return "error", None
+    local_digest = hashlib.sha256(probe.local).hexdigest()
+
+    headers = {}
+    # The stored validators are only good if they were taken from the very
+    # repomd.xml that is in the cache now.
+    if stored and stored.get("url") == url and stored.get("sha256") == local_digest:
+        if stored.get("etag"):
+            headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified"):
+            headers["If-Modified-Since"] = stored["last_modified"]
+
+    response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        return "unchanged", stored
+    response.raise_for_status()
+
+    remote_digest = hashlib.sha256(response.content).hexdigest()
+    validators = {
+        "url": url,
+        "sha256": remote_digest,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    return ("unchanged" if remote_digest == local_digest else "changed"), validators
+
+
+def _probe_status(
+    probe: RepoProbe, stored: dict[str, Any] | None
+) -> tuple[str, dict[str, Any] | None]:
+    try:
+        if probe.kind == "metalink":
+            return _metalink_status(probe), stored
+        return _conditional_status(probe, stored)
+    except (requests.RequestException, ElementTree.ParseError):
+        return "error", stored
+
+
+def expire_changed_repos(base, logger: logging.Logger | None = None) -> dict[str, int]:
+    """Mark only the repos whose metadata really changed upstream as expired.
+
+    Call it between create_repos_from_system_configuration() and
+    load_repos(). Instead of metadata_expire=0, which makes libdnf5 fetch
+    repomd.xml (and often primary) again for every repo on every load, each
+    repo gets a single request: the metalink, whose hash is compared with
+    the cached repomd.xml, or a conditional GET of repomd.xml itself using
+    the ETag/Last-Modified from the last time. Repos that are unchanged are
+    kept as they are, anything that changed or could not be checked is
+    expired and left to libdnf5 as before.
+    """
+    global _validated
+    logger = logger if logger is not None else logging.getLogger()
+
+    state = load_json(VALIDATORS_FILE)
+    if not isinstance(state, dict):
+        state = {}
+    validators: dict[str, Any] = state.get("validators", {})
+    stats: dict[str, int] = state.get("stats", {})
+    run_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    probes = _collect_probes(base)
+    checkable = [probe for _, probe in probes if probe is not None]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = dict(
+            zip(
+                (probe.repo_id for probe in checkable),
+                executor.map(
+                    lambda probe: _probe_status(probe, validators.get(probe.repo_id)),
+                    checkable,
+                ),
+            )
+        )
+
+    for repo, probe in probes:
+        status = "error"
+        if probe is not None:
+            status, new_validators = results[probe.repo_id]
+            if new_validators:
+                validators[probe.repo_id] = new_validators
+        if status == "unchanged":
+            run_stats["hits"] += 1
+            # Checked just now, don't let the age of the files expire it.
+            repo.get_config().get_metadata_expire_option().from_string("-1")
+        else:
+            run_stats["misses" if status == "changed" else "errors"] += 1
+            repo.expire()
+            logger.debug("Metadata of repo %s %s.", repo.get_id(),
+                         "changed" if status == "changed" else "could not be checked")
+
+    for key, value in run_stats.items():
+        stats[key] = stats.get(key, 0) + value
+    save_json(VALIDATORS_FILE, {"validators": validators, "stats": stats})
+
+    logger.info(
+        "Repository metadata: %d unchanged, %d changed, %d not checked.",
+        run_stats["hits"], run_stats["misses"], run_stats["errors"],
+    )
+    _validated = True
+    return run_stats
@@ -0,0 +1,170 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from nobara_updater.kernels import KernelInventory, record_initramfs_seconds
+from nobara_updater.progress import DETAIL, format_duration
+
+# What dracut puts into every initramfs. A kernel whose image is older than
+# any of these needs a new one. Directories are compared by their own
+# mtime and that of the directories below them, rpm replacing a file
+# touches the directory it is in.
+SHARED_INPUTS = [
+    Path("/etc/dracut.conf"),
+    Path("/usr/lib/dracut/dracut.conf.d"),
+    Path("/usr/lib/dracut/modules.d"),
+    Path("/usr/lib/firmware"),
+    Path("/etc/plymouth/plymouthd.conf"),
+    Path("/etc/vconsole.conf"),
+    Path("/etc/crypttab"),
+]
+# Small config directories whose files get rewritten in place, which
+# doesn't touch the directory, so every file in them is looked at. The
+# modprobe.d options go into the initramfs and change with driver swaps.
+SHARED_CONFIG_DIRS = [
+    Path("/etc/dracut.conf.d"),
+    Path("/etc/modprobe.d"),
+    Path("/usr/lib/modprobe.d"),
+]
+
+
+def _newest_mtime(path: Path, recurse: bool = True, files: bool = False) -> float:
+    try:
+        newest = path.stat().st_mtime
+    except OSError:
+        return 0.0
+    if not recurse or not path.is_dir():
+        return newest
+    for root, dirs, filenames in os.walk(path):
+        for name in dirs + filenames if files else dirs:
+            try:
+                newest = max(newest, os.stat(os.path.join(root, name), follow_symlinks=False).st_mtime)
+            except OSError:
+                continue
+    return newest
+
+
+class InitramfsManager:
+    """Collects initramfs regeneration requests of one run and builds them
+    together.
+
+    Callers ask for a rebuild with request() when they changed something
+    that goes into the initramfs; nothing runs until regenerate(). Then
+    every kernel is built once, however many requests named it, only the
+    kernels that need it are built, and independent kernels are built in
+    parallel with `dracut -f --kver`, instead of `dracut -f
+    --regenerate-all` rebuilding all of them one after the other.
+    """
+
+    def __init__(self, logger: logging.Logger | None = None, jobs: int | None = None) -> None:
+        self.logger = logger if logger else logging.getLogger("nobara-updater.initramfs")
+        self.jobs = jobs or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._forced: set[str] = set()
+        self._force_all = False
+        self._check_stale = False
+        self._reasons: list[str] = []
+
+    def request(self, reason: str, kernels: list[str] | None = None, force: bool = False) -> None:
+        """Ask for the initramfs of the given kernels (all by default) to be
+        regenerated.
+
+        Without force, a kernel is only rebuilt if its modules or one of
+        the shared inputs changed since its initramfs was built, which is what
+        package updates need. Use force for changes that can't be seen
+        from the files, like a new plymouth theme.
+        """
+        with self._lock:
+            self._reasons.append(reason)
+            if not force:
+                self._check_stale = True
+            elif kernels is None:
+                self._force_all = True
+            else:
+                self._forced.update(kernels)
+
+    def pending(self) -> bool:
+        with self._lock:
+            return bool(self._reasons)
+
+    def stale_kernels(self, inventory: KernelInventory) -> list[str]:
+        shared = max(
+            [_newest_mtime(path) for path in SHARED_INPUTS]
+            + [_newest_mtime(path, files=True) for path in SHARED_CONFIG_DIRS],
+            default=0.0,
+        )
+        stale = []
+        for kver in inventory.versions():
+            kernel = inventory.kernels[kver]
+            built = _newest_mtime(kernel.initramfs, recurse=False) if kernel.initramfs else 0.0
+            if not built:
+                stale.append(kver)
+                continue
+            # depmod rewrites the modules.* files of a kernel whenever its
+            # modules change, so the top level of the directory is enough.
+            modules = _newest_mtime(kernel.modules, recurse=False)
+            for entry in kernel.modules.glob("modules.*"):
+                modules = max(modules, _newest_mtime(entry, recurse=False))
+            if max(shared, modules) > built:
+                stale.append(kver)
+        return stale
+
+    def _build(self, kver: str) -> tuple[bool, float, str]:
+        started = time.monotonic()
+        result = subprocess.run(
+            ["dracut", "-f", "--kver", kver],
+            capture_output=True,
+            text=True, encoding="utf-8", errors="replace",
+        )
+        return result.returncode == 0, time.monotonic() - started, result.stdout + result.stderr
+
+    def regenerate(self, inventory: KernelInventory | None = None) -> bool:
+        """Build everything requested so far. Returns False if a build failed."""
+        with self._lock:
+            if not self._reasons:
+                return True
+            reasons = self._reasons
+            forced, force_all, check_stale = self._forced, self._force_all, self._check_stale
+            self._reasons, self._forced, self._force_all, self._check_stale = [], set(), False, False
+
+        if inventory is None:
+            inventory = KernelInventory(self.logger)
+        kernels = set(inventory.versions())
+        targets = kernels if force_all else forced & kernels
+        if check_stale:
+            targets.update(self.stale_kernels(inventory))
+        if not targets:
+            self.logger.info("All initramfs images are up to date.\n")
+            return True
+
+        self.logger.info(
+            "Regenerating initramfs for %s (%s)...",
+            ", ".join(sorted(targets)),
+            "; ".join(dict.fromkeys(reasons)),
+        )
+        started = time.monotonic()
+        success = True
+        with ThreadPoolExecutor(max_workers=max(1, min(len(targets), self.jobs))) as executor:
+            jobs = {executor.submit(self._build, kver): kver for kver in sorted(targets)}
+            for job in as_completed(jobs):
+                kver = jobs[job]
+                try:
+                    ok, seconds, output = job.result()
+                except OSError as e:
+                    ok, seconds, output = False, 0.0, str(e)
+                if ok:
+                    record_initramfs_seconds(seconds)
+                    self.logger.info("initramfs for %s built in %s.", kver, format_duration(seconds))
+                    if output.strip():
+                        self.logger.info("dracut output for %s:\n%s", kver, output, extra=DETAIL)
+                else:
+                    success = False
+                    self.logger.error("dracut failed for %s:\n%s", kver, output)
+        self.logger.info(
+            "initramfs regeneration done in %s.\n", format_duration(time.monotonic() - started)
+        )
+        return success
@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from nobara_updater.cache import load_json, save_json
+
+BOOT_DIR = Path("/boot")
+MODULES_DIR = Path("/lib/modules")
+
+# The packages that carry a kernel image, their version-release.arch is
+# the kernel version. Variants can have several segments (kernel-rt-debug-core).
+KERNEL_PACKAGE = re.compile(r"^kernel(-[a-z0-9]+)*(?<!-modules)-core$|^kernel-uki-virt$")
+# The install-only packages built from one kernel: image, modules, devel
+# and the meta packages. kernel-tools and kernel-headers carry the kernel
+# version too but are ordinary packages.
+KERNEL_INSTALLONLY_PACKAGE = re.compile(
+    r"^kernel(?!-tools|-headers)(-[a-z0-9]+)*(-core|-modules(-[a-z]+)*|-devel(-matched)?)?$"
+    r"|^kernel-uki-virt(-addons)?$"
+)
+
+_bootctl_lock = threading.Lock()
+_image_type: str | None = None
+
+
+class Kernel(NamedTuple):
+    version: str
+    image: Path | None
+    initramfs: Path | None
+    modules: Path | None
+    # None when it isn't known which kernels rpm has installed.
+    rpm_owned: bool | None
+
+    @property
+    def bootable(self) -> bool:
+        return self.image is not None and self.modules is not None
+
+
+def boot_image_type() -> str:
+    """What `bootctl kernel-identify` says about the boot stub, e.g. "uki".
+
+    Asked once per run; empty if bootctl can't tell.
+    """
+    global _image_type
+    with _bootctl_lock:
+        if _image_type is None:
+            _image_type = ""
+            try:
+                stub = subprocess.run(
+                    ["bootctl", "--print-stub-path"],
+                    capture_output=True,
+                    text=True, encoding="utf-8", errors="replace",
+                    check=True,
+                ).stdout.strip()
+                _image_type = subprocess.run(
+                    ["bootctl", "kernel-identify", stub],
+                    capture_output=True,
+                    text=True, encoding="utf-8", errors="replace",
+                    check=True,
+                ).stdout.strip()
+            except (OSError, subprocess.CalledProcessError):
+                pass
+        return _image_type
+
+
+def _versions(path: Path, prefix: str = "") -> dict[str, Path]:
+    found = {}
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix):
+                    found[entry.name[len(prefix):]] = Path(entry.path)
+    except OSError:
+        pass
+    return found
+
+
+class KernelInventory:
+    """The kernels on this system, from one scan of /boot and /lib/modules.
+
+    Replaces `ls /boot | grep vmlinuz` and `ls /lib/modules`. With the
+    installed package index it also knows which kernels rpm installed,
+    so a module tree is never removed from under an installed kernel
+    whose image just isn't in /boot (UKI setups). Call scan() again after
+    a transaction.
+    """
+
+    def __init__(self, logger: logging.Logger | None = None, installed: Any = None) -> None:
+        self.logger = logger if logger else logging.getLogger("nobara-updater.kernels")
+        self.installed = installed
+        self.booted = os.uname().release
+        self.kernels: dict[str, Kernel] = {}
+        self.scan()
+
+    def _rpm_versions(self) -> set[str] | None:
+        if self.installed is None:
+            return None
+        return {
+            f"{pkg.version}-{pkg.release}.{pkg.arch}"
+            for pkg in self.installed.packages()
+            if KERNEL_PACKAGE.match(pkg.name)
+        }
+
+    def scan(self) -> None:
+        images = {
+            version: path for version, path in _versions(BOOT_DIR, "vmlinuz-").items()
+            if "rescue" not in version
+        }
+        initramfs = {
+            version.removesuffix(".img"): path
+            for version, path in _versions(BOOT_DIR, "initramfs-").items()
+            if version.endswith(".img")
+        }
+        modules = {version: path for version, path in _versions(MODULES_DIR).items() if path.is_dir()}
+        rpm_versions = self._rpm_versions()
+        self.kernels = {
+            version: Kernel(
+                version,
+                images.get(version),
+                initramfs.get(version),
+                modules.get(version),
+                None if rpm_versions is None else version in rpm_versions,
+            )
+            for version in sorted(set(images) | set(modules))
+        }
+
+    def versions(self) -> list[str]:
+        """Kernels that can boot: an image in /boot and modules to go with it."""
+        return [kernel.version for kernel in self.kernels.values() if kernel.bootable]
+
+    def latest(self) -> str | None:
+        versions = self.versions()
+        if not versions:
+            return None
+        return max(versions, key=lambda version: self.kernels[version].image.stat().st_mtime)
+
+    def reboot_needed(self) -> bool:
+        """A newer kernel than the running one is installed."""
+        latest = self.latest()
+        return latest is not None and latest != self.booted
+
+    def orphaned_modules(self) -> list[Path]:
+        """Module trees of kernels that are no longer installed."""
+        orphans = []
+        for kernel in self.kernels.values():
+            if kernel.modules is None or kernel.version == self.booted:
+                continue
+            # An image in /boot keeps its modules even when no package owns
+            # it (self-built kernels), rpm covers UKI setups without one.
+            installed = kernel.image is not None or bool(kernel.rpm_owned)
+            if not installed:
+                orphans.append(kernel.modules)
+        return orphans
+
+    def remove_orphaned_modules(self) -> list[Path]:
+        orphans = self.orphaned_modules()
+        if not orphans:
+            return []
+
+        def remove(path: Path) -> Path | None:
+            try:
+                shutil.rmtree(path)
+                return path
+            except OSError as e:
+                self.logger.error("Could not remove module directory %s: %s", path, e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(len(orphans), os.cpu_count() or 1)) as executor:
+            removed = [path for path in executor.map(remove, orphans) if path is not None]
+        for path in removed:
+            self.logger.info("Removed module directory: %s", path)
+        self.scan()
+        return removed
+
+
+KERNELS_CACHE = "kernels.json"
+# Kernels remembered as having booted, most recent last.
+BOOT_HISTORY = 10
+
+
+def _kernel_state() -> dict[str, Any]:
+    state = load_json(KERNELS_CACHE)
+    return state if isinstance(state, dict) else {}
+
+
+def record_booted_kernel() -> None:
+    """Remember the running kernel as one that boots."""
+    state = _kernel_state()
+    booted = [version for version in state.get("booted", []) if version != os.uname().release]
+    state["booted"] = (booted + [os.uname().release])[-BOOT_HISTORY:]
+    save_json(KERNELS_CACHE, state)
+
+
+def known_good_kernel(installed: list[str]) -> str | None:
+    """The installed kernel other than the running one that booted last."""
+    running = os.uname().release
+    for version in reversed(_kernel_state().get("booted", [])):
+        if version != running and version in installed:
+            return version
+    return None
+
+
+def record_initramfs_seconds(seconds: float) -> None:
+    state = _kernel_state()
+    average = state.get("initramfs_seconds")
+    # Moving average, one slow build shouldn't decide the estimate.
+    state["initramfs_seconds"] = seconds if not average else 0.7 * average + 0.3 * seconds
+    save_json(KERNELS_CACHE, state)
+
+
+def initramfs_seconds() -> float | None:
+    return _kernel_state().get("initramfs_seconds")
+
+
+def boot_usage(version: str) -> int:
+    """Bytes a kernel takes up in /boot: image, initramfs, System.map and
+    the like, and its boot loader entry."""
+    total = 0
+    for directory in (BOOT_DIR, BOOT_DIR / "loader" / "entries"):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if version in entry.name and entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return total
+
+
+def kernels_to_remove(
+    installed: list[str], incoming: list[str], keep: int, running: str, known_good: str | None
+) -> list[str]:
+    """Installed kernels the retention policy drops.
+
+    installed is ordered oldest first and incoming are the kernels the
+    transaction adds, which are newer than all of them. The newest keep
+    kernels stay, and so do the running kernel and the known-good one.
+    """
+    newest = (installed + incoming)[-keep:] if keep > 0 else installed + incoming
+    kept = set(newest) | {running}
+    if known_good:
+        kept.add(known_good)
+    return [version for version in installed if version not in kept]
@@ -0,0 +1,71 @@
+import logging
+
+# dnf4 takes long to import, only load it when the legacy display is used.
+import dnf  # type: ignore[import]
+
+
+class CustomTransactionDisplay(dnf.yum.rpmtrans.LoggingTransactionDisplay):
+    def __init__(self, total_packages):
+        super().__init__()
+        self.logger = logging.getLogger(__name__)
+        self.scriptlet_progress = {}
+        self.performing_cleanup = 0
+        self.performing_upgrade = 0
+        self.starting_line = 0
+        self.total_packages = total_packages
+        self.package = ""
+
+    def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
+        super().progress(package, action, ti_done, ti_total, ts_done, ts_total)
+        action_str = self._get_action_str(action)
+        package_name = str(package)
+
+        match action_str:
+            case "Upgraded:" | "Preparing:" | "Reinstalled:" | "Downgraded:" | "Obsoleted:" | "Cleanup:":
+                return  # Skip logging for these actions
+
+        if action_str == "Running scriptlet:":
+            if self.performing_cleanup == 0:
+                self.logger.info("Cleanup...")
+                self.performing_cleanup = 1
+            else:
+                return
+        else:
+            if self.performing_upgrade == 0:
+                if action_str == "Upgrading:":
+                    self.logger.info("Upgrading...")
+                if action_str == "Removing:":
+                    self.logger.info("Removing...")
+                if action_str == "Downgrading:":
+                    self.logger.info("Downgrading...")
+                if action_str == "Installing:":
+                    self.logger.info("Installing...")
+
+                self.performing_upgrade = 1
+
+            if self.package != package_name:
+                self.starting_line += 1
+                if self.starting_line <= self.total_packages:
+                    self.package = package_name
+                    self.logger.info(f"    ({self.starting_line}/{self.total_packages}) {action_str} {package_name}")
+                else:
+                    return
+
+    def _get_action_str(self, action):
+        action_map = {
+            dnf.transaction.PKG_DOWNGRADE: 'Downgrading:',
+            dnf.transaction.PKG_DOWNGRADED: 'Downgraded:',
+            dnf.transaction.PKG_INSTALL: 'Installing:',
+            dnf.transaction.PKG_OBSOLETE: 'Obsoleting:',
+            dnf.transaction.PKG_OBSOLETED: 'Obsoleted:',
+            dnf.transaction.PKG_REINSTALL: 'Reinstalling:',
+            dnf.transaction.PKG_REINSTALLED: 'Reinstalled:',
+            dnf.transaction.PKG_REMOVE: 'Removing:',
+            dnf.transaction.PKG_UPGRADE: 'Upgrading:',
+            dnf.transaction.PKG_UPGRADED: 'Upgraded:',
+            dnf.transaction.PKG_CLEANUP: 'Cleanup:',
+            dnf.transaction.PKG_VERIFY: 'Verified:',
+            dnf.transaction.PKG_SCRIPTLET: 'Running scriptlet:',
+            dnf.transaction.TRANS_PREPARATION: 'Preparing:',
+        }
+        return action_map.get(action, action)
@@ -0,0 +1,257 @@
+import hashlib
+import html
+import logging
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+import libdnf5.repo as dnf5_repo
+import requests
+
+from nobara_updater.cache import load_json, save_json
+
+RANKING_FILE = "mirrors.json"
+# A ranking older than this is ignored, mirrors come and go.
+RANKING_MAX_AGE = 7 * 24 * 60 * 60
+# How many mirrors of one repo are measured, and how many of the best
+# fresh ones are handed to libdnf5 afterwards.
+MAX_MIRRORS_PER_REPO = 10
+PREFERRED_MIRRORS = 5
+MEASURE_WORKERS = 16
+REQUEST_TIMEOUT = 5
+# Size of the slice of primary metadata fetched to estimate throughput.
+RANGE_BYTES = 256 * 1024
+
+METALINK_NS = {
+    "ml": "http://www.metalinker.org/",
+    "mm0": "http://fedorahosted.org/mirrormanager",
+}
+REPOMD_NS = {"repo": "http://linux.duke.edu/metadata/repo"}
+
+
+class MirrorResult(NamedTuple):
+    repo_id: str
+    url: str
+    rtt: float | None = None
+    throughput: float | None = None
+    revision: str | None = None
+    repomd_sha256: str | None = None
+    error: str | None = None
+
+
+class RepoMirrors(NamedTuple):
+    repo_id: str
+    mirrors: list[str]
+    # sha256 of the newest repomd.xml according to the metalink, if any.
+    current_hashes: set[str]
+
+
+def _expand(url: str, variables: dict[str, str]) -> str:
+    for name, value in variables.items():
+        url = url.replace(f"${name}", value)
+    return url
+
+
+def _base_of(repomd_url: str) -> str:
+    return repomd_url.rstrip("/").removesuffix("/repodata/repomd.xml")
+
+
+def _new_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=MEASURE_WORKERS, pool_maxsize=MEASURE_WORKERS
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _metalink_mirrors(session: requests.Session, repo_id: str, url: str) -> RepoMirrors:
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    root = ElementTree.fromstring(response.content)
+    file_element = root.find("ml:files/ml:file", METALINK_NS)
+    if file_element is None:
+        return RepoMirrors(repo_id, [], set())
+
+    current_hashes = {
+        (hash_element.text or "").strip()
+        for hash_element in file_element.findall("ml:verification/ml:hash", METALINK_NS)
+        if hash_element.get("type") == "sha256"
+    }
+    mirrors = []
+    # The metalink already lists mirrors by preference for this client.
+    for url_element in file_element.findall("ml:resources/ml:url", METALINK_NS):
+        if url_element.get("protocol") in ("http", "https") and url_element.text:
+            mirrors.append(_base_of(url_element.text.strip()))
+    return RepoMirrors(repo_id, mirrors[:MAX_MIRRORS_PER_REPO], current_hashes)
+
+
+def _mirrorlist_mirrors(session: requests.Session, repo_id: str, url: str) -> RepoMirrors:
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    mirrors = [
+        line.strip().rstrip("/")
+        for line in response.text.splitlines()
+        if line.strip().startswith(("http://", "https://"))
+    ]
+    return RepoMirrors(repo_id, mirrors[:MAX_MIRRORS_PER_REPO], set())
+
+
+def _measure(session: requests.Session, repo_id: str, mirror: str) -> MirrorResult:
+    try:
+        response = session.get(f"{mirror}/repodata/repomd.xml", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        rtt = response.elapsed.total_seconds()
+        repomd_sha256 = hashlib.sha256(response.content).hexdigest()
+
+        root = ElementTree.fromstring(response.content)
+        revision_element = root.find("repo:revision", REPOMD_NS)
+        revision = revision_element.text.strip() if revision_element is not None and revision_element.text else None
+
+        throughput = None
+        location = root.find("repo:data[@type='primary']/repo:location", REPOMD_NS)
+        if location is not None and location.get("href"):
+            start = time.monotonic()
+            with session.get(
+                f"{mirror}/{location.get('href')}",
+                headers={"Range": f"bytes=0-{RANGE_BYTES - 1}"},
+                timeout=REQUEST_TIMEOUT,
+                stream=True,
+            ) as primary:
+                primary.raise_for_status()
+                received = sum(len(chunk) for chunk in primary.iter_content(64 * 1024))
+            elapsed = time.monotonic() - start
+            if elapsed > 0 and received:
+                throughput = received / elapsed
+
+        return MirrorResult(repo_id, mirror, rtt, throughput, revision, repomd_sha256)
+    except (requests.RequestException, ElementTree.ParseError) as e:
+        return MirrorResult(repo_id, mirror, error=type(e).__name__)
+
+
+def _revision_key(revision: str | None) -> tuple[int, int | str]:
+    if revision is None:
+        return (0, 0)
+    return (2, int(revision)) if revision.isdigit() else (1, revision)
+
+
+def _is_fresh(result: MirrorResult, repo: RepoMirrors, newest_revision: str | None) -> bool:
+    if result.error is not None:
+        return False
+    # With a metalink there is no guessing, it names the current repomd.xml.
+    if repo.current_hashes:
+        return result.repomd_sha256 in repo.current_hashes
+    return _revision_key(result.revision) >= _revision_key(newest_revision)
+
+
+def _speed_key(result: MirrorResult) -> tuple[float, float]:
+    return (-(result.throughput or 0.0), result.rtt if result.rtt is not None else float("inf"))
+
+
+def rank_mirrors(
+    repos: list[Any], variables: dict[str, str], logger: logging.Logger | None = None
+) -> dict[str, Any]:
+    """Measure every mirror of every repo and remember the fastest fresh ones.
+
+    A mirror is measured by fetching its repomd.xml (round-trip time, and
+    its <revision> and checksum) and a small range of its primary metadata
+    (throughput). Mirrors whose repomd.xml is not the one the metalink
+    names, or whose revision is behind the newest one seen for the repo,
+    are reported as stale and never preferred. The ranking is stored in
+    /var/cache/nobara-updater and picked up by apply_mirror_ranking().
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    green = "#00FF00"
+    red = "#FF0000"
+    check_mark = f"<span foreground='{green}'>✔</span>"
+    red_x = f"<span foreground='{red}'>✘</span>"
+
+    session = _new_http_session()
+
+    def expand_repo(repo) -> RepoMirrors | None:
+        try:
+            if repo.metalink:
+                return _metalink_mirrors(session, repo.id, _expand(str(repo.metalink), variables))
+            if repo.mirrorlist:
+                return _mirrorlist_mirrors(session, repo.id, _expand(str(repo.mirrorlist), variables))
+        except (requests.RequestException, ElementTree.ParseError) as e:
+            logger.info(f"{red_x} {repo.id}: could not get mirror list: {html.escape(str(e))}\n")
+            return None
+        baseurls = [_expand(url, variables).rstrip("/") for url in (repo.baseurl or []) if url]
+        return RepoMirrors(repo.id, baseurls[:MAX_MIRRORS_PER_REPO], set())
+
+    with ThreadPoolExecutor(max_workers=MEASURE_WORKERS) as executor:
+        expanded = [repo for repo in executor.map(expand_repo, repos) if repo is not None and repo.mirrors]
+        jobs = [(repo.repo_id, mirror) for repo in expanded for mirror in repo.mirrors]
+        results = list(executor.map(lambda job: _measure(session, *job), jobs))
+
+    ranking: dict[str, Any] = {}
+    for repo in expanded:
+        repo_results = [result for result in results if result.repo_id == repo.repo_id]
+        newest_revision = max(
+            (result.revision for result in repo_results if result.error is None),
+            key=_revision_key,
+            default=None,
+        )
+        fresh = sorted(
+            (result for result in repo_results if _is_fresh(result, repo, newest_revision)),
+            key=_speed_key,
+        )
+        stale = [result for result in repo_results if result.error is None and result not in fresh]
+        unreachable = [result for result in repo_results if result.error is not None]
+
+        logger.info(f"{repo.repo_id}: {len(fresh)} fresh, {len(stale)} stale, {len(unreachable)} unreachable mirrors\n")
+        for result in fresh:
+            throughput = f"{result.throughput / 1_000_000:.1f} MB/s" if result.throughput else "n/a"
+            logger.info(
+                f"{check_mark} {repo.repo_id}: {result.rtt * 1000:.0f} ms, {throughput}, "
+                f"revision {result.revision}: {html.escape(result.url)}\n"
+            )
+        for result in stale:
+            logger.info(
+                f"{red_x} {repo.repo_id}: stale, revision {result.revision} "
+                f"(newest {newest_revision}): {html.escape(result.url)}\n"
+            )
+        for result in unreachable:
+            logger.info(f"{red_x} {repo.repo_id}: {result.error}: {html.escape(result.url)}\n")
+
+        ranking[repo.repo_id] = {
+            "fresh": [result.url for result in fresh],
+            "stale": [result.url for result in stale],
+            "newest_revision": newest_revision,
+        }
+
+    save_json(RANKING_FILE, {"time": time.time(), "repos": ranking})
+    return ranking
+
+
+def apply_mirror_ranking(base, logger: logging.Logger | None = None) -> None:
+    """Put the fastest fresh mirrors from the last ranking first.
+
+    Call it between create_repos_from_system_configuration() and
+    load_repos(). The ranked mirrors become the repo's baseurl, which
+    librepo tries before the mirrors it gets from the metalink or
+    mirrorlist. The metalink stays set, so its repomd.xml checksum is still
+    verified and a mirror that went stale since the ranking is skipped.
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    ranking = load_json(RANKING_FILE)
+    if not isinstance(ranking, dict):
+        return
+    try:
+        if time.time() - float(ranking["time"]) > RANKING_MAX_AGE:
+            return
+        repos = ranking["repos"]
+    except (KeyError, TypeError, ValueError):
+        return
+
+    query = dnf5_repo.RepoQuery(base)
+    query.filter_enabled(True)
+    for repo in query:
+        preferred = (repos.get(repo.get_id()) or {}).get("fresh", [])[:PREFERRED_MIRRORS]
+        if not preferred:
+            continue
+        repo.get_config().get_baseurl_option().from_string(",".join(preferred))
+        logger.debug("Preferring ranked mirrors for %s: %s", repo.get_id(), ", ".join(preferred))
@@ -1,38 +1,119 @@
 #!/usr/bin/python3
+from __future__ import annotations
+
 import argparse
+import contextlib
 import html
 import logging
 import os
 import platform
 import pwd
+import queue
 import re
 import subprocess
 import sys
 import threading
+import time
 import xml.etree.ElementTree as ElementTree
 from argparse import Namespace
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Any, Callable
 
-import gi  # type: ignore[import]
-import psutil
-import shutil
-import requests
-from nobara_updater.quirks import QuirkFixup  # type: ignore[import]
+from nobara_updater.dkms import DkmsBuilder
+from nobara_updater.downloads import DOWNLOAD_PROFILES, FlatpakTransferMonitor, resolve_download_profile
+from nobara_updater.initramfs import InitramfsManager
+from nobara_updater.kernels import KernelInventory, boot_image_type
+from nobara_updater.progress import DetailFilter
 from nobara_updater.run_as import run_as_user
 
-gi.require_version("Gtk", "3.0")
-gi.require_version("GLib", "2.0")
-gi.require_version("Flatpak", "1.0")
+# GTK, Flatpak, requests and the dnf5 bindings are imported by the
+# load_*() functions once main() knows the command, after the sudo/pkexec
+# re-exec, and each command only loads what it uses (COMMAND_LOADERS).
+# --help and the re-exec itself don't load any of them.
+gi = Flatpak = GLib = Gtk = requests = None
+QuirkFixup = rank_mirrors = list_flatpak_updates = maintain_flatpak_installation = None
+AttributeDict = TransactionPlan = UpdateSession = None
+get_installed_index = repoindex = prefetch_system_upgrade = None
+run_system_upgrade_transaction = updatechecker = None
+
+
+def load_dnf() -> None:
+    global AttributeDict, TransactionPlan, UpdateSession, get_installed_index
+    global repoindex, prefetch_system_upgrade, run_system_upgrade_transaction, updatechecker
+
+    from nobara_updater.dnf import (  # type: ignore[import]
+        AttributeDict,
+        TransactionPlan,
+        UpdateSession,
+        get_installed_index,
+        repoindex,
+        prefetch_system_upgrade,
+        run_system_upgrade_transaction,
+        updatechecker,
+    )
+
+
+def load_flatpak() -> None:
+    global gi, Flatpak, GLib, list_flatpak_updates, maintain_flatpak_installation
+
+    import gi  # type: ignore[import]
+
+    gi.require_version("GLib", "2.0")
+    gi.require_version("Flatpak", "1.0")
+    from gi.repository import Flatpak, GLib  # type: ignore[import]
+
+    from nobara_updater.flatpak_updates import list_updates as list_flatpak_updates
+    from nobara_updater.flatpak_updates import maintain_installation as maintain_flatpak_installation
+
+
+def load_requests() -> None:
+    global requests
+
+    import requests
+
+
+def load_quirks() -> None:
+    global QuirkFixup
+
+    from nobara_updater.quirks import QuirkFixup  # type: ignore[import]
+
+
+def load_mirrors() -> None:
+    global rank_mirrors
+
+    from nobara_updater.mirrors import rank_mirrors
 
-from gi.repository import Flatpak, GLib, Gtk  # type: ignore[import]
 
-from nobara_updater.dnf import (  # type: ignore[import]
-    AttributeDict,
-    PackageUpdater,
-    repoindex,
-    run_system_upgrade_transaction,
-    updatechecker,
-)
+def load_gui() -> None:
+    global Gtk
+
+    for load in (load_dnf, load_flatpak, load_requests, load_quirks, load_mirrors):
+        load()
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gtk  # type: ignore[import]
+
+
+# What each command uses. check_updates() lists Flatpak updates too, so
+# everything that checks for updates needs Flatpak.
+COMMAND_LOADERS: dict[str, tuple[Callable[[], None], ...]] = {
+    "install-updates": (load_dnf, load_flatpak, load_requests, load_quirks),
+    "cli": (load_dnf, load_flatpak, load_requests, load_quirks),
+    "check-updates": (load_dnf, load_flatpak),
+    "prefetch": (load_dnf, load_flatpak),
+    "repair": (load_dnf, load_flatpak),
+    "install-fixups": (load_dnf, load_flatpak, load_quirks),
+    "install-codecs": (load_dnf,),
+    "check-repos": (load_dnf, load_requests),
+    "maintenance": (load_flatpak,),
+    "rank-mirrors": (load_dnf, load_mirrors),
+}
+
+
+def load_runtime(command: str) -> None:
+    for load in COMMAND_LOADERS.get(command, ()):
+        load()
 
 # Force UTF-8 locale for all child processes spawned from this Python process
 os.environ.setdefault("LANG", "C.UTF-8")
@@ -123,7 +204,7 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def initialize_logging(textview: Gtk.TextView = None) -> logging.Logger:
+def initialize_logging(textview: Gtk.TextView = None, log_to_file: bool = True) -> logging.Logger:
     global rotate_log_files
     global logger
 
@@ -139,29 +220,35 @@ def initialize_logging(textview: Gtk.TextView = None) -> logging.Logger:
         "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
     )
     console_handler.setFormatter(console_formatter)
+    # Per-package transaction detail is for the log file only.
+    console_handler.addFilter(DetailFilter())
     # Add the console handler to the logger
     logger.addHandler(console_handler)
 
     # LOG FILE
-    # Rotate log files before writing the new log fo;e
-    rotate_log_files(str(log_file))
-
-    # Create file handler
-    file_handler = logging.FileHandler(log_file, mode="w")
-    file_handler.setLevel(logging.INFO)
-    # Create formatter for the file handler
-    file_formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
-    )
-    file_handler.setFormatter(file_formatter)
-    # Add the file handler to the logger
-    logger.addHandler(file_handler)
+    # Background jobs like prefetch must not rotate away the log of the run
+    # the user is looking at.
+    if log_to_file:
+        # Rotate log files before writing the new log fo;e
+        rotate_log_files(str(log_file))
+
+        # Create file handler
+        file_handler = logging.FileHandler(log_file, mode="w")
+        file_handler.setLevel(logging.INFO)
+        # Create formatter for the file handler
+        file_formatter = logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+        )
+        file_handler.setFormatter(file_formatter)
+        # Add the file handler to the logger
+        logger.addHandler(file_handler)
 
     # GUI STATUS WINDOW
     # Optionally create textview handler for GUI
     if textview is not None:
         textview_handler = TextViewHandler(textview)
         textview_handler.setLevel(logging.INFO)
+        textview_handler.addFilter(DetailFilter())
         # Add the textview handler to the logger
         logger.addHandler(textview_handler)
 
@@ -301,11 +388,31 @@ def get_repolist() -> tuple[
     )
 
 
+# At most this many repo check requests are in flight at once, whatever
+# mix of metalinks, mirrorlists and baseurls they come from.
+REPO_CHECK_CONCURRENCY = 16
+# How many mirrors of one mirrorlist are raced against each other.
+MIRROR_RACE_WIDTH = 4
+_repo_check_slots = threading.BoundedSemaphore(REPO_CHECK_CONCURRENCY)
+
+
+def new_repo_check_session() -> requests.Session:
+    # One pool of keep-alive connections per host, shared by all threads.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=REPO_CHECK_CONCURRENCY, pool_maxsize=REPO_CHECK_CONCURRENCY
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def validate_metalink(
     metalink_url: str, session: requests.Session, headers: dict[str, str]
 ) -> bool:
     try:
-        response = session.get(metalink_url, headers=headers, timeout=5)
+        with _repo_check_slots:
+            response = session.get(metalink_url, headers=headers, timeout=5)
         if response.status_code == 200:
             try:
                 root = ElementTree.fromstring(response.content)
@@ -321,7 +428,8 @@ def validate_mirrorlist(
     mirrorlist_url: str, session: requests.Session, headers: dict[str, str]
 ) -> bool:
     try:
-        response = session.get(mirrorlist_url, headers=headers, timeout=5)
+        with _repo_check_slots:
+            response = session.get(mirrorlist_url, headers=headers, timeout=5)
         if response.status_code == 200:
             mirrors = response.text.splitlines()
             mirrors = [mirror for mirror in mirrors if mirror.strip()]
@@ -347,17 +455,40 @@ def validate_mirrorlist(
         return False
 
 
+def validate_baseurl(url: str, session: requests.Session, headers: dict[str, str]) -> bool:
+    try:
+        with _repo_check_slots:
+            response = session.head(url, headers=headers, timeout=5)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+
 def validate_baseurls(
     baseurl_list: list[str], session: requests.Session, headers: dict[str, str]
 ) -> bool:
-    for url in baseurl_list:
-        try:
-            response = session.head(url, headers=headers, timeout=5)
-            if response.status_code == 200:
+    """True as soon as any of the urls answers.
+
+    The urls are raced instead of tried one after another, so a dead
+    mirror at the top of a mirrorlist only costs its timeout once, in
+    parallel with the others, instead of holding everything up.
+    """
+    if len(baseurl_list) <= 1:
+        return any(validate_baseurl(url, session, headers) for url in baseurl_list)
+
+    executor = ThreadPoolExecutor(max_workers=min(MIRROR_RACE_WIDTH, len(baseurl_list)))
+    try:
+        futures = [
+            executor.submit(validate_baseurl, url, session, headers)
+            for url in baseurl_list
+        ]
+        for future in as_completed(futures):
+            if future.result():
                 return True
-        except Exception:
-            return False
-    return False
+        return False
+    finally:
+        # Don't wait for the slower mirrors once one has answered.
+        executor.shutdown(wait=False, cancel_futures=True)
 
 def check_repos() -> None:
     green = "#00FF00"
@@ -377,15 +508,30 @@ def check_repos() -> None:
     log_messages = []
 
     # Create a session
-    session = requests.Session()
+    session = new_repo_check_session()
 
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.82 Safari/537.36"
     }
+    checks = (
+        [(validate_metalink, metalink) for metalink in metalinks]
+        + [(validate_mirrorlist, mirrorlist) for mirrorlist in mirrorlists]
+        + [(validate_baseurls, [url]) for url in baseurls]
+    )
+    # Everything is checked at once, the messages are still built in the
+    # same order as before.
+    with ThreadPoolExecutor(max_workers=max(1, min(REPO_CHECK_CONCURRENCY, len(checks)))) as executor:
+        results = list(
+            executor.map(lambda check: check[0](check[1], session, headers), checks)
+        )
+    metalink_results = results[: len(metalinks)]
+    mirrorlist_results = results[len(metalinks) : len(metalinks) + len(mirrorlists)]
+    baseurl_results = results[len(metalinks) + len(mirrorlists) :]
+
     # Example: Validate the URLs and print the corresponding repo names
-    for metalink in metalinks:
+    for metalink, valid in zip(metalinks, metalink_results):
         escaped_metalink = html.escape(metalink)
-        if validate_metalink(metalink, session, headers):
+        if valid:
             log_messages.append(
                 f"{check_mark} {metalink_repos[metalink]}: metalink: {escaped_metalink}\n"
             )
@@ -394,9 +540,9 @@ def check_repos() -> None:
                 f"{red_x} {metalink_repos[metalink]}: metalink: {escaped_metalink}\n"
             )
 
-    for mirrorlist in mirrorlists:
+    for mirrorlist, valid in zip(mirrorlists, mirrorlist_results):
         escaped_mirrorlist = html.escape(mirrorlist)
-        if validate_mirrorlist(mirrorlist, session, headers):
+        if valid:
             log_messages.append(
                 f"{check_mark} {mirrorlist_repos[mirrorlist]}: mirrorlist: {escaped_mirrorlist}\n"
             )
@@ -405,9 +551,9 @@ def check_repos() -> None:
                 f"{red_x} {mirrorlist_repos[mirrorlist]}: mirrorlist: {escaped_mirrorlist}\n"
             )
 
-    for url in baseurls:
+    for url, valid in zip(baseurls, baseurl_results):
         escaped_url = html.escape(url)
-        if validate_baseurls([url], session, headers):
+        if valid:
             log_messages.append(
                 f"{check_mark} {baseurl_repos[url]}: baseurl: {escaped_url}\n"
             )
@@ -427,6 +573,8 @@ perform_reboot_request = 0
 perform_refresh = 0
 is_refreshing = 0
 media_fixup_event = threading.Event()
+# Collects the dracut runs fixups and updates ask for, see InitramfsManager.
+initramfs = InitramfsManager(logger)
 
 def get_system_updates_available() -> int:
     global system_updates_available
@@ -453,7 +601,28 @@ def get_fixups_available() -> int:
     global fixups_available
     return fixups_available
 
-def check_updates(return_texts: bool = False) -> None | tuple[str | None, str | None, str | None]:
+# Shared deadline for the three sources of check_updates(), a source that
+# hasn't answered by then is reported as having no updates. It is left
+# running in its daemon thread until it returns or the process exits: a
+# dnf check keeps its half-loaded sack (the session moves on without it),
+# a Flatpak check keeps its remote connections, and a user check keeps
+# that user's helper busy until the call returns.
+CHECK_UPDATES_TIMEOUT = 300
+
+
+def check_updates(
+    return_texts: bool = False,
+    session: UpdateSession | None = None,
+    on_source: Callable[[str, str | None], Any] | None = None,
+    timeout: float = CHECK_UPDATES_TIMEOUT,
+) -> None | tuple[str | None, str | None, str | None]:
+    """Check dnf, user Flatpak and system Flatpak updates at the same time.
+
+    All three mostly wait on the network, so they run concurrently and the
+    check takes as long as the slowest one. on_source is called with the
+    source ("system", "flatpak_user" or "flatpak_system") and its text as
+    soon as that source is done.
+    """
     global updates_available
     global system_updates_available
     global flatpak_updates_available
@@ -462,55 +631,87 @@ def check_updates(return_texts: bool = False) -> None | tuple[str | None, str |
     system_updates_available = 0
     flatpak_updates_available = 0
 
-    sys_update_text = None
-    fp_user_update_text = None
-    fp_sys_update_text = None
+    # Sets ORIG_USER and friends, do it before the threads start.
+    orig_user_uid, orig_user_gid = get_orig_user_ids()
 
-    # Get our system updates
-    package_names = updatechecker()
-    if package_names:
-        updates_available = 1
-        system_updates_available = 1
-        sys_update_text = "\n".join(package_names)
+    def system_source() -> str | None:
+        package_names = updatechecker(session=session)
+        return "\n".join(package_names) if package_names else None
+
+    def flatpak_user_source() -> str | None:
+        if all_users_mode:
+            results = run_for_users(user_flatpak_targets(), "fp_get_user_updates")
+            lines = []
+            for name in sorted(results):
+                if results[name] is None:
+                    logger.warning("Could not check Flatpak updates of user %s.", name)
+                lines.extend(f"{name}: {update}" for update in results[name] or [])
+            return "\n".join(lines) if lines else None
+        fp_user_updates = run_as_user(orig_user_uid, orig_user_gid, "fp_get_user_updates")
+        return "\n".join(fp_user_updates) if fp_user_updates else None
+
+    def flatpak_system_source() -> str | None:
+        fp_system_updates = fp_get_system_updates()
+        if not fp_system_updates:
+            return None
+        return "\n".join(
+            fp_system_update.get_appdata_name()
+            for fp_system_update in fp_system_updates
+            if fp_system_update.get_appdata_name() is not None
+        )
 
-    if is_running_with_sudo_or_pkexec() == 1:
-        sudo_user = os.environ.get('SUDO_USER', '')
-        if sudo_user and not sudo_user.isdigit():
-            try:
-                orig_user_uid = pwd.getpwnam(sudo_user).pw_uid
-                os.environ['ORIG_USER'] = str(orig_user_uid)
+    texts: dict[str, str | None] = {"system": None, "flatpak_user": None, "flatpak_system": None}
+    sources = {
+        "system": system_source,
+        "flatpak_user": flatpak_user_source,
+        "flatpak_system": flatpak_system_source,
+    }
+    finished: queue.Queue = queue.Queue()
 
-                original_user_home = pwd.getpwnam(sudo_user).pw_dir
-                os.environ['ORIGINAL_USER_HOME'] = str(original_user_home)
-            except KeyError:
-                print(f"User {sudo_user} not found")
+    def run(name: str, source: Callable[[], str | None]) -> None:
+        start = time.monotonic()
+        try:
+            finished.put((name, source(), None, time.monotonic() - start))
+        except Exception as e:
+            finished.put((name, None, e, time.monotonic() - start))
 
-    # Get the original user's UID and GID
-    orig_user = os.environ.get("ORIG_USER")
-    if orig_user is None:
-        orig_user = "0"
-    orig_user_uid = int(orig_user)
-    pw_record = pwd.getpwuid(orig_user_uid)
-    orig_user_gid = pw_record.pw_gid
+    # Daemon threads: a source that misses the deadline can't keep the
+    # process from exiting.
+    for name, source in sources.items():
+        threading.Thread(target=run, args=(name, source), name=f"check-{name}", daemon=True).start()
 
-    # Flatpak User Updates window
-    fp_user_updates = run_as_user(orig_user_uid, orig_user_gid, "fp_get_user_updates")
-    if fp_user_updates:
-        updates_available = 1
-        flatpak_updates_available = 1
-        fp_user_update_text = "\n".join(fp_user_updates)
-
-    # Flatpak System Updates window
-    fp_system_updates = fp_get_system_updates()
-    if fp_system_updates:
-        updates_available = 1
-        flatpak_updates_available = 1
-        fp_sys_update_texts = [
-            fp_system_update.get_appdata_name()
-            for fp_system_update in fp_system_updates
-            if fp_system_update.get_appdata_name() is not None
-        ]
-        fp_sys_update_text = "\n".join(fp_sys_update_texts)
+    deadline = time.monotonic() + timeout
+    pending = set(sources)
+    while pending:
+        try:
+            name, text, error, elapsed = finished.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        pending.discard(name)
+        if error is not None:
+            logger.error("Checking %s updates failed: %s", name.replace("_", " "), error)
+            continue
+        logger.info("Checked %s updates in %.1f s.", name.replace("_", " "), elapsed)
+        texts[name] = text
+        if text:
+            updates_available = 1
+            if name == "system":
+                system_updates_available = 1
+            else:
+                flatpak_updates_available = 1
+        if on_source is not None:
+            on_source(name, text)
+
+    for name in sorted(pending):
+        logger.warning("Checking %s updates timed out after %s s.", name.replace("_", " "), timeout)
+    if "system" in pending and session is not None:
+        # The dnf check still holds the session's lock, the fixups and the
+        # install after this load a new sack instead of waiting for it.
+        session.abandon()
+
+    sys_update_text = texts["system"]
+    fp_user_update_text = texts["flatpak_user"]
+    fp_sys_update_text = texts["flatpak_system"]
 
     if is_running_with_sudo_or_pkexec() == 1:
         if sys_update_text:
@@ -531,6 +732,156 @@ def check_updates(return_texts: bool = False) -> None | tuple[str | None, str |
         return sys_update_text, fp_user_update_text, fp_sys_update_text
     return None
 
+# Set by --all-users: the user Flatpak steps cover every local user
+# instead of only the one who started nobara-sync.
+all_users_mode = False
+# How many users are handled at the same time in --all-users mode.
+USER_WORKERS = 4
+SIDELOAD_DIR = Path("/run/flatpak/sideload-repos")
+
+
+def get_local_users() -> list[pwd.struct_passwd]:
+    users = []
+    for user in pwd.getpwall():
+        if user.pw_uid < 1000 or user.pw_uid == 65534:  # system users, nobody
+            continue
+        if user.pw_shell.endswith(("nologin", "false")) or not Path(user.pw_dir).is_dir():
+            continue
+        users.append(user)
+    return users
+
+
+def user_flatpak_targets() -> list[tuple[str, int, int]]:
+    """(name, uid, gid) of the users whose Flatpaks are checked/updated."""
+    if all_users_mode:
+        return [(user.pw_name, user.pw_uid, user.pw_gid) for user in get_local_users()]
+    orig_user_uid, orig_user_gid = get_orig_user_ids()
+    return [(pwd.getpwuid(orig_user_uid).pw_name, orig_user_uid, orig_user_gid)]
+
+
+def run_for_users(
+    users: list[tuple[str, int, int]], func_name: str, option: str = ""
+) -> dict[str, Any]:
+    """Run a shared function as each user, in parallel, each in its own
+    privilege-dropped helper. None for a user means it failed."""
+    results: dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(users), USER_WORKERS))) as executor:
+        jobs = {
+            executor.submit(run_as_user, uid, gid, func_name, option): name
+            for name, uid, gid in users
+        }
+        for job in as_completed(jobs):
+            try:
+                results[jobs[job]] = job.result()
+            except Exception as e:
+                logger.error("%s failed for user %s: %s", func_name, jobs[job], e)
+                results[jobs[job]] = None
+    return results
+
+
+def prefetch_shared_flatpak_refs(pending: dict[str, list[dict[str, str]] | None]) -> bool:
+    """Pull updates that several users are waiting for once, into the
+    system repo, without deploying them.
+
+    Only refs from remotes with a collection ID that the system
+    installation also has can be shared: the system repo is then offered
+    as a sideload repo (see flatpak_sideload()) and the users' pulls find
+    the objects there instead of downloading them again.
+    """
+    counts = Counter(
+        (ref["ref"], ref["url"], ref["collection_id"], ref["commit"])
+        for refs in pending.values() if refs
+        for ref in refs
+        if ref["collection_id"] and ref["commit"]
+    )
+    shared = [key for key, count in counts.items() if count > 1]
+    if not shared:
+        return False
+
+    system_installation = Flatpak.Installation.new_system(None)
+    remotes = {
+        (remote.get_url(), remote.get_collection_id()): remote.get_name()
+        for remote in system_installation.list_remotes(None)
+        if remote.get_collection_id()
+    }
+    installed = {ref.format_ref() for ref in system_installation.list_installed_refs(None)}
+    transaction = Flatpak.Transaction.new_for_installation(system_installation)
+    transaction.set_no_deploy(True)
+    # The users' own lists already name every runtime and extension they need.
+    transaction.set_disable_dependencies(True)
+    transaction.set_disable_related(True)
+    added = 0
+    for ref, url, collection_id, commit in shared:
+        remote_name = remotes.get((url, collection_id))
+        if remote_name is None:
+            continue
+        # The users' pulls only find the objects of the commit their check
+        # matched, the remote may have moved on since.
+        try:
+            if ref in installed:
+                transaction.add_update(ref, None, commit)
+            else:
+                parsed = Flatpak.Ref.parse(ref)
+                latest = system_installation.fetch_remote_ref_sync(
+                    remote_name,
+                    parsed.get_kind(),
+                    parsed.get_name(),
+                    parsed.get_arch(),
+                    parsed.get_branch(),
+                    None,
+                ).get_commit()
+                if latest != commit:
+                    logger.info("Not sharing %s between users, the remote has a newer commit.", ref)
+                    continue
+                transaction.add_install(remote_name, ref, None)
+            added += 1
+        except GLib.GError as e:
+            logger.warning("Not sharing %s between users: %s", ref, e)
+    if not added:
+        return False
+
+    logger.info("Downloading %s Flatpak updates shared by several users once...", added)
+    transfers = FlatpakTransferMonitor(logger, transaction, "shared")
+    try:
+        transaction.run()
+    except GLib.GError as e:
+        logger.warning("Could not download shared Flatpak updates: %s", e)
+        return False
+    transfers.report()
+    return True
+
+
+def drop_shared_flatpak_refs() -> None:
+    """Remove what prefetch_shared_flatpak_refs() pulled into the system
+    repo once the users have deployed it, with or without --maintenance."""
+    system_installation = Flatpak.Installation.new_system(None)
+    try:
+        system_installation.cleanup_local_refs_sync(None)
+        system_installation.prune_local_repo(None)
+    except GLib.GError as e:
+        logger.warning("Could not clean up shared Flatpak downloads: %s", e)
+
+
+@contextlib.contextmanager
+def flatpak_sideload(repo: Path):
+    """Offer an OSTree repo to every Flatpak pull while in the block."""
+    link = SIDELOAD_DIR / "nobara-updater"
+    try:
+        SIDELOAD_DIR.mkdir(parents=True, exist_ok=True)
+        if link.is_symlink():
+            link.unlink()
+        link.symlink_to(repo)
+        linked = True
+    except OSError as e:
+        logger.warning("Could not set up Flatpak sideload repo: %s", e)
+        linked = False
+    try:
+        yield
+    finally:
+        if linked:
+            link.unlink(missing_ok=True)
+
+
 def fp_get_system_updates() -> list[Flatpak.Ref] | None:
     # Get our flatpak updates
     with fp_system_installation_list(Flatpak.Installation.new_system(None)) as flatpak_sys_updates:
@@ -559,76 +910,48 @@ def get_orig_user_ids() -> tuple[int, int]:
 #return False if uki is detected based on bootctl. Return True in cases where calls fail or image_type is split.
 #primarily to avoid crash later
 def kernel_image_supported() -> bool:
-    try:
-        kernel_image = subprocess.run(
-            "bootctl --print-stub-path",
-            shell=True,
-            capture_output=True,
-            text=True, encoding="utf-8", errors="replace",
-            check=True
-        )
-        image_type = subprocess.run(
-                f"bootctl kernel-identify {kernel_image.stdout.strip()}",
-                shell=True,
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace",
-                check=True
-        )
-        if image_type == "uki":
-            logger.info("Upgrade of unsupported kernel install detected. You are on your own.")
-            return False
-        else:
-            return True
-    except subprocess.CalledProcessError:
-        return True
+    if boot_image_type() == "uki":
+        logger.info("Upgrade of unsupported kernel install detected. You are on your own.")
+        return False
+    return True
 
 
-def install_system_updates_only() -> bool:
+def install_system_updates_only(session: UpdateSession | None = None) -> bool:
     global perform_kernel_actions
     global perform_reboot_request
 
-    package_names = updatechecker()
+    if session is None:
+        session = UpdateSession(logger)
+    package_names = updatechecker(session=session)
     success = True
 
     logger.info("Starting SYSTEM package updates, please do not turn off your computer...\n")
     if package_names:
         logger.info("Upgrading packages:\n%s", "\n".join(package_names))
-        success = run_system_upgrade_transaction(logger)
+        success = run_system_upgrade_transaction(logger, session)
         if not success:
             logger.error("DNF System Updates failed!")
 
+    kernels = KernelInventory(logger, get_installed_index())
     # Perform dracut if kernel was updated.
     if perform_kernel_actions == 1:
         supported = kernel_image_supported()
         if supported:
             logger.info(
-                "Kernel or kernel module updates were performed. Running required 'dracut -f'...\n"
+                "Kernel or kernel module updates were performed. Checking which initramfs images need 'dracut -f'...\n"
             )
-            try:
-                result = subprocess.run(
-                    "ls /boot/ | grep vmlinuz | grep -v rescue",
-                    shell=True,
-                    capture_output=True,
-                    text=True, encoding="utf-8", errors="replace",
-                    check=True,
-                )
-                lines = result.stdout.strip().split("\n")
-                versions = [line.replace("vmlinuz-", "") for line in lines if line.startswith("vmlinuz-")]
-
-                result = subprocess.run(["ls", "/lib/modules"], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-                modules = result.stdout.strip().split()
-
-                filtered_modules = [module for module in modules if module not in versions]
-                for directory in filtered_modules:
-                    if directory:
-                        dir_path = os.path.join("/lib/modules", directory)
-                        if os.path.exists(dir_path):
-                            shutil.rmtree(dir_path)
-            except subprocess.CalledProcessError as e:
-                print(f"An error occurred: {e}")
-
-            subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+            kernels.remove_orphaned_modules()
+            # Whatever the kernel-install hooks didn't build, before the
+            # initramfs picks the modules up.
+            DkmsBuilder(logger).build(kernels.versions())
+            initramfs.request("kernel or kernel module updates")
         perform_reboot_request = 1
+        if kernels.reboot_needed():
+            logger.info("Kernel %s is installed, %s is running.", kernels.latest(), kernels.booted)
+
+    # Also builds what the fixups asked for, once.
+    if not initramfs.regenerate(kernels):
+        success = False
 
     # Send update refresh request to systray service
     orig_user_uid, orig_user_gid = get_orig_user_ids()
@@ -652,11 +975,23 @@ def install_flatpak_updates_only() -> None:
 
     orig_user_uid, orig_user_gid = get_orig_user_ids()
 
-    # system flatpaks
-    install_system_flatpak_updates()
-
-    # user flatpaks
-    run_as_user(orig_user_uid, orig_user_gid, "install_user_flatpak_updates")
+    if all_users_mode:
+        install_all_users_flatpak_updates()
+    else:
+        # The system and user installations are separate repos, so both
+        # transactions run at the same time.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            jobs = {
+                executor.submit(install_system_flatpak_updates): "system",
+                executor.submit(
+                    run_as_user, orig_user_uid, orig_user_gid, "install_user_flatpak_updates"
+                ): "user",
+            }
+            for job in as_completed(jobs):
+                try:
+                    job.result()
+                except Exception as e:
+                    logger.error("Flatpak %s updates failed: %s", jobs[job], e)
 
     # refresh systray
     run_as_user(orig_user_uid, orig_user_gid, "yumex_sync_updates")
@@ -664,12 +999,77 @@ def install_flatpak_updates_only() -> None:
     logger.info("Flatpak updates complete!\n")
 
 
+def install_all_users_flatpak_updates() -> None:
+    users = user_flatpak_targets()
+    logger.info("Updating Flatpaks of %s users: %s", len(users), ", ".join(name for name, _, _ in users))
+    pending = run_for_users(users, "fp_get_user_update_refs")
+    shared = prefetch_shared_flatpak_refs(pending)
+
+    system_repo = Path(Flatpak.Installation.new_system(None).get_path().get_path()) / "repo"
+    with flatpak_sideload(system_repo), ThreadPoolExecutor(max_workers=2) as executor:
+        system_job = executor.submit(install_system_flatpak_updates)
+        waiting = [(name, uid, gid) for name, uid, gid in users if pending.get(name)]
+        results = run_for_users(waiting, "install_user_flatpak_updates")
+        try:
+            system_job.result()
+        except Exception as e:
+            logger.error("Flatpak system updates failed: %s", e)
+    if shared:
+        drop_shared_flatpak_refs()
+
+    for name, _, _ in users:
+        if pending.get(name) is None:
+            logger.warning("%s: could not check Flatpak updates.", name)
+        elif not pending[name]:
+            logger.info("%s: Flatpaks up to date.", name)
+        elif results.get(name) is None:
+            logger.error("%s: Flatpak updates failed.", name)
+        else:
+            logger.info("%s: %s Flatpak updates installed.", name, results[name])
+
+
+def flatpak_maintenance(after_updates: bool = False) -> None:
+    """Remove unused Flatpak runtimes and prune the repos of the system
+    installation and of each user installation."""
+    logger.info("Running Flatpak maintenance...")
+    users = user_flatpak_targets()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        system_job = executor.submit(
+            maintain_flatpak_installation,
+            Flatpak.Installation.new_system(None),
+            logger.info,
+            after_updates,
+        )
+        user_results = run_for_users(
+            users, "maintain_user_flatpaks", "after-updates" if after_updates else ""
+        )
+        try:
+            results = {"system": system_job.result()}
+        except Exception as e:
+            logger.error("Flatpak maintenance of the system installation failed: %s", e)
+            results = {}
+    results.update(user_results)
+
+    reclaimed = 0
+    for name, result in sorted(results.items()):
+        if result is None:
+            logger.error("%s: Flatpak maintenance failed.", name)
+            continue
+        reclaimed += result["reclaimed"]
+        logger.info(
+            "%s: removed %s unused refs, reclaimed %.1f MB in %.1f s.",
+            name, len(result["removed"]), result["reclaimed"] / 1_000_000, result["seconds"],
+        )
+    logger.info("Flatpak maintenance complete, %.1f MB reclaimed.\n", reclaimed / 1_000_000)
+
+
 def install_system_flatpak_updates() -> None:
     # System installation updates
     system_installation = Flatpak.Installation.new_system(None)
     with fp_system_installation_list(system_installation) as flatpak_sys_updates:
         if flatpak_sys_updates is not None:
             transaction = Flatpak.Transaction.new_for_installation(system_installation)
+            transfers = FlatpakTransferMonitor(logger, transaction)
             for ref in flatpak_sys_updates:
                 logger.info(
                     "Updating %s for system installation...", ref.get_appdata_name()
@@ -680,9 +1080,71 @@ def install_system_flatpak_updates() -> None:
                 except Exception as e:
                     logger.error("Error updating %s: %s", ref.get_appdata_name(), e)
             transaction.run()
+            transfers.report()
             logger.info("Flatpak System Updates complete!")
     del system_installation
 
+def prefetch_system_flatpak_updates() -> None:
+    # Pull only: the objects land in the system repo, nothing is deployed
+    # until install_system_flatpak_updates() runs.
+    system_installation = Flatpak.Installation.new_system(None)
+    with fp_system_installation_list(system_installation) as flatpak_sys_updates:
+        if flatpak_sys_updates:
+            transaction = Flatpak.Transaction.new_for_installation(system_installation)
+            transaction.set_no_deploy(True)
+            transfers = FlatpakTransferMonitor(logger, transaction)
+            for ref in flatpak_sys_updates:
+                try:
+                    transaction.add_update(ref.format_ref(), None, None)
+                except Exception as e:
+                    logger.error("Error prefetching %s: %s", ref.get_appdata_name(), e)
+            transaction.run()
+            transfers.report()
+            logger.info("Flatpak System Updates prefetched.")
+    del system_installation
+
+
+def spawn_prefetch(download_profile: str | None = None, throttle: str | None = None) -> None:
+    # Detached, so check-updates returns right away.
+    command = [sys.executable, str(Path(__file__).resolve()), "prefetch"]
+    if download_profile:
+        command += ["--download-profile", download_profile]
+    if throttle:
+        command += ["--throttle", throttle]
+    subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    logger.info("Downloading updates in the background...")
+
+
+def lower_priority() -> None:
+    # Idle CPU and IO priority. Children, including the user Flatpak
+    # process, inherit it.
+    os.nice(19)
+    subprocess.run(
+        ["ionice", "-c", "3", "-p", str(os.getpid())],
+        capture_output=True, text=True, encoding="utf-8", errors="replace",
+    )
+
+
+def prefetch_updates(session: UpdateSession | None = None) -> None:
+    # This must never get in the user's way.
+    lower_priority()
+
+    try:
+        prefetch_system_upgrade(logger, session)
+    except Exception as e:
+        logger.error("Package prefetch failed: %s", e)
+
+    prefetch_system_flatpak_updates()
+    orig_user_uid, orig_user_gid = get_orig_user_ids()
+    run_as_user(orig_user_uid, orig_user_gid, "prefetch_user_flatpak_updates")
+
+
 class fp_system_installation_list(object):
     # Generates flatpak_system_updates for other functions with error handling
     def __init__(self, system_installation):
@@ -690,19 +1152,11 @@ class fp_system_installation_list(object):
 
 
     def __enter__(self):
-        flatpak_system_updates = None
-        error = True # No do-while in Python so init to true to run loop once
-        while error:
-            try:
-                flatpak_system_updates = self.system_installation.list_installed_refs_for_update(None)
-            except gi.repository.GLib.GError as e:
-                # Expected, see #43
-                logger.error(e)
-            except:
-                raise
-            else:
-                error = False
-        return flatpak_system_updates
+        try:
+            return list_flatpak_updates(self.system_installation, logger.warning, "flatpak-system.json")
+        except gi.repository.GLib.GError as e:
+            logger.error("Error getting Flatpak system updates: %s", e)
+            return []
 
 
     def __exit__(self, *args):
@@ -717,7 +1171,11 @@ def button_ensure_sensitivity(
     if current_state != desired_state:
         widget.set_sensitive(desired_state)
 
-def install_fixups() -> None:
+def install_fixups(
+    session: UpdateSession | None = None,
+    regenerate_initramfs: bool = True,
+    only: list[str] | None = None,
+) -> None:
     global perform_kernel_actions
     global perform_reboot_request
     global fixups_available
@@ -729,13 +1187,18 @@ def install_fixups() -> None:
 
     # Run quirks.py and get the values
     logger.info("Running quirk fixup")
-    quirk_fixup = QuirkFixup(logger)
+    quirk_fixup = QuirkFixup(logger, session, initramfs)
     (
         perform_kernel_actions,
         perform_reboot_request,
         fixups_available,
         perform_refresh,
-    ) = quirk_fixup.system_quirk_fixup()
+    ) = quirk_fixup.system_quirk_fixup(only)
+
+    # Pass False when installing updates next, they build the initramfs
+    # images once for both. The relaunch below would forget the requests.
+    if regenerate_initramfs or perform_refresh == 1:
+        initramfs.regenerate()
 
     # Perform final refresh after making core fixes before updating the rest of the packages.
     if perform_refresh == 1:
@@ -749,7 +1212,7 @@ def install_fixups() -> None:
 
     if fixups_available == 1:
         logger.info("Problems with Media Packages detected, repairing...")
-        prompt_media_fixup()
+        prompt_media_fixup(session)
 
     if is_running_with_sudo_or_pkexec() == 1:
         sudo_user = os.environ.get('SUDO_USER', '')
@@ -777,8 +1240,8 @@ def install_fixups() -> None:
     )
 
 
-def install_updates() -> bool:
-    success = install_system_updates_only()
+def install_updates(session: UpdateSession | None = None) -> bool:
+    success = install_system_updates_only(session)
     install_flatpak_updates_only()
     return success
 
@@ -818,66 +1281,14 @@ def attempt_distro_sync() -> None:
         logger.error(f"dnf distro-sync failed: {e}")
         return
     # Cleanup old modules
-    try:
-        # Run the command and capture the output
-        result = subprocess.run(
-            "ls /boot/ | grep vmlinuz | grep -v rescue",
-            shell=True,
-            capture_output=True,
-            text=True, encoding="utf-8", errors="replace",
-            check=True
-        )
-        logger.info("Found kernel versions:\n" + result.stdout)
-
-        # Split the output into lines
-        lines = result.stdout.strip().split('\n')
-
-        # Extract version numbers by removing 'vmlinuz-' prefix
-        versions = [line.replace('vmlinuz-', '') for line in lines if line.startswith('vmlinuz-')]
-        logger.info("Kernel versions to keep: " + ", ".join(versions))
-
-        # Run the ls command and capture the output
-        result = subprocess.run(
-            ['ls', '/lib/modules'],
-            capture_output=True,
-            text=True, encoding="utf-8", errors="replace",
-            check=True
-        )
-        logger.info("Found module directories:\n" + result.stdout)
-
-        # Split the output into entries
-        modules = result.stdout.strip().split()
-
-        # Filter modules that do not match the kernel versions
-        filtered_modules = [module for module in modules if module not in versions]
-        logger.info("Modules to remove: " + ", ".join(filtered_modules))
-
-        # Remove filtered modules
-        for directory in filtered_modules:
-            if directory:  # Check if directory is not None or empty
-                dir_path = os.path.join('/lib/modules', directory)
-                if os.path.exists(dir_path):  # Check if the path exists
-                    shutil.rmtree(dir_path)
-                    logger.info(f"Removed module directory: {dir_path}")
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"An error occurred: {e}")
-        return
+    kernels = KernelInventory(logger, get_installed_index())
+    logger.info("Kernel versions to keep: " + ", ".join(kernels.versions()))
+    kernels.remove_orphaned_modules()
 
-    # Run the commands
-    try:
-        result = subprocess.run(
-            ["dracut", "-f","--regenerate-all"],
-            capture_output=True,
-            text=True, encoding="utf-8", errors="replace",
-            check=True
-        )
-        logger.info("dracut output:\n" + result.stdout)
-        logger.info("Distro-sync completed successfully")
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error running dracut: {e}")
+    initramfs.request("distro-sync", force=True)
+    if not initramfs.regenerate(kernels):
         return
+    logger.info("Distro-sync completed successfully")
 
     try:
         os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -887,13 +1298,13 @@ def attempt_distro_sync() -> None:
         logger.error(f"Failed to relaunch script: {e}")
         self.status_label_updates("Failed to relaunch script")
 
-def prompt_media_fixup() -> None:
+def prompt_media_fixup(session: UpdateSession | None = None) -> None:
     global media_fixup_event
     media_fixup_event.set()
-    media_fixup()
+    media_fixup(session)
     media_fixup_event.wait()
 
-def media_fixup() -> None:
+def media_fixup(session: UpdateSession | None = None) -> None:
     global fixups_available
     global media_fixup_event
     hard_removal = [
@@ -945,42 +1356,28 @@ def media_fixup() -> None:
     combined_removal = hard_removal + soft_removal
     indented_combined_removal = ["    " + line for line in combined_removal]
     logger.info("%s\n\n%s\n", action_log_string, chr(10).join(indented_combined_removal))
-    for package in hard_removal:
-        subprocess.run(
-            ["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
+    # Everything below goes into one plan: a single `rpm -e --nodeps` for
+    # the erasures and one transaction for the rest.
+    plan = TransactionPlan(logger, session)
+    plan.erase_nodeps(hard_removal)
 
-    soft_removal_list = []
-    for package in soft_removal:
-        removal_check = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if removal_check.returncode == 0:
-            soft_removal_list.append(package)
-    if soft_removal_list:
-        PackageUpdater(soft_removal_list, "remove", None)
+    installed = get_installed_index()
 
-    vulkan_standard_installed = 0
-    vulkan_git_installed = 0
-    for package in vulkan_standard:
-        removal_check_vulkan = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if removal_check_vulkan.returncode == 0:
-            subprocess.run(
-                ["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            vulkan_standard_installed = 1
+    soft_removal_list = [
+        package for package in soft_removal if installed.is_installed(package)
+    ]
+    if soft_removal_list:
+        plan.remove(soft_removal_list)
 
-    for package in vulkan_git:
-        removal_check_vulkan_git = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if removal_check_vulkan_git.returncode == 0:
-            subprocess.run(
-                ["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            vulkan_git_installed = 1
+    vulkan_standard_present = [
+        package for package in vulkan_standard if installed.is_installed(package)
+    ]
+    vulkan_git_present = [
+        package for package in vulkan_git if installed.is_installed(package)
+    ]
+    vulkan_standard_installed = 1 if vulkan_standard_present else 0
+    vulkan_git_installed = 1 if vulkan_git_present else 0
+    plan.erase_nodeps(vulkan_standard_present + vulkan_git_present)
 
     install = [
         "mesa-libgallium-freeworld.x86_64",
@@ -1030,44 +1427,42 @@ def media_fixup() -> None:
     action_log_string = "Performing clean media package installation..."
     indented_install = ["    " + line for line in install]
     logger.info("%s\n\n%s\n", action_log_string, chr(10).join(indented_install))
-    install_list = []
-    for package in install:
-        install_check = subprocess.run(
-            ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if install_check.returncode != 0:
-            install_list.append(package)
+    # The index still shows the state before the erasures.
+    install_list = [
+        package for package in install
+        if plan.removes(package) or not installed.is_installed(package)
+    ]
 
     if install_list:
-        PackageUpdater(install_list, "install", None)
+        plan.install(install_list)
 
     if vulkan_standard_installed == 1:
         vulkan_standard_freeworld = [
             "mesa-vulkan-drivers-freeworld.x86_64",
             "mesa-vulkan-drivers-freeworld.i686",
         ]
-        PackageUpdater(vulkan_standard_freeworld, "install", None)
+        plan.install(vulkan_standard_freeworld)
 
     if vulkan_git_installed == 1:
         vulkan_git_freeworld = [
             "mesa-vulkan-drivers-git-freeworld.x86_64",
             "mesa-vulkan-drivers-git-freeworld.i686",
         ]
-        PackageUpdater(vulkan_git_freeworld, "install", None)
+        plan.install(vulkan_git_freeworld)
 
-    vulkan_install_check_standard_freeworld = subprocess.run(
-        ["rpm", "-q", "mesa-vulkan-drivers-freeworld"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-    )
-    vulkan_install_check_git_freeworld = subprocess.run(
-        ["rpm", "-q", "mesa-vulkan-drivers-git-freeworld"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-    )
-    if vulkan_standard_installed == 0 and vulkan_git_installed == 0 and vulkan_install_check_standard_freeworld.returncode != 0 and vulkan_install_check_git_freeworld.returncode != 0:
+    if (
+        vulkan_standard_installed == 0
+        and vulkan_git_installed == 0
+        and not installed.is_installed("mesa-vulkan-drivers-freeworld")
+        and not installed.is_installed("mesa-vulkan-drivers-git-freeworld")
+    ):
         vulkan_standard_freeworld = [
             "mesa-vulkan-drivers-freeworld.x86_64",
             "mesa-vulkan-drivers-freeworld.i686",
         ]
-        PackageUpdater(vulkan_standard_freeworld, "install", None)
+        plan.install(vulkan_standard_freeworld)
 
+    plan.commit()
     fixups_available = 0
 
 def prompt_reboot() -> None:
@@ -1078,14 +1473,73 @@ def parse_args() -> argparse.Namespace:
 
     subparsers = parser.add_subparsers(dest="command")
 
+    download_options = argparse.ArgumentParser(add_help=False)
+    download_options.add_argument(
+        "--download-profile",
+        choices=DOWNLOAD_PROFILES,
+        help="auto: tune parallel downloads from the measured throughput of earlier runs; "
+        "max: as many parallel downloads as dnf allows; "
+        "background: few parallel downloads, limited bandwidth and idle priority",
+    )
+    download_options.add_argument(
+        "--throttle",
+        help="Bandwidth limit, as for the dnf throttle option (e.g. 2M or 50%%)",
+    )
+
+    all_users_option = argparse.ArgumentParser(add_help=False)
+    all_users_option.add_argument(
+        "--all-users",
+        action="store_true",
+        help="Check and update the user Flatpaks of every local user, not only your own",
+    )
+
+    kernel_option = argparse.ArgumentParser(add_help=False)
+    kernel_option.add_argument(
+        "--keep-kernels",
+        type=int,
+        metavar="N",
+        help="Keep the N newest kernels plus the running one and the last other kernel that booted, "
+        "and remove older kernels in the same transaction as the updates",
+    )
+
+    maintenance_option = argparse.ArgumentParser(add_help=False)
+    maintenance_option.add_argument(
+        "--maintenance",
+        action="store_true",
+        help="After the Flatpak updates, remove unused runtimes and prune the Flatpak repos",
+    )
+
     subparsers.add_parser(
         "install-updates",
+        parents=[download_options, all_users_option, maintenance_option, kernel_option],
         help="Performs check-updates, install-fixups, then installs any updates available.",
     )
-    subparsers.add_parser("check-updates", help="Check for new updates and fixups.")
-    subparsers.add_parser("repair", help="Attempts repair using distro-sync.")
+    check_parser = subparsers.add_parser(
+        "check-updates",
+        parents=[download_options, all_users_option, kernel_option],
+        help="Check for new updates and fixups.",
+    )
+    check_parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Download found updates in the background so installing them later is faster",
+    )
     subparsers.add_parser(
-        "install-fixups", help="Performs a series of known problem fixes."
+        "repair", parents=[download_options], help="Attempts repair using distro-sync."
+    )
+    fixups_parser = subparsers.add_parser(
+        "install-fixups", parents=[download_options], help="Performs a series of known problem fixes."
+    )
+    fixups_parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only show which fixups would run, without changing anything",
+    )
+    fixups_parser.add_argument(
+        "--quirk",
+        action="append",
+        metavar="NAME",
+        help="Only run the named fixup, can be given more than once",
     )
     subparsers.add_parser(
         "install-codecs",
@@ -1093,6 +1547,7 @@ def parse_args() -> argparse.Namespace:
     )
     cli_parser = subparsers.add_parser(
         "cli",
+        parents=[download_options, all_users_option, maintenance_option, kernel_option],
         help="Run in CLI mode. Installs system updates and fixups by default; use --all to also install Flatpak updates.",
     )
     cli_parser.add_argument("username", help="Specify the username", nargs="?")
@@ -1103,6 +1558,21 @@ def parse_args() -> argparse.Namespace:
     )
 
     subparsers.add_parser("check-repos", help="list enabled repo information")
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        parents=[download_options],
+        help="Download pending system and Flatpak updates without installing them.",
+    )
+    prefetch_parser.set_defaults(download_profile="background")
+    subparsers.add_parser(
+        "rank-mirrors",
+        help="Measure repo mirrors, flag stale ones and prefer the fastest fresh ones.",
+    )
+    subparsers.add_parser(
+        "maintenance",
+        parents=[all_users_option],
+        help="Remove unused Flatpak runtimes and prune the Flatpak repos, e.g. from a timer.",
+    )
 
     argv = sys.argv[1:]
     known_commands = {
@@ -1113,6 +1583,9 @@ def parse_args() -> argparse.Namespace:
         "install-codecs",
         "cli",
         "check-repos",
+        "rank-mirrors",
+        "prefetch",
+        "maintenance",
     }
 
     if argv and argv[0] not in known_commands and argv[0] not in {"-h", "--help"}:
@@ -1124,6 +1597,8 @@ def parse_args() -> argparse.Namespace:
 
 def check_root_privileges(args: Namespace) -> None:
     if args.command == "cli" and args.username:
+        import psutil
+
         try:
             # Get the parent process ID (PPID)
             ppid = os.getppid()
@@ -1223,16 +1698,26 @@ def cleanup_xhost():
             pass
 
 def main() -> None:
+    global all_users_mode
 
     args = parse_args()
     check_manual_sudo()
     check_root_privileges(args)
 
-    if args.command and os.geteuid() == 0:
+    if args.command == "install-fixups" and args.plan and os.geteuid() == 0:
+        # A quick local report: no notices download, no dnf session, only
+        # the quirks and the cached update check.
+        load_quirks()
         initialize_logging()
+        QuirkFixup(logger, None, initramfs).plan_report(args.quirk)
+        exit(0)
+    if args.command and os.geteuid() == 0:
+        load_runtime(args.command)
+        initialize_logging(log_to_file=args.command != "prefetch")
         logger.info("Running CLI mode...")
         # Display updates.txt content
         try:
+            load_requests()
             response = requests.get("https://updates.nobaraproject.org/updates.txt", timeout=5)
             if response.status_code == 200:
                 content = response.text
@@ -1247,60 +1732,103 @@ def main() -> None:
         except Exception as e:
             error_message = f"Error fetching updates: {str(e)}"
             print(error_message)
+        download_profile = resolve_download_profile(
+            getattr(args, "download_profile", None), getattr(args, "throttle", None)
+        )
+        if download_profile is not None:
+            logger.info(
+                "Download profile %s: %s parallel downloads, bandwidth limit %s.",
+                download_profile.name,
+                download_profile.max_parallel_downloads or "default",
+                download_profile.throttle or "none",
+            )
+            if download_profile.idle and args.command != "prefetch":
+                lower_priority()
+        all_users_mode = getattr(args, "all_users", False)
+        # One libdnf5 sack for the whole run: check -> fixups -> install -> recheck.
+        session = None
+        if UpdateSession is not None:
+            session = UpdateSession(
+                logger,
+                download_profile=download_profile,
+                keep_kernels=getattr(args, "keep_kernels", None),
+            )
         if args.command == "install-updates":
             check_repos()
-            check_updates()
-            install_fixups()
-            success = install_updates()  # all (system + flatpak)
-            check_updates()
+            check_updates(session=session)
+            install_fixups(session, regenerate_initramfs=False)
+            success = install_updates(session)  # all (system + flatpak)
+            if args.maintenance:
+                flatpak_maintenance(after_updates=True)
+            check_updates(session=session)
             request_update_status()
             exit(0 if success else 1)
         if args.command == "cli":
             check_repos()
-            check_updates()
-            install_fixups()
-            success = install_system_updates_only()
+            check_updates(session=session)
+            install_fixups(session, regenerate_initramfs=False)
+            success = install_system_updates_only(session)
 
             if args.all:
                 install_flatpak_updates_only()
+                if args.maintenance:
+                    flatpak_maintenance(after_updates=True)
 
-            check_updates()
+            check_updates(session=session)
             request_update_status()
             exit(0 if success else 1)
         if args.command == "install-codecs":
-            prompt_media_fixup()
+            prompt_media_fixup(session)
             exit(0)
         if args.command == "install-fixups":
-            check_updates()
-            install_fixups()
-            check_updates()
+            check_updates(session=session)
+            install_fixups(session, only=args.quirk)
+            check_updates(session=session)
             request_update_status()
             exit(0)
         if args.command == "repair":
-            check_updates()
+            check_updates(session=session)
             attempt_distro_sync()
-            check_updates()
+            check_updates(session=session)
             request_update_status()
             exit(0)
         if args.command == "check-updates":
-            check_updates()
+            check_updates(session=session)
             request_update_status()
+            if args.prefetch and updates_available == 1:
+                spawn_prefetch(args.download_profile, args.throttle)
+            exit(0)
+        if args.command == "prefetch":
+            prefetch_updates(session)
             exit(0)
         if args.command == "check-repos":
             check_repos()
             exit(0)
+        if args.command == "maintenance":
+            # Not after updates: keep what a prefetch pulled for the next install.
+            flatpak_maintenance()
+            exit(0)
+        if args.command == "rank-mirrors":
+            logger.info("Ranking repository mirrors...\n")
+            rank_mirrors(
+                repoindex(),
+                {"releasever": VERSION_ID, "basearch": BASEARCH},
+                logger,
+            )
+            exit(0)
         if args.command and os.geteuid() == 0:
             initialize_logging()
             logger.info("Running CLI mode...")
     elif "DISPLAY" in os.environ and os.geteuid() == 0:
+        load_gui()
         try:
             if not Gtk.init_check():
                 logger.error("Failed to initialize GTK")
                 return 1
             update_window = UpdateWindow()
-            update_window.connect("destroy", Gtk.main_quit)
-            update_window.show_all()
-            update_window.present()
+            update_window.window.connect("destroy", Gtk.main_quit)
+            update_window.window.show_all()
+            update_window.window.present()
             Gtk.main()
         except RuntimeError as e:
             logger.error(f"GTK initialization error: {e}")
@@ -1311,9 +1839,11 @@ def main() -> None:
         exit(1)
 
 
-class UpdateWindow(Gtk.Window):  # type: ignore[misc]
+class UpdateWindow:
+    # Holds its Gtk.Window rather than subclassing it, so the class can be
+    # defined without GTK loaded.
     def __init__(self) -> None:
-        super().__init__(title="Update System")
+        self.window = Gtk.Window(title="Update System")
         if os.geteuid() == 0:
             if is_running_with_sudo_or_pkexec() == 1:
                 sudo_user = os.environ.get('SUDO_USER', '')
@@ -1343,8 +1873,8 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
 
 
         self.main_context = GLib.MainContext.default()
-        self.set_border_width(10)
-        self.set_default_size(900, 900)  # Set default window size
+        self.window.set_border_width(10)
+        self.window.set_default_size(900, 900)  # Set default window size
 
         # Create the notices text view and its scrolled window
         self.notices_textview = Gtk.TextView()
@@ -1506,7 +2036,7 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         grid.attach(self.open_log_button, 0, 11, 3, 1)
         grid.attach(self.open_log_button_dir, 0, 12, 3, 1)
         grid.attach(self.open_package_man_button, 0, 13, 3, 1)
-        self.add(grid)
+        self.window.add(grid)
 
         # Initialize the logger
         self.logger = initialize_logging(self.status_textview)
@@ -1522,9 +2052,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         self.status_label_updates("Starting SYSTEM package updates, please do not turn off your computer...")
-        self.textview_updates()
-        success = install_system_updates_only()
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
+        success = install_system_updates_only(session)
+        self.textview_updates(session)
         if success:
             self.status_label_updates("System updates complete!")
         else:
@@ -1540,9 +2071,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         self.status_label_updates("Starting FLATPAK updates, please do not turn off your computer...")
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
         install_flatpak_updates_only()
-        self.textview_updates()
+        self.textview_updates(session)
         self.status_label_updates("Flatpak updates complete!")
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
@@ -1577,30 +2109,30 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
             buffer.set_text(error_message)
             logger.error(error_message)
 
-    def textview_updates(self) -> None:
-        result = check_updates(return_texts=True)
-        if result is None:
-            result = "", "", ""
-        sys_update_text, fp_user_update_text, fp_sys_update_text = result
-
+    def textview_updates(self, session: UpdateSession | None = None) -> None:
         # Function to clear and insert text into a buffer
         def clear_and_insert_text(buffer, text):
             buffer.set_text("")  # Clear the buffer
             if text:
                 buffer.insert(buffer.get_end_iter(), text + "\n")
 
-        if result:
-            # Clear and insert text into the update buffer
-            update_buffer = self.update_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, update_buffer, sys_update_text)
+        textviews = {
+            "system": self.update_textview,
+            "flatpak_user": self.flatpak_user_textview,
+            "flatpak_system": self.flatpak_system_textview,
+        }
+        pending = set(textviews)
+
+        # Each pane is filled as soon as its source is done.
+        def on_source(name: str, text: str | None) -> None:
+            pending.discard(name)
+            GLib.idle_add(clear_and_insert_text, textviews[name].get_buffer(), text)
 
-            # Clear and insert text into the flatpak user buffer
-            user_buffer = self.flatpak_user_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, user_buffer, fp_user_update_text)
+        check_updates(session=session, on_source=on_source)
 
-            # Clear and insert text into the flatpak system buffer
-            system_buffer = self.flatpak_system_textview.get_buffer()
-            GLib.idle_add(clear_and_insert_text, system_buffer, fp_sys_update_text)
+        # Sources that failed or timed out have nothing to show.
+        for name in pending:
+            GLib.idle_add(clear_and_insert_text, textviews[name].get_buffer(), None)
 
     def status_label_updates(self, message: str) -> None:
         GLib.idle_add(
@@ -1613,9 +2145,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         self.status_label_updates("Starting package updates, please do not turn off your computer...")
-        self.textview_updates()
-        success = install_updates()
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
+        success = install_updates(session)
+        self.textview_updates(session)
         if success:
             self.status_label_updates("All Updates complete!")
         else:
@@ -1630,9 +2163,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
     def on_check_updates_button_clicked_async(self):
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
-        self.textview_updates()
-        install_fixups()
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
+        install_fixups(session)
+        self.textview_updates(session)
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         request_update_status()
@@ -1644,9 +2178,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         self.status_label_updates("Checking for various known problems to repair, please do not turn off your computer...")
-        self.textview_updates()
-        install_fixups()
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
+        install_fixups(session)
+        self.textview_updates(session)
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         request_update_status()
@@ -1671,9 +2206,10 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
         self.status_label_updates("Attempting repair using distro-sync...")
-        self.textview_updates()
+        session = UpdateSession(logger)
+        self.textview_updates(session)
         attempt_distro_sync()
-        self.textview_updates()
+        self.textview_updates(session)
         self.status_label_updates("Process complete!")
         toggle_refresh()
         GLib.idle_add(self.toggle_buttons_during_refresh)
@@ -1756,11 +2292,12 @@ class UpdateWindow(Gtk.Window):  # type: ignore[misc]
     def run_updater(self) -> None:
         toggle_refresh() # turn on perform-task toggle
         GLib.idle_add(self.toggle_buttons_during_refresh) # disable buttons
+        session = UpdateSession(logger)
         check_repos()
         self.status_label_updates("Checking for various known problems to repair, please do not turn off your computer...")
-        self.textview_updates()
-        install_fixups()
-        self.textview_updates()
+        self.textview_updates(session)
+        install_fixups(session)
+        self.textview_updates(session)
         toggle_refresh() # turn  off perform-task toggle
         GLib.idle_add(self.toggle_buttons_during_refresh) # enable buttons
         request_update_status()
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+
+# Pass as extra= for lines that only belong in the log file, e.g.
+# logger.info("...", extra=DETAIL). Handlers a person watches live skip
+# them via DetailFilter.
+DETAIL = {"detail": True}
+
+# Coalesced progress lines per second, at most.
+DEFAULT_MAX_RATE = 1.0
+
+
+class DetailFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not getattr(record, "detail", False)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class TransactionProgress:
+    """Coalesces per-element rpm callbacks into a few progress lines.
+
+    rpm reports every element, and the bytes of every element, many times
+    over. Each report is recorded here, and a summary line (percent, items
+    done, current package and ETA) is logged at most max_rate times per
+    second. The per-package lines go to the log file only.
+
+    Progress is measured in bytes where they are known (installs and
+    upgrades), items stand in for the rest, so a big package counts for
+    more than a small removal.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        total_items: int,
+        total_bytes: int = 0,
+        max_rate: float = DEFAULT_MAX_RATE,
+    ) -> None:
+        self.logger = logger
+        self.total_items = max(total_items, 1)
+        self.total_bytes = total_bytes
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_report = 0.0
+        self._items_done = 0
+        self._bytes_done = 0
+        self._current = ""
+        self._current_bytes = 0
+        self._current_index: int | None = None
+        self._last_percent = -1
+
+    def start_item(self, index: int, description: str) -> None:
+        with self._lock:
+            # rpm repeats the call for the element it is working on, only
+            # a new index finishes the previous one.
+            if index == self._current_index:
+                repeated = True
+            else:
+                repeated = False
+                self._current_index = index
+                self._items_done = max(self._items_done, index)
+                self._bytes_done += self._current_bytes
+                self._current_bytes = 0
+                self._current = description
+        if repeated:
+            self.report()
+            return
+        self.logger.info(
+            "    (%s/%s) %s", index + 1, self.total_items, description, extra=DETAIL
+        )
+        self.report()
+
+    def item_bytes(self, done: int) -> None:
+        with self._lock:
+            self._current_bytes = max(self._current_bytes, done)
+        self.report()
+
+    def fraction(self) -> float:
+        if self.total_bytes > 0:
+            done = self._bytes_done + self._current_bytes
+            return min(done / self.total_bytes, 1.0)
+        return min(self._items_done / self.total_items, 1.0)
+
+    def report(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.min_interval:
+                return
+            fraction = self.fraction()
+            percent = int(fraction * 100)
+            # Nothing moved since the last line, don't repeat it.
+            if not force and percent == self._last_percent and self._last_report:
+                return
+            self._last_report = now
+            self._last_percent = percent
+            items_done = self._items_done
+            current = self._current
+
+        elapsed = now - self._started
+        eta = ""
+        if 0.0 < fraction < 1.0 and elapsed > 1.0:
+            eta = f", ETA {format_duration(elapsed * (1.0 - fraction) / fraction)}"
+        self.logger.info(
+            "Progress: %s%% (%s/%s) %s%s", percent, items_done, self.total_items, current, eta
+        )
+
+    def finish(self) -> None:
+        with self._lock:
+            self._items_done = self.total_items
+            self._bytes_done = self.total_bytes
+            self._current_bytes = 0
+            self._current = "done"
+        self.report(force=True)
@@ -2,14 +2,17 @@
 import logging
 import threading
 import os
+import time
 import subprocess
 import shutil
 import shlex
 import pwd
 import re
 import glob
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import Callable, NamedTuple
 
 import gi  # type: ignore[import]
 from packaging.version import parse as parse_version
@@ -22,45 +25,244 @@ gi.require_version("Flatpak", "1.0")
 os.environ.setdefault("LANG", "C.UTF-8")
 os.environ.setdefault("LC_ALL", "C.UTF-8")
 
-from nobara_updater.dnf import PackageUpdater, updatechecker  # type: ignore[import]
+from nobara_updater.dnf import (  # type: ignore[import]
+    PackageUpdater,
+    TransactionPlan,
+    get_installed_index,
+    repo_enabled as dnf_repo_enabled,
+)
+from nobara_updater.dkms import DkmsBuilder  # type: ignore[import]
+from nobara_updater.freshness import refresh_args  # type: ignore[import]
+from nobara_updater.initramfs import InitramfsManager  # type: ignore[import]
+from nobara_updater.kernels import KernelInventory  # type: ignore[import]
+from nobara_updater.progress import DETAIL  # type: ignore[import]
+from nobara_updater.snapshot import SystemSnapshot  # type: ignore[import]
+
+CURRENT_RELEASE = 44
+FSYNC_TARGET_KERNEL = "6.12.11-204.nobara.fc41.x86_64"
+
+CRITICAL_PACKAGES = [
+    "fedora-gpg-keys",
+    "nobara-gpg-keys",
+    "nobara-repos",
+]
+RPMFUSION_PACKAGES = [
+    "rpmfusion-free-release",
+    "rpmfusion-nonfree-release",
+    "rpmfusion-free-release-tainted",
+    "rpmfusion-nonfree-release-tainted",
+    "rpmfusion-free-release-rawhide",
+    "rpmfusion-nonfree-release-rawhide",
+]
+PROBLEMATIC_PACKAGES = [
+    "qt5-qtwebengine-freeworld",
+    "qt6-qtwebengine-freeworld",
+    "qgnomeplatform-qt6",
+    "qgnomeplatform-qt5",
+    "okular5-libs",
+    "fedora-workstation-repositories",
+    "deckyloader",
+    "obs-studio-libs.i686",
+    "obs-studio-plugin-vkcapture.i686",
+    "obs-studio-plugin-source-record.i686"
+]
+PROBLEMATIC_2025_PACKAGES = [
+    "plasma-workspace-geolocation",
+    "plasma-workspace-geolocation-libs",
+    "rubberband.i686",
+    "python3-torch-rocm-gfx9",
+    "python3-torchaudio-rocm-gfx9",
+    "tesseract.i686",
+    "kdelibs-webkit",
+    "kate4-part",
+    "kde-style-breeze",
+    "libpostproc-free.x86_64",
+    "libpostproc-free.i686"
+]
+
+
+class Quirk(NamedTuple):
+    name: str
+    description: str
+    # Whether the quirk may have something to do. Only reads the snapshot,
+    # so all of them can be evaluated at once; the quirk itself still
+    # checks the details before changing anything.
+    applies: Callable[[SystemSnapshot], bool]
+    run: Callable[["QuirkFixup", SystemSnapshot], None]
+
+
+# In the order they run, see the @quirk methods of QuirkFixup.
+QUIRKS: list[Quirk] = []
+
+
+def quirk(name: str, description: str, applies: Callable[[SystemSnapshot], bool] = lambda snapshot: True):
+    def register(run: Callable[["QuirkFixup", SystemSnapshot], None]):
+        QUIRKS.append(Quirk(name, description, applies, run))
+        return run
+    return register
+
+
+def _needs_gaming_packages(snapshot: SystemSnapshot) -> bool:
+    return (
+        not snapshot.is_installed("inputplumber")
+        or not snapshot.is_installed("falcond")
+        or ("ROG Ally" in snapshot.dmesg and snapshot.is_installed("rogally-firmware"))
+    )
+
+
+def _needs_nvidia_swap(snapshot: SystemSnapshot) -> bool:
+    return any(
+        ("nvidia" in pkg.name and pkg.epoch == "4") or "akmod-nvidia" in pkg.name
+        for pkg in snapshot.packages
+    )
+
+
+def _needs_vaapi_fixup(snapshot: SystemSnapshot) -> bool:
+    return not (
+        snapshot.is_installed("mesa-libgallium-freeworld.x86_64")
+        and snapshot.is_installed("mesa-libgallium-freeworld.i686")
+    ) and not (
+        snapshot.is_installed("mesa-libgallium.x86_64")
+        and snapshot.is_installed("mesa-libgallium.i686")
+    )
 
 
 class QuirkFixup:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, session=None, initramfs=None):
         self.logger = logger if logger else logging.getLogger("nobara-updater.quirks")
+        self.session = session
+        # dracut runs are requested here and run by the caller, together
+        # with the ones the updates need.
+        self.initramfs = initramfs if initramfs else InitramfsManager(self.logger)
+        self.installed = get_installed_index()
+        # Package changes of the quirks below are collected here and
+        # committed together, see TransactionPlan.
+        self.plan = TransactionPlan(self.logger, session)
+        self.perform_kernel_actions = 0
+        self.perform_reboot_request = 0
+        self.perform_refresh = 0
+        self.media_fixup = 0
+        # Set by a quirk that needs the updater relaunched before the rest.
+        self.stop = False
+
+    def _settle(self, *needles: str) -> None:
+        """Commit the plan first if it changes packages the calling quirk
+        is about to look up in the rpmdb (any, without needles)."""
+        if self.plan.touches(*needles):
+            self.plan.commit()
 
     def _installed_nevras(self, package_names: list[str]) -> dict[str, str | None]:
-        installed = {}
-        for package_name in package_names:
-            result = subprocess.run(
-                ["rpm", "-q", package_name],
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                check=False,
-            )
-            installed[package_name] = (
-                result.stdout.strip() if result.returncode == 0 else None
+        return {
+            package_name: self.installed.nevra(package_name)
+            for package_name in package_names
+        }
+
+    def evaluate(self, snapshot: SystemSnapshot, only: list[str] | None = None) -> dict[str, bool | Exception]:
+        """Which quirks apply, all predicates evaluated concurrently. A
+        predicate that fails counts as applying, the quirk decides."""
+        selected = [q for q in QUIRKS if only is None or q.name in only]
+
+        def check(q: Quirk) -> bool | Exception:
+            try:
+                return bool(q.applies(snapshot))
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(selected), 8))) as executor:
+            return dict(zip((q.name for q in selected), executor.map(check, selected)))
+
+    def plan_report(self, only: list[str] | None = None) -> dict[str, bool | Exception]:
+        """Dry run: log which quirks would run, without changing anything.
+
+        Pending updates come from the last update check, so this doesn't
+        resolve a transaction.
+        """
+        started = time.monotonic()
+        snapshot = SystemSnapshot(self.installed, self.session, cached_only=True)
+        applies = self.evaluate(snapshot, only)
+        for q in QUIRKS:
+            if q.name not in applies:
+                continue
+            result = applies[q.name]
+            if isinstance(result, Exception):
+                state = f"would run (check failed: {result})"
+            else:
+                state = "would run" if result else "not needed"
+            self.logger.info("%-24s %s - %s", q.name, state, q.description)
+        self.logger.info("Quirk plan computed in %.2f s.", time.monotonic() - started)
+        return applies
+
+    def system_quirk_fixup(self, only: list[str] | None = None):
+        snapshot = SystemSnapshot(self.installed, self.session)
+        # Reads the pending updates before the predicates run at once.
+        snapshot.pending
+        applies = self.evaluate(snapshot, only)
+        timings = []
+
+        for q in QUIRKS:
+            if q.name not in applies:
+                continue
+            if applies[q.name] is False:
+                self.logger.info("QUIRK %s: not needed.", q.name, extra=DETAIL)
+                continue
+            self.logger.info("QUIRK: %s", q.description)
+            started = time.monotonic()
+            try:
+                q.run(self, snapshot)
+                outcome = "done"
+            except Exception as e:
+                outcome = f"failed: {e}"
+                self.logger.error("QUIRK %s failed: %s", q.name, e)
+            seconds = time.monotonic() - started
+            timings.append((seconds, q.name))
+            self.logger.info("QUIRK %s: %s in %.2f s.", q.name, outcome, seconds, extra=DETAIL)
+            if self.stop:
+                return (
+                    0,
+                    0,
+                    0,
+                    self.perform_refresh,
+                )
+
+        # Apply everything the quirks above queued up in one transaction.
+        self.plan.commit()
+
+        # Check if any packages contain "kernel" or "dkms"
+        if "gamescope" in snapshot.desktop:
+            gamescope_packages = snapshot.pending_matching("gamescope")
+            if gamescope_packages:
+                self.perform_reboot_request = 1
+
+        # Remove newinstall needs-update tracker
+        if Path.exists(Path("/etc/nobara/newinstall")):
+            try:
+                # Remove the file
+                Path("/etc/nobara/newinstall").unlink()
+            except OSError as e:
+                self.logger.error("Error: %s", e.strerror)
+
+        if timings:
+            self.logger.info(
+                "Quirks run: %s, slowest: %s.",
+                len(timings),
+                ", ".join(f"{name} {seconds:.1f} s" for seconds, name in sorted(timings, reverse=True)[:3]),
             )
-        return installed
-
-    def system_quirk_fixup(self):
-        package_names = updatechecker()
-        action = "upgrade"
-        perform_kernel_actions = 0
-        perform_reboot_request = 0
-        perform_refresh = 0
-        current_release = 44
-        # START QUIRKS LIST
-
-        # QUIRK: Make sure to refresh the repositories and gpg-keys before anything
-        self.logger.info("QUIRK: Make sure to refresh the repositories and gpg-keys before anything.")
-        critical_packages = [
-            "fedora-gpg-keys",
-            "nobara-gpg-keys",
-            "nobara-repos",
-        ]
+        return (
+            self.perform_kernel_actions,
+            self.perform_reboot_request,
+            self.media_fixup,
+            self.perform_refresh,
+        )
+
+
+    @quirk(
+        "refresh-repos",
+        "Make sure to refresh the repositories and gpg-keys before anything.",
+        lambda snapshot: bool(set(snapshot.pending) & set(CRITICAL_PACKAGES)),
+    )
+    def _refresh_repos(self, snapshot: SystemSnapshot) -> None:
+        package_names = snapshot.pending
+        critical_packages = CRITICAL_PACKAGES
         if any(pkg in package_names for pkg in critical_packages):
             critical_updates = [
                 pkg for pkg in package_names if pkg in critical_packages
@@ -84,7 +286,7 @@ class QuirkFixup:
                     *critical_update_targets,
                     "--nogpgcheck",
                     "--best",
-                    f"--releasever={current_release}",
+                    f"--releasever={CURRENT_RELEASE}",
                 ],
                 capture_output=True,
                 text=True,
@@ -112,43 +314,36 @@ class QuirkFixup:
                     pkg for pkg in package_names if pkg not in critical_packages
                 ]
             else:
-                perform_refresh = 1
+                self.perform_refresh = 1
+                self.stop = True
                 self.logger.info(log_message)
-                return (
-                    0,
-                    0,
-                    0,
-                    perform_refresh,
-                )
+                return
             if "fedora-gpg-keys" in package_names:
                 package_names = [pkg for pkg in package_names if pkg != "fedora-gpg-keys"]
             if "nobara-repos" in package_names:
                 package_names = [pkg for pkg in package_names if pkg != "nobara-repos"]
             if "nobara-gpg-keys" in package_names:
                 package_names = [pkg for pkg in package_names if pkg != "nobara-gpg-keys"]
-        # QUIRK: Make sure to update the updater itself and refresh before anything
-        self.logger.info("QUIRK: Make sure to update the updater itself and refresh before anything.")
+            snapshot.pending = package_names
+
+    @quirk(
+        "self-update",
+        "Make sure to update the updater itself and refresh before anything.",
+        lambda snapshot: snapshot.os_release.get("VERSION_ID") != str(CURRENT_RELEASE) or "nobara-updater" in snapshot.pending,
+    )
+    def _update_self(self, snapshot: SystemSnapshot) -> None:
+        package_names = snapshot.pending
         # Update release packages on new release
-
-        result = subprocess.run("cat /etc/os-release | grep VERSION_ID", shell=True, capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-
-        # Split the output into lines
-        release = result.stdout.strip().split('\n')
-
-        if current_release not in release:
+        if snapshot.os_release.get("VERSION_ID") != str(CURRENT_RELEASE):
             subprocess.run("dnf update -y --refresh nobara-release* --nogpgcheck", shell=True, capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
 
         if "nobara-updater" in package_names:
             self.logger.info("An update for the Update System app has been detected, updating self...\n")
             if self.run_package_updater(["nobara-updater"], "upgrade"):
                 if self._is_package_installed("nobara-updater"):
-                    perform_refresh = 1
-                    return (
-                        0,
-                        0,
-                        0,
-                        perform_refresh,
-                    )
+                    self.perform_refresh = 1
+                    self.stop = True
+                    return
                 self.logger.error(
                     "nobara-updater update reported success, but the package is not installed. Not relaunching."
                 )
@@ -156,58 +351,42 @@ class QuirkFixup:
                 self.logger.error(
                     "Failed to update nobara-updater. Existing installation was left in place."
                 )
-        # QUIRK: Cleanup outdated kernel modules
-        self.logger.info("QUIRK: Cleanup outdated kernel modules.")
-        try:
-            # Run the command and capture the output
-            result = subprocess.run("ls /boot/ | grep vmlinuz | grep -v rescue", shell=True, capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-
-            # Split the output into lines
-            lines = result.stdout.strip().split('\n')
-
-            # Extract version numbers by removing 'vmlinuz-' prefix
-            versions = [line.replace('vmlinuz-', '') for line in lines if line.startswith('vmlinuz-')]
-
-            # Run the ls command and capture the output
-            result = subprocess.run(['ls', '/lib/modules'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-
-            # Split the output into entries
-            modules = result.stdout.strip().split()
-
-            # Filter modules that do not match the kernel versions
-            filtered_modules = [module for module in modules if module not in versions]
-
-            # Remove filtered modules
-            for directory in filtered_modules:
-                if directory:  # Check if directory is not None or empty
-                    dir_path = os.path.join('/lib/modules', directory)
-                    if os.path.exists(dir_path):  # Check if the path exists
-                        shutil.rmtree(dir_path)
-
-        except subprocess.CalledProcessError as e:
-            print(f"An error occurred: {e}")
 
-        # QUIRK: Remove RPM Fusion release packages if they exist, we use Terra and they conflict.
-        self.logger.info("QUIRK: Remove RPM Fusion release packages if they exist, we use Terra and they conflict.")
-        rpmfusion_packages = [
-            "rpmfusion-free-release",
-            "rpmfusion-nonfree-release",
-            "rpmfusion-free-release-tainted",
-            "rpmfusion-nonfree-release-tainted",
-            "rpmfusion-free-release-rawhide",
-            "rpmfusion-nonfree-release-rawhide",
-        ]
-        if self.remove_installed_packages(rpmfusion_packages) == 1:
-            perform_refresh = 1
-
-        self.logger.info("QUIRK: maliit-keyboard, as plasma-keyboard is now default.")
+    @quirk(
+        "kernel-module-cleanup",
+        "Cleanup outdated kernel modules.",
+        lambda snapshot: bool(KernelInventory(installed=snapshot.installed).orphaned_modules()),
+    )
+    def _cleanup_kernel_modules(self, snapshot: SystemSnapshot) -> None:
+        KernelInventory(self.logger, snapshot.installed).remove_orphaned_modules()
+
+    @quirk(
+        "rpmfusion-release",
+        "Remove RPM Fusion release packages if they exist, we use Terra and they conflict.",
+        lambda snapshot: snapshot.any_installed(RPMFUSION_PACKAGES),
+    )
+    def _remove_rpmfusion(self, snapshot: SystemSnapshot) -> None:
+        if self.remove_installed_packages(RPMFUSION_PACKAGES) == 1:
+            self.perform_refresh = 1
+
+    @quirk(
+        "maliit-keyboard",
+        "maliit-keyboard, as plasma-keyboard is now default.",
+        lambda snapshot: snapshot.is_installed("maliit-keyboard"),
+    )
+    def _remove_maliit(self, snapshot: SystemSnapshot) -> None:
         rpmfusion_packages = [
             "maliit-keyboard",
         ]
         self.remove_installed_packages(rpmfusion_packages)
 
-        # QUIRK: Repair incomplete TigerVNC server package set.
-        self.logger.info("QUIRK: Repair incomplete TigerVNC server package set.")
+    @quirk(
+        "tigervnc",
+        "Repair incomplete TigerVNC server package set.",
+        lambda snapshot: snapshot.is_installed("tigervnc-server-minimal"),
+    )
+    def _repair_tigervnc(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         tigervnc_installed = [
             "tigervnc-license",
             "tigervnc-server-minimal",
@@ -217,31 +396,31 @@ class QuirkFixup:
             "tigervnc-selinux",
         ]
         if (
-            all(
-                subprocess.run(["rpm", "-q", pkg], capture_output=True, text=True, encoding="utf-8", errors="replace").returncode == 0
-                for pkg in tigervnc_installed
-            )
-            and all(
-                subprocess.run(["rpm", "-q", pkg], capture_output=True, text=True, encoding="utf-8", errors="replace").returncode != 0
-                for pkg in tigervnc_missing
-            )
+            all(installed.is_installed(pkg) for pkg in tigervnc_installed)
+            and not any(installed.is_installed(pkg) for pkg in tigervnc_missing)
         ):
             if self.remove_installed_packages(tigervnc_installed) == 1:
-                perform_refresh = 1
+                self.perform_refresh = 1
             if self.ensure_package_installed(tigervnc_installed + tigervnc_missing) == 1:
-                perform_refresh = 1
-
-        # QUIRK: Make sure dnf-app-center is installed.
-        self.logger.info("QUIRK: Make sure dnf-app-center is installed.")
+                self.perform_refresh = 1
+
+    @quirk(
+        "dnf-app-center",
+        "Make sure dnf-app-center is installed.",
+        lambda snapshot: not snapshot.is_installed("dnf-app-center"),
+    )
+    def _install_app_center(self, snapshot: SystemSnapshot) -> None:
         if self.ensure_package_installed("dnf-app-center") == 1:
-            perform_refresh = 1
-
-        # QUIRK: Replace SDDM with Plasma Login Manager when SDDM is installed.
-        self.logger.info("QUIRK: Replace SDDM with Plasma Login Manager when SDDM is installed.")
-        check_sddm = subprocess.run(
-            ["rpm", "-q", "sddm"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if check_sddm.returncode == 0:
+            self.perform_refresh = 1
+
+    @quirk(
+        "plasma-login-manager",
+        "Replace SDDM with Plasma Login Manager when SDDM is installed.",
+        lambda snapshot: snapshot.is_installed("sddm"),
+    )
+    def _replace_sddm(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
+        if installed.is_installed("sddm"):
             sddm_conf = Path("/etc/sddm.conf")
             sddm_conf_d = Path("/etc/sddm.conf.d")
             plasmalogin_conf = Path("/etc/plasmalogin.conf")
@@ -260,101 +439,114 @@ class QuirkFixup:
             subprocess.run(["dnf", "remove", "-y", "sddm", "--setopt=tsflags=noscripts"], capture_output=True, text=True, encoding="utf-8", errors="replace")
             self.ensure_package_installed("plasma-login-manager")
 
-            subprocess.run(
-                ["systemctl", "disable", "sddm.service"],
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace",
-                check=False,
-            )
-            subprocess.run(
-                ["systemctl", "enable", "plasmalogin.service"],
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace",
-                check=False,
-            )
+            def switch_display_manager():
+                subprocess.run(
+                    ["systemctl", "disable", "sddm.service"],
+                    capture_output=True,
+                    text=True, encoding="utf-8", errors="replace",
+                    check=False,
+                )
+                subprocess.run(
+                    ["systemctl", "enable", "plasmalogin.service"],
+                    capture_output=True,
+                    text=True, encoding="utf-8", errors="replace",
+                    check=False,
+                )
+
+            # The unit only exists once plasma-login-manager is installed.
+            self.plan.after(switch_display_manager)
 
-        # QUIRK: Make sure to run both dracut and dkms if any kmods  or kernel packages were updated.
-        self.logger.info("QUIRK: Make sure to run both dracut and dkms if any kmods  or kernel packages were updated.")
+    @quirk(
+        "kernel-actions",
+        "Make sure to run both dracut and dkms if any kmods  or kernel packages were updated.",
+        lambda snapshot: bool(snapshot.pending_matching("kernel", "dkms")),
+    )
+    def _kernel_actions(self, snapshot: SystemSnapshot) -> None:
+        package_names = snapshot.pending
         # Check if any packages contain "kernel" or "dkms"
         kernel_kmod_packages = [
             pkg for pkg in package_names if "kernel" in pkg or "dkms" in pkg
         ]
         if kernel_kmod_packages:
-            perform_kernel_actions = 1
-            perform_reboot_request = 1
-
-        # QUIRK: If kwin or mutter are being updated, ask for a reboot.
-        self.logger.info("QUIRK: If kwin or mutter are being updated, ask for a reboot.")
+            self.perform_kernel_actions = 1
+            self.perform_reboot_request = 1
+
+    @quirk(
+        "compositor-reboot",
+        "If kwin or mutter are being updated, ask for a reboot.",
+        lambda snapshot: bool(snapshot.pending_matching("kwin", "mutter")),
+    )
+    def _compositor_reboot(self, snapshot: SystemSnapshot) -> None:
+        package_names = snapshot.pending
         de_update_packages = [
             pkg for pkg in package_names if "kwin" in pkg or "mutter" in pkg
         ]
         if de_update_packages:
-            perform_reboot_request = 1
-
-        # QUIRK: Install InputPlumber for Controller input, install steam firmware for steamdecks. Cleanup old packages.
+            self.perform_reboot_request = 1
+
+    @quirk(
+        "gaming-packages",
+        "Install InputPlumber for Controller input, install steam firmware for steamdecks. Cleanup old packages.",
+        _needs_gaming_packages,
+    )
+    def _install_gaming_packages(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         remove_names = []
         updatelist  = []
 
-        self.logger.info("QUIRK: Install InputPlumber for Controller input, install steam firmware for steamdecks. Cleanup old packages.")
-
         # Install InputPlumber
-        check_ip = subprocess.run(
-            ["rpm", "-q", "inputplumber"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        if check_ip.returncode != 0:
+        if not installed.is_installed("inputplumber"):
             updatelist.append("inputplumber")
 
         # Install ROG Ally/X firmware if needed
-        check_ally = subprocess.run(
-            "dmesg | grep 'ROG Ally'", capture_output=True, text=True, encoding="utf-8", errors="replace", shell=True
-        )
-        ally_detected = check_ally.returncode == 0
+        ally_detected = "ROG Ally" in snapshot.dmesg
         if ally_detected:
             self.logger.info(
                 "Found ROG Ally, installing firmware"
             )
 
             rogfw_name = "rogally-firmware"
-            check_rogfw = subprocess.run(
-                ["rpm", "-q", rogfw_name], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            rogfw_installed = check_rogfw.returncode == 0
+            rogfw_installed = installed.is_installed(rogfw_name)
             # Remove it, it's upstreamed now'
             if rogfw_installed:
-                PackageUpdater([rogfw_name], "remove", None)
+                self.plan.remove([rogfw_name])
 
-        check_falcond = subprocess.run(
-            ["rpm", "-q", "falcond"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        falcond_installed = check_falcond.returncode == 0
+        falcond_installed = installed.is_installed("falcond")
         if not falcond_installed:
-            PackageUpdater(["falcond"], "install", None)
-            subprocess.run(
-                ["systemctl", "enable", "--now", "falcond"],
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace",
+            self.plan.install(["falcond"])
+            self.plan.after(
+                lambda: subprocess.run(
+                    ["systemctl", "enable", "--now", "falcond"],
+                    capture_output=True,
+                    text=True, encoding="utf-8", errors="replace",
+                )
             )
 
+        if len(remove_names) > 0:
+            self.plan.remove(remove_names)
 
-        check_gamescope_htpc = subprocess.run(
-            ["rpm", "-q", "gamescope-htpc-common"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        gamescope_htpc_installed = check_gamescope_htpc.returncode == 0
-
-        check_gamescope_session_common = subprocess.run(
-            ["rpm", "-q", "gamescope-session-common"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        gamescope_session_common_installed = check_gamescope_session_common.returncode == 0
+        if len(updatelist) > 0:
+            self.plan.install(updatelist)
+
+    @quirk(
+        "gamescope-boot-theme",
+        "Match the plymouth theme and grub menu to the gamescope session.",
+        lambda snapshot: snapshot.any_installed(["gamescope-htpc-common", "gamescope-session-common"]),
+    )
+    def _gamescope_boot_theme(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
+        gamescope_htpc_installed = installed.is_installed("gamescope-htpc-common")
+
+        gamescope_session_common_installed = installed.is_installed("gamescope-session-common")
         if gamescope_htpc_installed:
             if not gamescope_session_common_installed:
                 # Return to normal grub + plymouth first.
                 plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
+                plymouth_scripts_notinstalled = not installed.is_installed(plymouth_scripts_name)
                 if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
+                    # Barrier: the theme below needs the plugin installed.
+                    self.plan.install(["plymouth-plugin-script"])
+                    self.plan.commit()
 
                 # Run the 'plymouth-set-default-theme' command and capture its output
                 check_theme = subprocess.run(
@@ -370,7 +562,7 @@ class QuirkFixup:
                         text=True, encoding="utf-8", errors="replace",
                     )
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+                    self.initramfs.request("plymouth theme changed", force=True)
 
                     # Path to the grub configuration file
                     grub_file_path = "/etc/default/grub"  # Use the test file path
@@ -425,12 +617,11 @@ class QuirkFixup:
             else:
                 # Fixup plymouth so it's more steamos-like
                 plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
+                plymouth_scripts_notinstalled = not installed.is_installed(plymouth_scripts_name)
                 if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
+                    # Barrier: the theme below needs the plugin installed.
+                    self.plan.install(["plymouth-plugin-script"])
+                    self.plan.commit()
 
                 # Run the 'plymouth-set-default-theme' command and capture its output
                 check_theme = subprocess.run(
@@ -446,7 +637,7 @@ class QuirkFixup:
                         text=True, encoding="utf-8", errors="replace",
                     )
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+                    self.initramfs.request("plymouth theme changed", force=True)
 
                     # Path to the grub configuration file
                     grub_file_path = "/etc/default/grub"  # Use the test file path
@@ -503,12 +694,11 @@ class QuirkFixup:
             if not gamescope_htpc_installed:
                 # Return to normal grub + plymouth first.
                 plymouth_scripts_name = "plymouth-plugin-script"
-                check_plymouth_scripts = subprocess.run(
-                    ["rpm", "-q", plymouth_scripts_name], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                )
-                plymouth_scripts_notinstalled = check_plymouth_scripts.returncode != 0
+                plymouth_scripts_notinstalled = not installed.is_installed(plymouth_scripts_name)
                 if plymouth_scripts_notinstalled:
-                    PackageUpdater(["plymouth-plugin-script"], "install", None)
+                    # Barrier: the theme below needs the plugin installed.
+                    self.plan.install(["plymouth-plugin-script"])
+                    self.plan.commit()
 
                 # Run the 'plymouth-set-default-theme' command and capture its output
                 check_theme = subprocess.run(
@@ -524,7 +714,7 @@ class QuirkFixup:
                         text=True, encoding="utf-8", errors="replace",
                     )
 
-                    subprocess.run(["dracut", "-f", "--regenerate-all"], check=True)
+                    self.initramfs.request("plymouth theme changed", force=True)
 
                     # Path to the grub configuration file
                     grub_file_path = "/etc/default/grub"  # Use the test file path
@@ -577,138 +767,80 @@ class QuirkFixup:
                             text=True, encoding="utf-8", errors="replace",
                         )
 
-        if len(remove_names) > 0:
-            PackageUpdater(remove_names, "remove", None)
-
-        if len(updatelist) > 0:
-            PackageUpdater(updatelist, "install", None)
-
+    @quirk(
+        "steamdeck",
+        "Install the Steam Deck hardware support packages on a Steam Deck.",
+        lambda snapshot: "Galileo" in snapshot.dmesg or "Jupiter" in snapshot.dmesg,
+    )
+    def _install_steamdeck_packages(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         # Also check if device is steamdeck, if so install jupiter packages
-        check_galileo = subprocess.run(
-            "dmesg | grep 'Galileo'", capture_output=True, text=True, encoding="utf-8", errors="replace", shell=True
-        )
-        galileo_detected = check_galileo.returncode == 0
-
-        check_jupiter = subprocess.run(
-            "dmesg | grep 'Jupiter'", capture_output=True, text=True, encoding="utf-8", errors="replace", shell=True
-        )
-        jupiter_detected = check_jupiter.returncode == 0
+        galileo_detected = "Galileo" in snapshot.dmesg
+        jupiter_detected = "Jupiter" in snapshot.dmesg
 
         if (galileo_detected or jupiter_detected):
             steamdeck_install = []
 
             jupiter_hw = "jupiter-hw-support"
-            check_jupiter_hw = subprocess.run(
-                ["rpm", "-q", jupiter_hw], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            jupiter_hw_installed = check_jupiter_hw.returncode != 0
+            jupiter_hw_installed = not installed.is_installed(jupiter_hw)
             if jupiter_hw_installed:
                 steamdeck_install.append(jupiter_hw)
 
             jupiter_fan = "jupiter-fan-control"
-            check_jupiter_fan = subprocess.run(
-                ["rpm", "-q", jupiter_fan], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            jupiter_fan_installed = check_jupiter_fan.returncode != 0
+            jupiter_fan_installed = not installed.is_installed(jupiter_fan)
             if jupiter_fan_installed:
                 steamdeck_install.append(jupiter_fan)
 
             steamdeck_dsp = "steamdeck-dsp"
-            check_steamdeck_dsp = subprocess.run(
-                ["rpm", "-q", steamdeck_dsp], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            steamdeck_dsp_installed = check_steamdeck_dsp.returncode != 0
+            steamdeck_dsp_installed = not installed.is_installed(steamdeck_dsp)
             if steamdeck_dsp_installed:
                 steamdeck_install.append(steamdeck_dsp)
 
             steamdeck_firmware = "steamdeck-firmware"
-            check_steamdeck_firmware = subprocess.run(
-                ["rpm", "-q", steamdeck_firmware], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            steamdeck_firmware_installed = check_steamdeck_firmware.returncode != 0
+            steamdeck_firmware_installed = not installed.is_installed(steamdeck_firmware)
             if steamdeck_firmware_installed:
                 steamdeck_install.append(steamdeck_firmware)
 
             if len(steamdeck_install) > 0:
-                PackageUpdater(steamdeck_install, "install", None)
-
-        # QUIRK: Problematic package cleanup
-        self.logger.info("QUIRK: Problematic package cleanup.")
-        problematic = [
-            "qt5-qtwebengine-freeworld",
-            "qt6-qtwebengine-freeworld",
-            "qgnomeplatform-qt6",
-            "qgnomeplatform-qt5",
-            "okular5-libs",
-            "fedora-workstation-repositories",
-            "deckyloader",
-            "obs-studio-libs.i686",
-            "obs-studio-plugin-vkcapture.i686",
-            "obs-studio-plugin-source-record.i686"
-        ]
+                self.plan.install(steamdeck_install)
+
+    @quirk(
+        "problematic-packages",
+        "Problematic package cleanup.",
+        lambda snapshot: snapshot.any_installed(PROBLEMATIC_PACKAGES + PROBLEMATIC_2025_PACKAGES),
+    )
+    def _remove_problematic(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         problematic_names = []
-        for package in problematic:
-            problematic_check = subprocess.run(
-                ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            if problematic_check.returncode == 0:
+        for package in PROBLEMATIC_PACKAGES:
+            if installed.is_installed(package):
                 problematic_names.append(package)
 
         if len(problematic_names) > 0:
             self.logger.info("Found problematic packages, removing...")
-            PackageUpdater(problematic_names, "remove", None)
-
-        problematic_2025 = [
-            "plasma-workspace-geolocation",
-            "plasma-workspace-geolocation-libs",
-            "rubberband.i686",
-            "python3-torch-rocm-gfx9",
-            "python3-torchaudio-rocm-gfx9",
-            "tesseract.i686",
-            "kdelibs-webkit",
-            "kate4-part",
-            "kde-style-breeze",
-            "libpostproc-free.x86_64",
-            "libpostproc-free.i686"
-        ]
-        for package in problematic_2025:
-            problematic_check_2025 = subprocess.run(
-                ["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            if problematic_check_2025.returncode == 0:
-                if "rubberband" in package:
-                    libs32_check = subprocess.run(["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                    if libs32_check.returncode == 0:
-                        subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                        subprocess.run(["dnf", "install", "-y", "rubberband-libs.x86_64", "--refresh"], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                        subprocess.run(["dnf", "install", "-y", "rubberband-libs.i686", "--refresh"], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                elif "tesseract" in package:
-                    libs32_check = subprocess.run(["rpm", "-q", package], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                    if libs32_check.returncode == 0:
-                        subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                        subprocess.run(["dnf", "install", "-y", "tesseract-libs.x86_64", "--refresh"], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                        subprocess.run(["dnf", "install", "-y", "tesseract-libs.i686", "--refresh"], capture_output=True, text=True, encoding="utf-8", errors="replace")
-                else:
-                    subprocess.run(["rpm", "-e", "--nodeps", package], capture_output=True, text=True, encoding="utf-8", errors="replace")
+            self.plan.remove(problematic_names)
 
-        # QUIRK: Clear plasmashell cache if a plasma-workspace update is available
-        self.logger.info("QUIRK: Clear plasmashell cache if a plasma-workspace update is available.")
-        # Function to run the rpm command and get the output
+        problematic_2025_installed = [
+            package for package in PROBLEMATIC_2025_PACKAGES if installed.is_installed(package)
+        ]
+        for package in problematic_2025_installed:
+            self.plan.erase_nodeps([package])
+            if "rubberband" in package:
+                self.plan.install(["rubberband-libs.x86_64", "rubberband-libs.i686"])
+            elif "tesseract" in package:
+                self.plan.install(["tesseract-libs.x86_64", "tesseract-libs.i686"])
+
+    @quirk(
+        "plasmashell-cache",
+        "Clear plasmashell cache if a plasma-workspace update is available.",
+        lambda snapshot: any(pkg.startswith("plasma-workspace") for pkg in snapshot.pending),
+    )
+    def _clear_plasmashell_cache(self, snapshot: SystemSnapshot) -> None:
+        package_names = snapshot.pending
+        # The resolved upgrade set already answers this, no need for a
+        # separate `dnf check-update` metadata load.
         def check_update():
-            try:
-                # Run the dnf check-update command and filter for plasma-workspace
-                result = subprocess.run(['dnf', 'check-update'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=False)
-                # Use Python's string filtering instead of piping in the shell
-                if result.returncode in [0, 100]:
-                    if 'plasma-workspace' in result.stdout:
-                        return True
-                    return False
-                self.logger.error(f"DNF error (code {result.returncode}): {result.stderr}")
-                return False
-                
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to run dnf command: {e}")
-                return False
+            return any(pkg.startswith("plasma-workspace") for pkg in package_names)
 
         # Function to get the list of all user home directories
         def get_all_user_home_directories():
@@ -735,22 +867,19 @@ class QuirkFixup:
             for home_dir in get_all_user_home_directories():
                 delete_qmlcache(home_dir)
 
-        # QUIRK: Fix Nvidia epoch so it matches that of negativo17 for cross compatibility
-        self.logger.info("QUIRK: Fix Nvidia epoch so it matches that of negativo17 for cross compatibility.")
-        self.logger.info("QUIRK: Also swap akmod-nvidia for dkms-nvidia.")
+    @quirk(
+        "nvidia-epoch",
+        "Fix Nvidia epoch so it matches that of negativo17 for cross compatibility, and swap akmod-nvidia for dkms-nvidia.",
+        _needs_nvidia_swap,
+    )
+    def _fix_nvidia(self, snapshot: SystemSnapshot) -> None:
+        # Scan the installed set for nvidia packages with epoch 4 or the akmod
+        installed_packages = self.installed.packages()
 
-        # Run the dnf list installed command and capture the output
-        check_nvidia_wrong_epoch = subprocess.run(
-            ["dnf", "list", "--installed"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-
-        # Check if the command was successful
-        if check_nvidia_wrong_epoch.returncode == 0:
-            # Filter the output for lines containing 'nvidia' and '4:'
-            output_lines = check_nvidia_wrong_epoch.stdout.splitlines()
-            nvidia_wrong_epoch = any("nvidia" in line and "4:" in line for line in output_lines)
-            nvidia_akmod = any("akmod-nvidia" in line for line in output_lines)
-            chromium = any(line.startswith("chromium.") or line.startswith("chromium ") for line in output_lines)
+        if installed_packages:
+            nvidia_wrong_epoch = any("nvidia" in pkg.name and pkg.epoch == "4" for pkg in installed_packages)
+            nvidia_akmod = any("akmod-nvidia" in pkg.name for pkg in installed_packages)
+            chromium = any(pkg.name == "chromium" for pkg in installed_packages)
             kernel_conf_path = "/etc/nvidia/kernel.conf"
             prior_variant = "unknown"   # "open" / "closed" / "unknown"
 
@@ -800,8 +929,8 @@ class QuirkFixup:
                 if chromium:
                     packages.append("chromium")
 
-                # Add the '--refresh' option at the end
-                command = ["dnf", "install", "-y"] + packages + ["--refresh"]
+                # Refresh at the end unless this run already checked the metadata
+                command = ["dnf", "install", "-y"] + packages + refresh_args()
 
                 # Run the command (capture returncode so we can gate post steps)
                 install_proc = subprocess.run(command)
@@ -815,32 +944,36 @@ class QuirkFixup:
                         conf += "options nvidia NVreg_EnableGpuFirmware=0\n"
                         if os.path.exists(kernel_conf_path):
                             subprocess.run(["sed", "-i", "-e", "s/kernel-open$/kernel/g", kernel_conf_path], check=False)
-                        subprocess.run(["dkms", "autoinstall"], check=False)
+                        DkmsBuilder(self.logger).build(modules=["nvidia"])
 
                     subprocess.run(["tee", "/etc/modprobe.d/nvidia-modeset.conf"],
                                 input=conf, text=True, encoding="utf-8", errors="replace", check=False)
 
                     subprocess.run(["chmod", "644", "/etc/modprobe.d/nvidia-modeset.conf"], check=False)
+                    # The modprobe options and the new driver go into every image.
+                    self.initramfs.request("nvidia driver swapped", force=True)
 
-                    perform_kernel_actions = 1
-                    perform_reboot_request = 1
+                    self.perform_kernel_actions = 1
+                    self.perform_reboot_request = 1
                 else:
                     self.logger.warning("dnf install nvidia stack failed with rc=%s", install_proc.returncode)
 
-        # QUIRK: Post N41 mesa update
-        self.logger.info("QUIRK: Update old N41 mesa packages to current versions.")
-
-        # Run the first command and capture the output
-        cmd = "dnf list --installed | grep mesa | grep fc41 | cut -d ' ' -f 1"
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, encoding="utf-8", errors="replace")
-
-        # Split output into a list of package names
-        packages = result.stdout.strip().split("\n")
+    @quirk(
+        "n41-mesa",
+        "Update old N41 mesa packages to current versions.",
+        lambda snapshot: any("mesa" in pkg.name and "fc41" in pkg.release for pkg in snapshot.packages),
+    )
+    def _update_n41_mesa(self, snapshot: SystemSnapshot) -> None:
+        # Collect name.arch of every installed fc41 mesa package
+        packages = [
+            f"{pkg.name}.{pkg.arch}"
+            for pkg in self.installed.packages()
+            if "mesa" in pkg.name and "fc41" in pkg.release
+        ]
 
-        # Run rpm -e --nodeps with all packages at once
-        if packages and packages != ['']:
-            rpm_cmd = ["rpm", "-e", "--nodeps"] + packages
-            subprocess.run(rpm_cmd)
+        # rpm -e --nodeps all of them, then install the current ones
+        if packages:
+            self.plan.erase_nodeps(packages)
 
             # Step 2: Install required mesa packages
             to_install = [
@@ -867,22 +1000,21 @@ class QuirkFixup:
                 "mesa-vulkan-drivers.x86_64",
             ]
 
-            dnf_cmd = ["dnf", "install", "-y"] + to_install
-            subprocess.run(dnf_cmd)
-
-        # QUIRK: Swap old AMD ROCm packages with upstream Fedora ROCm versions.
-        self.logger.info("QUIRK: Swap old AMD ROCm packages with upstream Fedora ROCm versions.")
-
+            self.plan.install(to_install)
+            # The vulkan, vaapi and media quirks below decide from the
+            # installed mesa packages, they have to see the swapped ones.
+            self.plan.commit()
+
+    @quirk(
+        "rocm",
+        "Swap old AMD ROCm packages with upstream Fedora ROCm versions.",
+        lambda snapshot: bool(snapshot.installed.from_repo("nobara-rocm-official")),
+    )
+    def _swap_rocm(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         try:
-            result = subprocess.run(
-                "dnf list --installed | grep @nobara-rocm-official",
-                shell=True,
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace"
-            )
-
-            # Check if there is any output
-            if result.stdout.strip():
+            # Check if anything is still installed from the old ROCm repo
+            if installed.from_repo("nobara-rocm-official"):
                 # Remove old ROCm packages
                 old_rocm_removal = [
                     "comgr.x86_64",
@@ -906,179 +1038,117 @@ class QuirkFixup:
                     "rocprofiler-register.x86_64",
                     "rocm-meta",
                 ]
-                PackageUpdater(old_rocm_removal, "remove", None)
-                # Now reinstall new rocm-meta
-                PackageUpdater(["rocm-meta"], "install", None)
+                # Now reinstall new rocm-meta. It is also in the removal
+                # list, so the plan commits the removal first.
+                self.plan.swap(old_rocm_removal, ["rocm-meta"])
 
         except Exception as e:
             print(f"An error occurred: {e}")
 
-        # QUIRK: mesa-vulkan-drivers fixup
-        self.logger.info("QUIRK: mesa-vulkan-drivers fixup.")
+    @quirk(
+        "mesa-vulkan-drivers",
+        "mesa-vulkan-drivers fixup.",
+        lambda snapshot: not any("mesa-vulkan-drivers" in pkg.nevra for pkg in snapshot.packages),
+    )
+    def _install_mesa_vulkan(self, snapshot: SystemSnapshot) -> None:
+        self._settle("mesa-vulkan-drivers")
         try:
-            result = subprocess.run(
-                "rpm -qa | grep mesa-vulkan-drivers",
-                shell=True,
-                capture_output=True,
-                text=True, encoding="utf-8", errors="replace"
-            )
-
-            # Check if there is any output
-            if result.returncode !=0:
+            # Check if any mesa-vulkan-drivers variant is installed
+            if not any("mesa-vulkan-drivers" in pkg.nevra for pkg in self.installed.packages()):
                 self.logger.info("mesa-vulkan-drivers fixup.")
-                subprocess.run(
-                    ["dnf", "install", "-y", "mesa-vulkan-drivers.x86_64", "mesa-vulkan-drivers.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                )
+                self.plan.install(["mesa-vulkan-drivers.x86_64", "mesa-vulkan-drivers.i686"])
         except Exception as e:
             print(f"An error occurred: {e}")
 
-        # QUIRK: vaapi fixup
-        self.logger.info("QUIRK: vaapi fixup.")
-        mesa_fixup_check = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        mesa_fixup_check1 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-
-        mesa_fixup_check2 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        mesa_fixup_check3 = subprocess.run(
-            ["rpm", "-q", "mesa-libgallium.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
+    @quirk(
+        "vaapi",
+        "vaapi fixup.",
+        _needs_vaapi_fixup,
+    )
+    def _fix_vaapi(self, snapshot: SystemSnapshot) -> None:
+        self._settle("mesa-libgallium", "mesa-va-drivers")
+        installed = snapshot.installed
         # they should all either end in -freeworld or not, no mixing.
+        vaapi_packages = [
+            "mesa-libgallium.x86_64",
+            "mesa-libgallium.i686",
+            "mesa-libgallium-freeworld.x86_64",
+            "mesa-libgallium-freeworld.i686",
+            "mesa-va-drivers.x86_64",
+            "mesa-va-drivers.i686",
+            "mesa-va-drivers-freeworld.x86_64",
+            "mesa-va-drivers-freeworld.i686",
+        ]
         if not (
-            mesa_fixup_check.returncode == 0
-            and mesa_fixup_check1.returncode == 0
+            installed.is_installed("mesa-libgallium-freeworld.x86_64")
+            and installed.is_installed("mesa-libgallium-freeworld.i686")
         ):
             # If all of them are not freeworld, check if they are all standard:
             if not (
-                mesa_fixup_check2.returncode == 0
-                and mesa_fixup_check3.returncode == 0
+                installed.is_installed("mesa-libgallium.x86_64")
+                and installed.is_installed("mesa-libgallium.i686")
             ):
 
                 # looks like we have a mix of both, let's check if -any- of them are freeworld:
                 if not (
                     # If at least one of them is freeworld, correct all to freeworld
-                    mesa_fixup_check.returncode == 0
-                    or mesa_fixup_check1.returncode == 0
-                    or mesa_fixup_check2.returncode == 0
-                    or mesa_fixup_check3.returncode == 0
+                    installed.is_installed("mesa-libgallium-freeworld.x86_64")
+                    or installed.is_installed("mesa-libgallium-freeworld.i686")
+                    or installed.is_installed("mesa-libgallium.x86_64")
+                    or installed.is_installed("mesa-libgallium.i686")
                 ):
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["dnf", "install", "-y", "mesa-libgallium-freeworld.x86_64", "mesa-libgallium-freeworld.i686", "--refresh"],
-                        capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
+                    self.plan.erase_nodeps(vaapi_packages)
+                    self.plan.install(["mesa-libgallium-freeworld.x86_64", "mesa-libgallium-freeworld.i686"])
                 # Otherwise correct to original
                 else:
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-libgallium-freeworld.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.x86_64"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["rpm", "-e", "--nodeps", "mesa-va-drivers-freeworld.i686"], capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-                    subprocess.run(
-                        ["dnf", "install", "-y", "mesa-libgallium.x86_64", "mesa-libgallium.i686", "--refresh"],
-                        capture_output=True, text=True, encoding="utf-8", errors="replace"
-                    )
-
-        # QUIRK: Kernel 6.12.9 fixup
-        self.logger.info("QUIRK: Kernel fsync->nobara conversion update.")
+                    self.plan.erase_nodeps(vaapi_packages)
+                    self.plan.install(["mesa-libgallium.x86_64", "mesa-libgallium.i686"])
+
+    @quirk(
+        "fsync-kernel",
+        "Kernel fsync->nobara conversion update.",
+        lambda snapshot: "fsync" in snapshot.kernel or ("nobara" in snapshot.kernel and snapshot.kernel < FSYNC_TARGET_KERNEL),
+    )
+    def _convert_fsync_kernel(self, snapshot: SystemSnapshot) -> None:
+        installed = snapshot.installed
         try:
             # Get the full kernel version
-            full_version = subprocess.run(['uname', '-r'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-
-            # Access the captured output
-            version_output = full_version.stdout.strip()
+            version_output = snapshot.kernel
 
             if "fsync" in version_output:
                 subprocess.run(['dnf', 'remove', 'kernel-uki-virt*', '-y'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
                 subprocess.run(['dnf', 'update', 'kernel', '-y'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
                 subprocess.run(['dnf', 'update', 'kernel-devel', '-y'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-                perform_kernel_actions = 1
-                perform_reboot_request = 1
+                self.perform_kernel_actions = 1
+                self.perform_reboot_request = 1
 
-            target_version = "6.12.11-204.nobara.fc41.x86_64"
+            target_version = FSYNC_TARGET_KERNEL
             if "nobara" in version_output:
                 if version_output < target_version:
-                    checkpending = subprocess.run(['rpm', '-q', f'kernel-{target_version}'], capture_output=True, text=True, encoding="utf-8", errors="replace", check=True)
-                    checkpending_output = checkpending.stdout.strip()
-                    if "not installed" in checkpending_output:
+                    if not installed.is_installed(f"kernel-{target_version}"):
                         try:
                             subprocess.run(['dnf', 'install', "-y", f'kernel-{target_version}'], check=True)
                             subprocess.run(['dnf', 'install', "-y", f'kernel-devel-{target_version}'], check=True)
-                            perform_kernel_actions = 1
-                            perform_reboot_request = 1
+                            self.perform_kernel_actions = 1
+                            self.perform_reboot_request = 1
                         except subprocess.CalledProcessError as e:
                             self.logger.info(f"Error installing new kernel: {e}")
 
         except subprocess.CalledProcessError as e:
             self.logger.info(f"An error occurred: {e}")
 
-        # QUIRK 18: Media fixup
+    @quirk(
+        "media",
+        "Media fixup.",
+    )
+    def _check_media(self, snapshot: SystemSnapshot) -> None:
+        # Checks the whole media stack, against what the quirks above did.
+        self._settle()
+        installed = snapshot.installed
         media_fixup = 0
 
         def repo_enabled(repo_name="nobara-pikaos-additional"):
-            try:
-                # Run `dnf -q repolist --enabled`
-                dnfoverride = subprocess.run(
-                    ["dnf", "-q", "repolist", "--enabled"],
-                    capture_output=True,
-                    text=True, encoding="utf-8", errors="replace",
-                    check=True
-                )
-
-                # Extract repo IDs (skip the first line like `awk 'NR>1 {print $1}'`)
-                repos = [line.split()[0] for line in dnfoverride.stdout.strip().splitlines()[1:]]
-
-                # Check if repo_name exists in list
-                if repo_name in repos:
-                    return True
-            except subprocess.CalledProcessError:
-                return False
+            return dnf_repo_enabled(repo_name)
 
         def repo_file_broken():
             try:
@@ -1097,31 +1167,18 @@ class QuirkFixup:
 
         def broken_codecs():
             if not repo_enabled():
-                try:
-                    # Run the rpm command and capture output
-                    result = subprocess.run(
-                        ["rpm", "-qa"],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True, encoding="utf-8", errors="replace",
-                        check=True
-                    )
-                    # Look for "freeworld" in the output
-                    if "freeworld" in result.stdout:
-                        return True
-                except subprocess.CalledProcessError as e:
-                    # Handle rpm command failure
-                    print(f"Error checking rpm packages: {e}")
+                # Look for "freeworld" in the installed set
+                if any("freeworld" in pkg.nevra for pkg in self.installed.packages()):
+                    return True
             return False
 
         if broken_codecs():
             media_fixup = 1
 
         if repo_enabled() and media_fixup == 0:
-            self.logger.info("QUIRK: Media fixup.")
             def rpm_installed(name: str) -> bool:
-                """Return True if rpm -q <name> reports installed."""
-                return subprocess.run(["rpm", "-q", name], capture_output=True).returncode == 0
+                """Return True if rpm -q <name> would report installed."""
+                return installed.is_installed(name)
 
             # These must be installed; if any is missing -> media_fixup = 1
             MUST_BE_INSTALLED = {
@@ -1179,40 +1236,10 @@ class QuirkFixup:
                         media_fixup = 1
                         break
 
-        if media_fixup == 1:
-            # do fixup
-            pass
-
-
-        # END QUIRKS LIST
-        # Check if any packages contain "kernel" or "dkms"
-        if "gamescope" in os.environ.get('XDG_CURRENT_DESKTOP', '').lower():
-            gamescope_packages = [
-                pkg for pkg in package_names if "gamescope" in pkg
-            ]
-            if gamescope_packages:
-                perform_reboot_request = 1
-
-        # Remove newinstall needs-update tracker
-        if Path.exists(Path("/etc/nobara/newinstall")):
-            try:
-                # Remove the file
-                Path("/etc/nobara/newinstall").unlink()
-            except OSError as e:
-                logger.error("Error: %s", e.strerror)
-
-        return (
-            perform_kernel_actions,
-            perform_reboot_request,
-            media_fixup,
-            perform_refresh,
-        )
+        self.media_fixup = media_fixup
 
     def _is_package_installed(self, package_name: str) -> bool:
-        result = subprocess.run(
-            ["rpm", "-q", package_name], capture_output=True, text=True, encoding="utf-8", errors="replace"
-        )
-        return result.returncode == 0
+        return self.installed.is_installed(package_name)
 
     def _run_package_updater_threaded(
         self, package_names: list[str], action: str
@@ -1242,14 +1269,16 @@ class QuirkFixup:
         return self._run_package_updater_threaded(package_list, action)
 
     def ensure_package_installed(self, package_name: str | list[str]) -> int:
+        """Queue the missing packages for installation in self.plan.
+
+        Returns 1 if anything was queued. Whatever the plan is about to
+        remove counts as missing.
+        """
         package_names = [package_name] if isinstance(package_name, str) else package_name
         missing_packages = []
 
         for pkg in package_names:
-            result = subprocess.run(
-                ["rpm", "-q", pkg], capture_output=True, text=True, encoding="utf-8", errors="replace"
-            )
-            if result.returncode != 0:
+            if not self._is_package_installed(pkg) or self.plan.removes(pkg):
                 missing_packages.append(pkg)
 
         if missing_packages:
@@ -1258,23 +1287,16 @@ class QuirkFixup:
                 "" if len(missing_packages) == 1 else "s",
                 ", ".join(missing_packages),
             )
-            if not self._run_package_updater_threaded(missing_packages, "install"):
-                return 0
-            still_missing = [
-                pkg for pkg in missing_packages if not self._is_package_installed(pkg)
-            ]
-            if still_missing:
-                self.logger.error(
-                    "Failed to install required package%s: %s",
-                    "" if len(still_missing) == 1 else "s",
-                    ", ".join(still_missing),
-                )
-                return 0
+            self.plan.install(missing_packages)
             return 1
 
         return 0
 
     def remove_installed_packages(self, package_names: list[str]) -> int:
+        """Queue the installed packages for removal in self.plan.
+
+        Returns 1 if anything was queued.
+        """
         installed_packages = []
         for packagename in package_names:
             if self._is_package_installed(packagename):
@@ -1284,23 +1306,12 @@ class QuirkFixup:
             self.logger.info(
                 "Removing conflicting packages: %s\n", ", ".join(installed_packages)
             )
-            if not self._run_package_updater_threaded(installed_packages, "remove"):
-                return 0
-            still_installed = [
-                pkg for pkg in installed_packages if self._is_package_installed(pkg)
-            ]
-            if still_installed:
-                self.logger.error(
-                    "Failed to remove conflicting package%s: %s",
-                    "" if len(still_installed) == 1 else "s",
-                    ", ".join(still_installed),
-                )
-                return 0
+            self.plan.remove(installed_packages)
             return 1
 
         return 0
 
     def run_package_updater(self, package_names: list[str], action: str) -> bool:
         # Initialize the PackageUpdater
-        updater = PackageUpdater(package_names, action, None)
+        updater = PackageUpdater(package_names, action, None, session=self.session)
         return updater.success
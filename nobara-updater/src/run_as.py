@@ -1,10 +1,11 @@
+import atexit
 import json
 import logging
-import multiprocessing
-import os
-import pwd
-import sys
+import socket
+import struct
 import subprocess
+import sys
+import threading
 from pathlib import Path
 from typing import Any
 
@@ -13,57 +14,157 @@ logger = logging.getLogger(__name__)
 
 SCRIPT_FILE = __file__
 
+# Frames on the helper socket: a 4 byte big-endian length, then that many
+# bytes of JSON.
+_HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024 * 1024
+
+
+def send_frame(sock: socket.socket, message: Any) -> None:
+    body = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket) -> Any:
+    """The next message, or None once the other side has closed."""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    (size,) = _HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"Frame of {size} bytes is too large")
+    body = _recv_exactly(sock, size)
+    if body is None:
+        return None
+    return json.loads(body.decode("utf-8"))
+
+
+class UserHelper:
+    """A run_as_user_target.py process running as one user.
+
+    It drops its privileges once, then runs shared_functions calls sent
+    over a socketpair for as long as it lives, streaming their log lines
+    back while they run. One helper runs one call at a time.
+    """
+
+    def __init__(self, uid: int, gid: int) -> None:
+        self.uid = uid
+        self.gid = gid
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        target_script = Path(SCRIPT_FILE).resolve().parent / "run_as_user_target.py"
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, str(target_script), str(uid), str(gid), str(child_sock.fileno())],
+                pass_fds=(child_sock.fileno(),),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+        except OSError:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self.sock = parent_sock
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def call(self, func_name: str, option: str = "", *args: Any) -> Any:
+        send_frame(self.sock, {"call": func_name, "option": str(option), "args": list(args)})
+        while True:
+            message = recv_frame(self.sock)
+            if message is None:
+                raise ConnectionError(f"user helper exited while running {func_name}")
+            if "log" in message:
+                logger.info(message["log"], extra={"detail": bool(message.get("detail"))})
+            elif "error" in message:
+                logger.error("%s failed as user %s: %s", func_name, self.uid, message["error"])
+                return None
+            elif "result" in message:
+                return message["result"]
+
+    def close(self) -> None:
+        # The helper exits when its socket is closed.
+        self.sock.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+_helpers_lock = threading.Lock()
+_idle_helpers: dict[tuple[int, int], list[UserHelper]] = {}
+_all_helpers: list[UserHelper] = []
+
+
+def _take_helper(uid: int, gid: int) -> UserHelper:
+    with _helpers_lock:
+        idle = _idle_helpers.setdefault((uid, gid), [])
+        while idle:
+            helper = idle.pop()
+            if helper.alive():
+                return helper
+            helper.close()
+            _all_helpers.remove(helper)
+    # Another call is still running (the GUI calls from several threads),
+    # so this one gets a helper of its own.
+    helper = UserHelper(uid, gid)
+    with _helpers_lock:
+        _all_helpers.append(helper)
+    return helper
+
+
+def _return_helper(helper: UserHelper) -> None:
+    with _helpers_lock:
+        _idle_helpers.setdefault((helper.uid, helper.gid), []).append(helper)
+
+
+def _discard_helper(helper: UserHelper) -> None:
+    helper.close()
+    with _helpers_lock:
+        if helper in _all_helpers:
+            _all_helpers.remove(helper)
+
+
+@atexit.register
+def close_helpers() -> None:
+    with _helpers_lock:
+        helpers = list(_all_helpers)
+        _all_helpers.clear()
+        _idle_helpers.clear()
+    for helper in helpers:
+        helper.close()
+
+
 def run_as_user(
     uid: int, gid: int, func_name: str, option: str = "", *args: Any
-) -> list[str] | None:
-    # Determine the real directory of the main script
-    script_dir = Path(SCRIPT_FILE).resolve().parent
-    # Construct the path to run_as_user_target.py
-    target_script = script_dir / "run_as_user_target.py"
-    # Create a manager for shared queues
-    manager = multiprocessing.Manager()
-    log_queue = manager.Queue()
-    update_queue = manager.Queue()
-
-    # Serialize the queue data
-    log_queue_data: list[Any] = []
-    update_queue_data: list[Any] = []
-
-    command = [
-        sys.executable,
-        target_script,
-        str(uid),
-        str(gid),
-        func_name,
-        json.dumps(log_queue_data),
-        json.dumps(update_queue_data),
-        str(option),
-        *args,
-    ]
-
-    result = subprocess.run(
-        command,
-        capture_output=True,
-        text=True,
-        encoding="utf-8",
-        errors="replace",
-    )
-    # Enable these for debugging run_as_user_target.py
-    if result.returncode == 0 and result.stdout is not None:
-        try:
-            output = json.loads(result.stdout.strip())
-            # Deserialize the queue data
-            for item in output["log_queue"]:
-                log_queue.put(item)
-            for item in output["update_queue"]:
-                update_queue.put(item)
-            # Process logs
-            while not log_queue.empty():
-                log_message = log_queue.get()
-                logger.info(log_message)
-            return output["result"]
-        except json.JSONDecodeError:
-            logger.error("Failed to decode JSON output from subprocess")
-            return None
-    else:
+) -> Any:
+    """Run shared_functions.<func_name> as the given user.
+
+    The first call for a user starts a helper process, later ones reuse it.
+    Returns the function's result, or None if it failed.
+    """
+    try:
+        helper = _take_helper(uid, gid)
+    except OSError as e:
+        logger.error("Could not start user helper: %s", e)
+        return None
+    try:
+        result = helper.call(func_name, option, *args)
+    except (OSError, ValueError) as e:
+        logger.error("Running %s as user %s failed: %s", func_name, uid, e)
+        _discard_helper(helper)
         return None
+    _return_helper(helper)
+    return result
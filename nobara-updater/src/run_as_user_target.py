@@ -1,32 +1,56 @@
-import json
 import logging
-import multiprocessing
 import os
 import pwd
+import queue
+import socket
 import sys
+import traceback
 from pathlib import Path
 from typing import Any
 
 import nobara_updater.shared_functions as shared_functions  # type: ignore[import]
+from nobara_updater.run_as import recv_frame, send_frame
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_as_user_target(
-    uid: int,
-    gid: int,
-    func_name: str,
-    log_queue_data: list[Any],
-    update_queue_data: list[Any],
-    option: str = "",
-    *args: Any,
-) -> None:
-    os.setgid(gid)
-    os.setuid(uid)
+class _LogStream:
+    """What shared_functions get as log_queue: every put() is sent to the
+    parent right away instead of being collected until the call ends."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+
+    def put(self, item: Any) -> None:
+        send_frame(self.sock, {"log": str(item)})
+
+
+class _FrameLogHandler(logging.Handler):
+    """Sends what the shared functions log through `logging` to the parent
+    as well, keeping the file-only marker of detail lines."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        super().__init__(logging.INFO)
+        self.sock = sock
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            send_frame(self.sock, {"log": record.getMessage(), "detail": bool(getattr(record, "detail", False))})
+        except OSError:
+            self.handleError(record)
+
 
+def drop_privileges(uid: int, gid: int) -> None:
     # Get the user's home directory and other details
     pw_record = pwd.getpwuid(uid)
+
+    # The user's own supplementary groups instead of root's, the helper
+    # serves calls for the whole run.
+    os.initgroups(pw_record.pw_name, gid)
+    os.setgid(gid)
+    os.setuid(uid)
+
     user_home = Path(pw_record.pw_dir)
 
     # Update environment variables
@@ -47,48 +71,41 @@ def run_as_user_target(
     # Change working directory to the user's home directory
     os.chdir(user_home)
 
-    # Create the queues from the passed data
-    manager = multiprocessing.Manager()
-    log_queue = manager.Queue()
-    update_queue = manager.Queue()
-
-    for item in log_queue_data:
-        log_queue.put(item)
-
-    for item in update_queue_data:
-        update_queue.put(item)
-
-    # Import the function dynamically from shared_functions
-    func = getattr(shared_functions, func_name)
-    result = func(uid, gid, log_queue, update_queue, option, *args)
-
-    # Collect the queue data to return
-    log_queue_data = []
-    while not log_queue.empty():
-        log_queue_data.append(log_queue.get())
-
-    update_queue_data = []
-    while not update_queue.empty():
-        update_queue_data.append(update_queue.get())
 
-    sys.stdout.write(
-        json.dumps(
-            {
-                "result": result,
-                "log_queue": log_queue_data,
-                "update_queue": update_queue_data,
-            }
-        )
-        + "\n"
-    )
+def serve(uid: int, gid: int, sock: socket.socket) -> None:
+    """Run calls from the parent until it closes the socket."""
+    log_stream = _LogStream(sock)
+    root_logger = logging.getLogger()
+    # Only the parent prints, don't also write to stderr here.
+    root_logger.handlers = [_FrameLogHandler(sock)]
+    while True:
+        message = recv_frame(sock)
+        if message is None:
+            return
+        # Nothing reads the update queue, it is only there for the
+        # signature of the shared functions.
+        update_queue: queue.SimpleQueue[Any] = queue.SimpleQueue()
+        try:
+            func = getattr(shared_functions, message["call"])
+            result = func(uid, gid, log_stream, update_queue, message.get("option", ""), *message.get("args", []))
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            send_frame(sock, {"error": f"{type(e).__name__}: {e}"})
+            continue
+        try:
+            send_frame(sock, {"result": result})
+        except TypeError as e:
+            send_frame(sock, {"error": f"result is not serializable: {e}"})
 
 
 if __name__ == "__main__":
     uid = int(sys.argv[1])
     gid = int(sys.argv[2])
-    func_name = sys.argv[3]
-    log_queue_data = json.loads(sys.argv[4])
-    update_queue_data = json.loads(sys.argv[5])
-    option = str(sys.argv[6])
-    args = sys.argv[7:]
-    run_as_user_target(uid, gid, func_name, log_queue_data, update_queue_data, option, *args)
+    sock = socket.socket(fileno=int(sys.argv[3]))
+    drop_privileges(uid, gid)
+    try:
+        serve(uid, gid, sock)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        sock.close()
@@ -1,3 +1,4 @@
+import logging
 import os
 import pwd
 import subprocess
@@ -11,6 +12,9 @@ from typing import Any
 
 from gi.repository import Flatpak  # type: ignore[import]
 
+from nobara_updater.downloads import FlatpakTransferMonitor
+from nobara_updater.flatpak_updates import list_updates, maintain_installation
+
 DNF_APP_CENTER_BUS_NAME = "org.dnf.AppCenter.UpdateService"
 DNF_APP_CENTER_OBJECT_PATH = "/org/dnf/AppCenter/UpdateService"
 DNF_APP_CENTER_INTERFACE = "org.dnf.AppCenter.UpdateService"
@@ -77,6 +81,40 @@ def fp_get_user_updates(
         return update_list
     return []
 
+def fp_get_user_update_refs(
+    uid: int, gid: int, log_queue: Any, update_queue: Any, option: str = "",
+) -> list[dict[str, str]]:
+    # Like fp_get_user_updates(), but with what it takes to tell that two
+    # users are waiting for the very same update.
+    user_installation = Flatpak.Installation.new_user(None)
+    update_refs = []
+    with fp_user_installation_list(user_installation, log_queue) as flatpak_user_updates:
+        for ref in flatpak_user_updates:
+            try:
+                remote = user_installation.get_remote_by_name(ref.get_origin(), None)
+            except gi.repository.GLib.GError:
+                continue
+            update_refs.append({
+                "ref": ref.format_ref(),
+                "name": ref.get_appdata_name() or ref.get_name(),
+                "url": remote.get_url() or "",
+                "collection_id": remote.get_collection_id() or "",
+                "commit": ref.get_latest_commit() or "",
+            })
+    del user_installation
+    return update_refs
+
+def maintain_user_flatpaks(
+    uid: int, gid: int, log_queue: Any, update_queue: Any, option: str = "",
+) -> dict[str, Any]:
+    # option "after-updates": the updates are in, refs pulled for them can go.
+    user_installation = Flatpak.Installation.new_user(None)
+    result = maintain_installation(
+        user_installation, log_queue.put, drop_pulled=option == "after-updates"
+    )
+    del user_installation
+    return result
+
 def is_service_enabled(service_name):
     try:
         result = _run_text(["systemctl", "--user", "is-enabled", service_name])
@@ -178,7 +216,7 @@ def yumex_sync_updates(
 
 def install_user_flatpak_updates(
     uid: int, gid: int, log_queue: Any, update_queue: Any, option: str = "",
-) -> None:
+) -> int:
     # Get the user's home directory and other details
     pw_record = pwd.getpwuid(uid)
     user_home = Path(pw_record.pw_dir)
@@ -217,6 +255,7 @@ def install_user_flatpak_updates(
     with fp_user_installation_list(user_installation, log_queue) as flatpak_user_updates:
         if flatpak_user_updates:
             transaction = Flatpak.Transaction.new_for_installation(user_installation)
+            transfers = FlatpakTransferMonitor(logging.getLogger(), transaction, "user")
             for ref in flatpak_user_updates:
                 try:
                     appdata_name = ref.get_appdata_name()
@@ -231,7 +270,33 @@ def install_user_flatpak_updates(
                     else:
                         log_queue.put(f"Error updating ref: {e}")
             transaction.run()
+            transfers.report()
             log_queue.put("Flatpak User Updates complete!")
+            updated = len(flatpak_user_updates)
+        else:
+            updated = 0
+
+    del user_installation
+    return updated
+
+
+def prefetch_user_flatpak_updates(
+    uid: int, gid: int, log_queue: Any, update_queue: Any, option: str = "",
+) -> None:
+    # Pull only, install_user_flatpak_updates() deploys them later.
+    user_installation = Flatpak.Installation.new_user(None)
+
+    with fp_user_installation_list(user_installation, log_queue) as flatpak_user_updates:
+        if flatpak_user_updates:
+            transaction = Flatpak.Transaction.new_for_installation(user_installation)
+            transaction.set_no_deploy(True)
+            for ref in flatpak_user_updates:
+                try:
+                    transaction.add_update(ref.format_ref(), None, None)
+                except Exception as e:
+                    log_queue.put(f"Error prefetching ref: {e}")
+            transaction.run()
+            log_queue.put("Flatpak User Updates prefetched.")
 
     del user_installation
 
@@ -244,20 +309,13 @@ class fp_user_installation_list(object):
 
 
     def __enter__(self):
-        flatpak_user_updates = None
-        error = True # No do-while in Python so init to true to run loop once
-        while error:
-            try:
-                flatpak_user_updates = self.user_installation.list_installed_refs_for_update(None)
-            except gi.repository.GLib.GError as e:
-                # Expected, see #43
-                self.log_queue.put(f"Error getting Flatpak user updates: {e}")
-            except:
-                raise
-            else:
-                error = False
-        return flatpak_user_updates
-    
+        cache_dir = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "nobara-updater"
+        try:
+            return list_updates(self.user_installation, self.log_queue.put, "flatpak-user.json", cache_dir)
+        except gi.repository.GLib.GError as e:
+            self.log_queue.put(f"Error getting Flatpak user updates: {e}")
+            return []
+
 
     def __exit__(self, *args):
         del self.user_installation
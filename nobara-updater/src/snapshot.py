@@ -0,0 +1,122 @@
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any, Callable
+
+from nobara_updater.dnf import (  # type: ignore[import]
+    InstalledIndex,
+    InstalledPackage,
+    UpdateSession,
+    get_installed_index,
+    load_cached_upgrades,
+    updatechecker,
+)
+
+OS_RELEASE = Path("/etc/os-release")
+
+
+def _lazy(compute: Callable[["SystemSnapshot"], Any]) -> property:
+    """A property computed on first use and kept. Each one has its own
+    lock, so concurrent readers wait for the first computation instead of
+    repeating it, without holding up readers of other properties."""
+    name = compute.__name__
+
+    def get(self: "SystemSnapshot") -> Any:
+        with self._meta_lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._values:
+                self._values[name] = compute(self)
+            return self._values[name]
+
+    get.__doc__ = compute.__doc__
+    return property(get)
+
+
+class SystemSnapshot:
+    """What the quirks know about the system, probed once per fixup pass.
+
+    The quirks used to each run their own `dmesg | grep`, read
+    /etc/os-release through a shell and so on. Here every fact is read on
+    first use and shared. With cached_only, pending updates come from the
+    last update check instead of resolving the upgrade again, which is
+    what a dry run wants.
+    """
+
+    def __init__(
+        self,
+        installed: InstalledIndex | None = None,
+        session: UpdateSession | None = None,
+        cached_only: bool = False,
+    ) -> None:
+        self.installed = installed if installed is not None else get_installed_index()
+        self.session = session
+        self.cached_only = cached_only
+        self._meta_lock = threading.Lock()
+        self._locks: dict[str, threading.Lock] = {}
+        self._values: dict[str, Any] = {}
+
+    @property
+    def pending(self) -> list[str]:
+        """Names of the packages the pending upgrade touches."""
+        return self._pending
+
+    @pending.setter
+    def pending(self, names: list[str]) -> None:
+        # A quirk that dealt with some of the updates itself drops them.
+        with self._meta_lock:
+            self._values["_pending"] = list(names)
+
+    @_lazy
+    def _pending(self) -> list[str]:
+        if self.cached_only:
+            return load_cached_upgrades() or []
+        return updatechecker(session=self.session)
+
+    @_lazy
+    def packages(self) -> list[InstalledPackage]:
+        """The installed packages when the pass started, for the predicates.
+        Quirks that commit change the rpmdb, so quirk bodies read
+        installed.packages(), which follows it."""
+        return self.installed.packages()
+
+    @_lazy
+    def os_release(self) -> dict[str, str]:
+        release = {}
+        try:
+            lines = OS_RELEASE.read_text(encoding="utf-8", errors="replace").splitlines()
+        except OSError:
+            return release
+        for line in lines:
+            key, sep, value = line.partition("=")
+            if sep:
+                release[key.strip()] = value.strip().strip('"')
+        return release
+
+    @_lazy
+    def kernel(self) -> str:
+        return os.uname().release
+
+    @_lazy
+    def dmesg(self) -> str:
+        """The kernel log, which names the hardware (ROG Ally, Steam Deck)."""
+        result = subprocess.run(
+            ["dmesg"],
+            capture_output=True,
+            text=True, encoding="utf-8", errors="replace",
+        )
+        return result.stdout
+
+    @_lazy
+    def desktop(self) -> str:
+        return os.environ.get("XDG_CURRENT_DESKTOP", "").lower()
+
+    def is_installed(self, spec: str) -> bool:
+        return self.installed.is_installed(spec)
+
+    def any_installed(self, specs: list[str]) -> bool:
+        return any(self.installed.is_installed(spec) for spec in specs)
+
+    def pending_matching(self, *needles: str) -> list[str]:
+        return [name for name in self.pending if any(needle in name for needle in needles)]
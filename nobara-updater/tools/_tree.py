@@ -0,0 +1,25 @@
+"""Makes the nobara_updater package of this checkout importable.
+
+Installed, the modules live in site-packages/nobara_updater. Here a
+temporary directory gets a nobara_updater link to src/, so the tools can
+run the code under review without installing it.
+"""
+import atexit
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+
+def package_root() -> str:
+    """A directory to put on sys.path or PYTHONPATH, removed at exit."""
+    root = Path(tempfile.mkdtemp(prefix="nobara-updater-tree-"))
+    (root / "nobara_updater").symlink_to(SRC, target_is_directory=True)
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return str(root)
+
+
+def use_tree() -> None:
+    sys.path.insert(0, package_root())
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+"""Times check_repos() against a local stand-in for the mirrors.
+
+A server on 127.0.0.1 plays the mirrors:
+
+    /slow/...        answers after --delay seconds (metalinks, repomd.xml)
+    /dead/...        never answers before the 5 s client timeout
+    /mirrorlist/<n>  a dead mirror first, then a slow one
+
+The same set of repos is checked the way check_repos() used to, one URL
+after the other, and with check_repos() from this checkout, which checks
+them concurrently and races the mirrors of a mirrorlist. Needs
+python3-requests, nothing is installed or changed.
+
+    python3 tools/bench_repo_check.py [--repos 12] [--delay 0.5]
+"""
+import argparse
+import logging
+import time
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import requests
+
+from _tree import use_tree
+
+# Longer than the 5 s timeout of the validators.
+DEAD_SECONDS = 6.0
+METALINK = b'<?xml version="1.0"?><metalink xmlns="http://www.metalinker.org/"></metalink>'
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    delay = 0.5
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, body: bytes) -> None:
+        if self.path.startswith("/dead/"):
+            time.sleep(DEAD_SECONDS)
+            return
+        if self.path.startswith("/slow/"):
+            time.sleep(self.delay)
+        elif not self.path.startswith("/mirrorlist/"):
+            self.send_error(404)
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command == "GET":
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        if self.path.startswith("/mirrorlist/"):
+            n = self.path.rsplit("/", 1)[1]
+            host = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+            self._answer(f"{host}/dead/{n}/\n{host}/slow/{n}/\n".encode())
+        elif self.path.endswith("metalink"):
+            self._answer(METALINK)
+        else:
+            self._answer(b"<repomd/>")
+
+    def do_HEAD(self):
+        self._answer(b"")
+
+
+def repo_set(host: str, repos: int) -> tuple[list[str], list[str], list[str]]:
+    """Metalinks and baseurls for most repos, a mirrorlist for every fourth."""
+    metalinks, mirrorlists, baseurls = [], [], []
+    for n in range(repos):
+        if n % 4 == 3:
+            mirrorlists.append(f"{host}/mirrorlist/{n}")
+        elif n % 2:
+            baseurls.append(f"{host}/slow/{n}/repodata/repomd.xml")
+        else:
+            metalinks.append(f"{host}/slow/{n}/metalink")
+    return metalinks, mirrorlists, baseurls
+
+
+# What check_repos() did before the checks ran concurrently.
+def old_validate_metalink(url: str, session: requests.Session, headers: dict[str, str]) -> bool:
+    try:
+        response = session.get(url, headers=headers, timeout=5)
+        if response.status_code == 200:
+            try:
+                return ElementTree.fromstring(response.content).tag.endswith("metalink")
+            except ElementTree.ParseError:
+                return False
+        return False
+    except Exception:
+        return False
+
+
+def old_validate_baseurls(urls: list[str], session: requests.Session, headers: dict[str, str]) -> bool:
+    for url in urls:
+        try:
+            response = session.head(url, headers=headers, timeout=5)
+            if response.status_code == 200:
+                return True
+        except Exception:
+            return False
+    return False
+
+
+def old_validate_mirrorlist(url: str, session: requests.Session, headers: dict[str, str]) -> bool:
+    try:
+        response = session.get(url, headers=headers, timeout=5)
+        if response.status_code == 200:
+            mirrors = [
+                mirror.rstrip("/") + "/repodata/repomd.xml"
+                for mirror in response.text.splitlines() if mirror.strip()
+            ]
+            return old_validate_baseurls(mirrors, session, headers)
+        return False
+    except Exception:
+        return False
+
+
+def old_check(metalinks: list[str], mirrorlists: list[str], baseurls: list[str]) -> list[bool]:
+    session = requests.Session()
+    headers: dict[str, str] = {}
+    return (
+        [old_validate_metalink(url, session, headers) for url in metalinks]
+        + [old_validate_mirrorlist(url, session, headers) for url in mirrorlists]
+        + [old_validate_baseurls([url], session, headers) for url in baseurls]
+    )
+
+
+class Collect(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+def new_check(metalinks: list[str], mirrorlists: list[str], baseurls: list[str]) -> list[bool]:
+    from nobara_updater import nobara_sync
+
+    urls = metalinks + mirrorlists + baseurls
+    names = {url: f"repo{n}" for n, url in enumerate(urls)}
+    nobara_sync.get_repolist = lambda: (metalinks, mirrorlists, baseurls, names, names, names)
+
+    collect = Collect()
+    nobara_sync.logger.handlers = [collect]
+    nobara_sync.check_repos()
+    passed = {message.split(": ", 2)[-1].strip() for message in collect.messages if "✔" in message}
+    return [url in passed for url in urls]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repos", type=int, default=12, help="Repos to check (default 12)")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds a slow mirror takes (default 0.5)")
+    args = parser.parse_args()
+
+    # Import outside of the timing.
+    use_tree()
+    from nobara_updater import nobara_sync
+
+    nobara_sync.load_requests()
+
+    MirrorHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+    metalinks, mirrorlists, baseurls = repo_set(host, args.repos)
+
+    results = {}
+    for label, check in (("serial (before)", old_check), ("concurrent (now)", new_check)):
+        started = time.monotonic()
+        passed = check(metalinks, mirrorlists, baseurls)
+        results[label] = (time.monotonic() - started, sum(passed), len(passed))
+
+    print(f"{args.repos} repos, {len(mirrorlists)} mirrorlists with a dead first mirror, {args.delay} s per slow answer")
+    for label, (seconds, passed, total) in results.items():
+        print(f"  {label:17} {seconds:6.2f} s, {passed}/{total} repos reachable")
+    before, now = results["serial (before)"][0], results["concurrent (now)"][0]
+    print(f"  speedup          {before / max(now, 1e-6):6.1f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+"""Startup regression check for the nobara-updater in this checkout.
+
+Runs src/nobara_sync.py under `python -X importtime` for `--help` and
+`check-updates --help`, lists the slowest imports and fails if one of
+the heavy modules that only the commands themselves load shows up, or
+if the imports take longer than --max-seconds in total.
+
+    python3 tools/importtime.py [--max-seconds 0.5]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+from _tree import SRC, package_root
+
+RUNS = [["--help"], ["check-updates", "--help"]]
+HEAVY = re.compile(r"^(gi\.repository\.(Gtk|Flatpak)|libdnf5(\..*)?|dnf(\..*)?|requests)$")
+SLOWEST = 10
+# "import time:       123 |       4567 |   package.module"
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def profile(args: list[str], root: str) -> list[tuple[int, int, str]]:
+    """(self µs, cumulative µs, module) of every import of one run."""
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(SRC / "nobara_sync.py"), *args],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        sys.exit(f"nobara_sync.py {' '.join(args)} failed:\n{result.stderr[-2000:]}")
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            imports.append((int(match[1]), int(match[2]), match[4]))
+    return imports
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--max-seconds", type=float, default=0.5, help="Budget for all imports of one run (default 0.5)"
+    )
+    args = parser.parse_args()
+
+    root = package_root()
+    failed = False
+    for run in RUNS:
+        imports = profile(run, root)
+        total = sum(self_us for self_us, _, _ in imports) / 1_000_000
+        print(f"nobara-updater {' '.join(run)}: {len(imports)} imports, {total:.3f} s")
+        for self_us, cumulative_us, module in sorted(imports, key=lambda i: i[1], reverse=True)[:SLOWEST]:
+            print(f"  {cumulative_us / 1000:8.1f} ms  {module}")
+        heavy = sorted({module for _, _, module in imports if HEAVY.match(module)})
+        if heavy:
+            print(f"  FAIL: loads {', '.join(heavy)}")
+            failed = True
+        if total > args.max_seconds:
+            print(f"  FAIL: over the {args.max_seconds} s budget")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())